@@ -0,0 +1,151 @@
+"""
+ Paged album browser for Music Mover.
+"""
+
+import bisect
+import math
+
+
+class NameIndex(object):
+	"""
+	Prefix and substring lookup over a fixed list of names, without case.
+	Prefixes are found by bisecting the sorted names. For substrings every
+	name is joined into one string, which str.find scans at C speed, and a
+	hit is mapped back to its name by bisecting the start offsets.
+	"""
+
+	def __init__(self, name_list):
+		key_list = [name.lower() for name in name_list]
+		self.sorted_list = sorted([(key, position) for position, key in enumerate(key_list)])
+		self.sorted_keys = [key for key, position in self.sorted_list]
+		# a newline never appears in a query, so no match spans two names
+		self.offset_list = []
+		offset = 0
+		for key in key_list:
+			self.offset_list.append(offset)
+			offset += len(key) + 1
+		self.text = "\n".join(key_list)
+
+	def prefix(self, text):
+		" Positions of the names starting with text, in name order "
+		text = text.lower()
+		start = bisect.bisect_left(self.sorted_keys, text)
+		position_list = []
+		for key, position in self.sorted_list[start:]:
+			if not key.startswith(text):
+				break
+			position_list.append(position)
+		position_list.sort()
+		return position_list
+
+	def substring(self, text):
+		" Positions of the names containing text, in name order "
+		text = text.lower()
+		if not text:
+			return range(len(self.offset_list))
+		position_list = []
+		offset = self.text.find(text)
+		while offset >= 0:
+			position = bisect.bisect_right(self.offset_list, offset) - 1
+			position_list.append(position)
+			# the rest of this name can not add another hit
+			if position + 1 >= len(self.offset_list):
+				break
+			offset = self.text.find(text, self.offset_list[position + 1])
+		return position_list
+
+
+class AlbumBrowser(object):
+	"""
+	A listing of albums shown a page at a time, narrowed by a filter. Each
+	album keeps its number in the whole listing, so a selection means the
+	same albums on any page and under any filter. Albums removed once they
+	are acted on keep their numbers too.
+	"""
+
+	page_size = 30
+
+	def __init__(self, album_list):
+		self.album_list = album_list
+		self.index = NameIndex(album_list)
+		self.removed = set()
+		self.filter = ''
+		self.prefix = False
+		# positions in album_list of the albums shown
+		self.view = range(len(album_list))
+		self.page = 0
+
+	def set_filter(self, text, prefix=False):
+		"""
+		Show only the albums containing text, or starting with it if prefix is
+		set. A filter which extends the current one narrows the albums already
+		shown rather than searching the whole listing.
+		"""
+		text = text.lower()
+		if not text:
+			position_list = range(len(self.album_list))
+		elif self.filter and ((self.prefix and prefix and text.startswith(self.filter)) or
+				(not self.prefix and self.filter in text)):
+			# every album which matches text matches the current filter
+			if prefix:
+				position_list = [position for position in self.view
+						if self.album_list[position].lower().startswith(text)]
+			else:
+				position_list = [position for position in self.view
+						if text in self.album_list[position].lower()]
+		elif prefix:
+			position_list = self.index.prefix(text)
+		else:
+			position_list = self.index.substring(text)
+		self.filter = text
+		self.prefix = prefix and bool(text)
+		self.view = [position for position in position_list if position not in self.removed]
+		self.page = 0
+
+	def remove(self, album):
+		" Hide an album which was acted on, its number is kept "
+		position_list = [position for position in self.view if self.album_list[position] == album]
+		for position in position_list:
+			self.removed.add(position)
+			self.view.remove(position)
+		self.page = min(self.page, self.page_count() - 1)
+
+	def page_count(self):
+		return max(1, int(math.ceil(len(self.view) / float(self.page_size))))
+
+	def next_page(self):
+		self.page = min(self.page + 1, self.page_count() - 1)
+
+	def prev_page(self):
+		self.page = max(self.page - 1, 0)
+
+	def page_items(self):
+		" (number, album) of the albums on the current page "
+		start = self.page * self.page_size
+		return [(position + 1, self.album_list[position])
+				for position in self.view[start:start + self.page_size]]
+
+	def album(self, number):
+		return self.album_list[number - 1]
+
+	def select(self, selection):
+		"""
+		Parse a selection like 1,3-5 into a list of album numbers. Ranges take
+		only the albums shown under the current filter. Raises ValueError if
+		a number is not shown.
+		"""
+		shown = set(self.view)
+		number_list = []
+		for part in selection.split(','):
+			if '-' in part:
+				low, high = map(int, part.split('-'))
+				# bisect, the view is in listing order
+				start = bisect.bisect_left(self.view, low - 1)
+				end = bisect.bisect_right(self.view, high - 1)
+				number_list.extend([position + 1 for position in self.view[start:end]])
+			else:
+				number = int(part)
+				if number - 1 not in shown:
+					raise ValueError("Album %d is not listed." % (number))
+				number_list.append(number)
+		return number_list
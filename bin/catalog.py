@@ -0,0 +1,69 @@
+"""
+ Catalog of the albums on every remote site for Music Mover.
+"""
+
+import threading
+
+
+class Catalog(object):
+	"""
+	The albums listed by a group of sites, merged by name. Each album has a
+	list of sources, (conn_manager, remote dir), in the order of the sites.
+	Albums blocked on a site are not taken from it.
+	"""
+
+	def __init__(self, conn_manager_list):
+		self.conn_manager_list = conn_manager_list
+		self.source_map = {}
+		self.error_list = []
+
+	def load(self, force=False):
+		" List every site at once, force skips the listing caches "
+		result_map = {}
+		def list_site(conn_manager):
+			try:
+				result_map[conn_manager] = conn_manager.get_album_list(force)
+			except Exception, err:
+				result_map[conn_manager] = ({}, ["%s: %s" % (conn_manager.remote_site.name, err)])
+		thread_list = []
+		for conn_manager in self.conn_manager_list:
+			thread = threading.Thread(target=list_site, args=(conn_manager,))
+			thread.setDaemon(True)
+			thread.start()
+			thread_list.append(thread)
+		for thread in thread_list:
+			thread.join()
+
+		self.source_map = {}
+		self.error_list = []
+		for conn_manager in self.conn_manager_list:
+			album_map, error_list = result_map[conn_manager]
+			self.error_list.extend(error_list)
+			blocked_set = set(conn_manager.remote_site.blocked_album_list)
+			for album, dir in album_map.items():
+				if album not in blocked_set:
+					self.source_map.setdefault(album, []).append((conn_manager, dir))
+
+	def album_list(self):
+		return sorted(self.source_map.keys())
+
+	def sources(self, album, stats=None):
+		" The sources of album, fastest first by the site rates in stats "
+		source_list = self.source_map[album]
+		if not stats or len(source_list) < 2:
+			return list(source_list)
+		rate_list = stats.site_rates([conn_manager.remote_site.name
+				for conn_manager, dir in source_list])
+		rank_list = []
+		for (conn_manager, dir), rate in zip(source_list, rate_list):
+			# equal rates go to the site with less queued
+			rank_list.append((-rate, conn_manager.pending_transfers(), len(rank_list),
+					(conn_manager, dir)))
+		rank_list.sort()
+		return [rank[-1] for rank in rank_list]
+
+	def site_names(self, album):
+		return [conn_manager.remote_site.name for conn_manager, dir in self.source_map[album]]
+
+	def remove(self, album):
+		self.source_map.pop(album, None)
@@ -0,0 +1,202 @@
+"""
+ Block delta transfer for Music Mover.
+
+ An rsync style delta: the local copy of a file is split into blocks and a
+ weak (adler32) and strong (md5) checksum of each block is sent to the remote
+ host. A small python script run there with exec_command rolls the weak
+ checksum over the remote file, and replies with a stream of block copies and
+ literal data, so only the changed parts of the file cross the link.
+"""
+
+import os
+import zlib
+import hashlib
+
+from manifest import shell_quote
+from scheduler import ThrottledReader
+
+
+# Runs on the remote host under python 2 or 3. Reads the block size, block
+# count and signatures on stdin, writes the delta to stdout:
+#   C <index>\n            copy block index from the local file
+#   L <length>\n<data>     literal data
+#   E <md5>\n              end, md5 of the whole remote file
+REMOTE_SCRIPT = r'''
+import sys, zlib, hashlib
+M = 65521
+inp = getattr(sys.stdin, "buffer", sys.stdin)
+out = getattr(sys.stdout, "buffer", sys.stdout)
+bs, count = [int(v) for v in inp.readline().split()]
+strong_list = []
+weak_map = {}
+for i in range(count):
+    weak, strong = inp.readline().split()
+    strong = strong.decode("ascii")
+    strong_list.append(strong)
+    weak_map.setdefault(int(weak), []).append((strong, i))
+def emit(op, arg, data=None):
+    out.write(("%s %s\n" % (op, arg)).encode("ascii"))
+    if data:
+        out.write(data)
+f = open(sys.argv[1], "rb")
+whole = hashlib.md5()
+buf = bytearray()
+base = pos = lit = 0
+eof = False
+expect = 0
+rolling = False
+a = b = 0
+while True:
+    while not eof and base + len(buf) < pos + bs + 1:
+        chunk = f.read(1 << 20)
+        if not chunk:
+            eof = True
+            break
+        whole.update(chunk)
+        buf.extend(chunk)
+    if base + len(buf) - pos < bs:
+        break
+    start = pos - base
+    hit = None
+    if not rolling:
+        window = bytes(buf[start:start + bs])
+        # after a copy the next block usually follows
+        if expect < count and hashlib.md5(window).hexdigest()[:16] == strong_list[expect]:
+            hit = expect
+        else:
+            check = zlib.adler32(window) & 0xffffffff
+            a, b = check & 0xffff, check >> 16
+            rolling = True
+    if hit is None and ((b << 16) | a) in weak_map:
+        strong = hashlib.md5(bytes(buf[start:start + bs])).hexdigest()[:16]
+        for candidate, index in weak_map[(b << 16) | a]:
+            if candidate == strong:
+                hit = index
+                break
+    if hit is not None:
+        if lit < pos:
+            emit("L", pos - lit, bytes(buf[lit - base:start]))
+        emit("C", hit)
+        pos += bs
+        lit = pos
+        expect = hit + 1
+        rolling = False
+        del buf[:pos - base]
+        base = pos
+        continue
+    if base + len(buf) <= pos + bs:
+        break
+    old, new = buf[start], buf[start + bs]
+    a = (a - old + new) % M
+    b = (b - bs * old + a - 1) % M
+    pos += 1
+    if pos - lit >= (1 << 20):
+        emit("L", pos - lit, bytes(buf[lit - base:pos - base]))
+        lit = pos
+        del buf[:lit - base]
+        base = lit
+emit("L", base + len(buf) - lit, bytes(buf[lit - base:]))
+emit("E", whole.hexdigest())
+out.flush()
+'''
+
+
+def block_signatures(path, block_size):
+	" Weak and strong checksums for each full block of a local file "
+	signature_list = []
+	f_local = open(path, 'rb')
+	try:
+		while(True):
+			block = f_local.read(block_size)
+			if len(block) < block_size:
+				break
+			signature_list.append((zlib.adler32(block) & 0xffffffff,
+					hashlib.md5(block).hexdigest()[:16]))
+	finally:
+		f_local.close()
+	return signature_list
+
+
+def python_command(script, arg_list):
+	" The command which runs a python script on the remote host, exit 127 without python "
+	return ("for py in python3 python; do command -v $py >/dev/null && "
+			"exec $py -c %s %s; done; exit 127" % (shell_quote(script),
+			" ".join([shell_quote(arg) for arg in arg_list])))
+
+
+def remote_command(remote_path):
+	" The command which runs the delta script on the remote host "
+	return python_command(REMOTE_SCRIPT, [remote_path])
+
+
+def apply_delta(stream, old_path, new_file, block_size):
+	"""
+	Rebuild the remote file in new_file from the delta stream and the blocks of
+	the local file at old_path. Returns the number of literal bytes received.
+	"""
+	literal_bytes = 0
+	whole = hashlib.md5()
+	f_old = open(old_path, 'rb')
+	try:
+		while(True):
+			line = stream.readline()
+			if not line:
+				raise IOError("Delta stream ended early")
+			op, arg = line.split()
+			if op == 'E':
+				if arg != whole.hexdigest():
+					raise IOError("Delta result does not match the remote file")
+				return literal_bytes
+			if op == 'C':
+				f_old.seek(int(arg) * block_size)
+				data = f_old.read(block_size)
+			elif op == 'L':
+				data = stream.read(int(arg))
+				if len(data) != int(arg):
+					raise IOError("Delta stream ended early")
+				literal_bytes += len(data)
+			else:
+				raise IOError("Unknown delta op %s" % (op))
+			new_file.write(data)
+			whole.update(data)
+	finally:
+		f_old.close()
+
+
+def delta_file(ssh_client, remote_path, dest, mtime, block_size, throttle=None):
+	"""
+	Update the local file dest to match remote_path by transferring only the
+	changed blocks. The result is written to dest.part and renamed into place.
+	Returns the number of literal bytes transferred. If given, throttle is
+	called with the size of each read of the delta.
+	"""
+	signature_list = block_signatures(dest, block_size)
+	stdin, stdout, stderr = ssh_client.exec_command(remote_command(remote_path))
+	stdin.write("%d %d\n" % (block_size, len(signature_list)))
+	for weak, strong in signature_list:
+		stdin.write("%d %s\n" % (weak, strong))
+	stdin.flush()
+	stdin.channel.shutdown_write()
+
+	stream = stdout
+	if throttle:
+		stream = ThrottledReader(stdout, throttle)
+	part_path = dest + '.part'
+	f_part = open(part_path, 'wb')
+	try:
+		try:
+			literal_bytes = apply_delta(stream, dest, f_part, block_size)
+		finally:
+			f_part.close()
+	except (IOError, ValueError), err:
+		os.remove(part_path)
+		# the remote may still be blocked writing the delta, closing the
+		# channel ends the stderr read at what has arrived
+		stdout.channel.close()
+		error = stderr.read().strip()
+		if error:
+			raise IOError("Delta of %s failed: %s" % (remote_path, error))
+		raise IOError("Delta of %s failed: %s" % (remote_path, err))
+	os.rename(part_path, dest)
+	os.utime(dest, (mtime, mtime))
+	return literal_bytes
@@ -0,0 +1,303 @@
+"""
+ Album content fingerprints for Music Mover.
+
+ A file's fingerprint is its size and an md5 of its first and last 64KB, cheap
+ enough to compute for a whole library. Remote fingerprints are computed by a
+ script run with exec_command, which keeps them in a cache file on the remote
+ host; local ones are kept in sqlite. Both are computed again only when a
+ file's size or mtime changes.
+
+ Pulled files verified against the remote content hash are recorded with
+ that hash, in the same database, for finding duplicates later.
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+
+from delta import python_command
+from manifest import read_nul_records
+from matcher import AlbumMatch
+
+
+# bytes hashed at each end of a file
+SPAN = 65536
+
+# Runs on the remote host under python 2 or 3. Reads album dirs, NUL
+# separated, on stdin and writes "<album>\t<size>\t<fingerprint>\0" for every
+# file below them. argv is the cache file and the span.
+REMOTE_SCRIPT = r'''
+import sys, os, hashlib
+inp = getattr(sys.stdin, "buffer", sys.stdin)
+out = getattr(sys.stdout, "buffer", sys.stdout)
+cache_path = os.path.expanduser(sys.argv[1])
+span = int(sys.argv[2])
+cache = {}
+try:
+    f = open(cache_path, "rb")
+    for record in f.read().split(b"\0"):
+        part = record.split(b"\t", 3)
+        if len(part) == 4:
+            cache[part[3]] = part[:3]
+    f.close()
+except (IOError, OSError):
+    pass
+def fingerprint(path, size):
+    whole = hashlib.md5()
+    f = open(path, "rb")
+    whole.update(f.read(span))
+    if size > span:
+        f.seek(max(span, size - span))
+        whole.update(f.read(span))
+    f.close()
+    return whole.hexdigest()[:16].encode("ascii")
+changed = False
+for album in inp.read().split(b"\0"):
+    if not album:
+        continue
+    for root, dirs, files in os.walk(album):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            size = str(st.st_size).encode("ascii")
+            mtime = str(int(st.st_mtime)).encode("ascii")
+            entry = cache.get(path)
+            if not entry or entry[0] != size or entry[1] != mtime:
+                try:
+                    entry = [size, mtime, fingerprint(path, st.st_size)]
+                except (IOError, OSError):
+                    continue
+                cache[path] = entry
+                changed = True
+            out.write(album + b"\t" + size + b"\t" + entry[2] + b"\0")
+out.flush()
+if changed:
+    f = open(cache_path + ".tmp", "wb")
+    for path in cache:
+        f.write(b"\t".join(cache[path] + [path]) + b"\0")
+    f.close()
+    os.rename(cache_path + ".tmp", cache_path)
+'''
+
+REMOTE_CACHE = '~/.mover_fingerprints'
+
+
+def file_fingerprint(path, size):
+	" The fingerprint of a local file, as computed by the remote script "
+	whole = hashlib.md5()
+	f_local = open(path, 'rb')
+	try:
+		whole.update(f_local.read(SPAN))
+		if size > SPAN:
+			f_local.seek(max(SPAN, size - SPAN))
+			whole.update(f_local.read(SPAN))
+	finally:
+		f_local.close()
+	return whole.hexdigest()[:16]
+
+
+def remote_fingerprints(ssh_client, album_path_list):
+	" Return a map of remote album path to the list of its file keys "
+	stdin, stdout, stderr = ssh_client.exec_command(python_command(REMOTE_SCRIPT,
+			[REMOTE_CACHE, str(SPAN)]))
+	stdin.write("\0".join(album_path_list))
+	stdin.flush()
+	stdin.channel.shutdown_write()
+	album_map = {}
+	for record in read_nul_records(stdout):
+		part_list = record.split('\t')
+		if len(part_list) != 3:
+			continue
+		album, size, fingerprint = part_list
+		album_map.setdefault(album, []).append("%s:%s" % (size, fingerprint))
+	if stdout.channel.recv_exit_status() != 0 and not album_map:
+		stdout.channel.close()
+		raise IOError("Fingerprints failed: %s" % (stderr.read().strip()))
+	return album_map
+
+
+class FingerprintIndex(object):
+	" Fingerprints of the files in the local albums, cached in sqlite "
+
+	# matches below this are not shown
+	flag_confidence = 0.5
+
+	def __init__(self, path):
+		index_dir = os.path.dirname(path)
+		if index_dir and not os.path.isdir(index_dir):
+			os.makedirs(index_dir)
+		self.db = sqlite3.connect(path)
+		self.db.text_factory = str
+		self.db.execute("""CREATE TABLE IF NOT EXISTS file (
+				path TEXT PRIMARY KEY,
+				size INTEGER NOT NULL,
+				mtime INTEGER NOT NULL,
+				fingerprint TEXT NOT NULL)""")
+		self.key_map = {}
+		self.album_count = {}
+		# file rows by path, loaded on the first refresh
+		self.known = None
+		# album path to (dir mtimes, map of file path to key) as last walked
+		self.album_map = {}
+
+	def close(self):
+		self.db.close()
+
+	def refresh(self, album_path_list):
+		"""
+		Fingerprint the files of the local albums. A file counts for its album
+		and every album above it. Albums are walked again only if they are
+		new, or a dir in them changed since the last refresh; the files of
+		the rest keep their fingerprints.
+		"""
+		if self.known is None:
+			self.known = {}
+			for path, size, mtime, fingerprint in self.db.execute("SELECT * FROM file"):
+				self.known[path] = (size, mtime, fingerprint)
+		album_path_set = set(album_path_list)
+		for album in self.album_map.keys():
+			if album not in album_path_set:
+				self._forget(self.album_map.pop(album)[1])
+		for album in album_path_set:
+			if album in self.album_map and not self._changed(self.album_map[album][0]):
+				continue
+			old = self.album_map.get(album, ({}, {}))[1]
+			dir_mtimes, file_map = self._scan(album)
+			self._forget([path for path in old if path not in file_map])
+			self.album_map[album] = (dir_mtimes, file_map)
+		self.db.commit()
+
+		self.key_map = {}
+		self.album_count = {}
+		for album, (dir_mtimes, file_map) in self.album_map.iteritems():
+			for key in file_map.itervalues():
+				self.key_map.setdefault(key, set()).add(album)
+			self.album_count[album] = len(file_map)
+
+	def _scan(self, album):
+		" Walk an album, returns the mtime of each dir and a map of file path to key "
+		dir_mtimes = {}
+		file_map = {}
+		for dir, dir_list, file_list in os.walk(album):
+			try:
+				dir_mtimes[dir] = os.stat(dir).st_mtime
+			except OSError:
+				continue
+			for name in file_list:
+				path = os.path.join(dir, name)
+				key = self._file_key(path, self.known)
+				if key:
+					file_map[path] = key
+		return dir_mtimes, file_map
+
+	def _changed(self, dir_mtimes):
+		" True if a dir of an album was added to, removed from, or is gone "
+		for dir, mtime in dir_mtimes.iteritems():
+			try:
+				if os.stat(dir).st_mtime != mtime:
+					return True
+			except OSError:
+				return True
+		return False
+
+	def _forget(self, path_list):
+		" Drop the fingerprints of files which are gone "
+		for path in path_list:
+			if self.known.pop(path, None):
+				self.db.execute("DELETE FROM file WHERE path = ?", (path,))
+
+	def _file_key(self, path, known):
+		try:
+			stat = os.stat(path)
+			size, mtime = stat.st_size, int(stat.st_mtime)
+			if path in known and known[path][:2] == (size, mtime):
+				fingerprint = known[path][2]
+			else:
+				fingerprint = file_fingerprint(path, size)
+				self.db.execute("INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?)",
+						(path, size, mtime, fingerprint))
+				known[path] = (size, mtime, fingerprint)
+		except (IOError, OSError):
+			return None
+		return "%d:%s" % (size, fingerprint)
+
+	def match(self, album, key_list):
+		"""
+		Return an AlbumMatch with the local album sharing the most files with
+		the keys of a remote album, or None if none share any. The confidence
+		is the files shared over the files in the larger of the two, so it is
+		1 only for an album holding exactly the same files.
+		"""
+		if not key_list:
+			return None
+		count_map = {}
+		for key in key_list:
+			for local in self.key_map.get(key, ()):
+				count_map[local] = count_map.get(local, 0) + 1
+		if not count_map:
+			return None
+		confidence, local = max([(float(count) / max(len(key_list), self.album_count[local]),
+				local) for local, count in count_map.items()])
+		return AlbumMatch(album, os.path.basename(local), AlbumMatch.CONTENT, confidence)
+
+
+class HashStore(object):
+	"""
+	Content hashes of the local files verified after a pull, see verify.py.
+	Used from the transfer threads, so access is locked.
+	"""
+
+	def __init__(self, path):
+		index_dir = os.path.dirname(path)
+		if index_dir and not os.path.isdir(index_dir):
+			os.makedirs(index_dir)
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.text_factory = str
+		self.db.execute("""CREATE TABLE IF NOT EXISTS verified (
+				path TEXT PRIMARY KEY,
+				size INTEGER NOT NULL,
+				mtime INTEGER NOT NULL,
+				hash TEXT NOT NULL)""")
+		self.db.execute("CREATE INDEX IF NOT EXISTS verified_hash ON verified (hash)")
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def add(self, path_list):
+		" Record (path, content hash) of verified local files "
+		self.lock.acquire()
+		try:
+			for path, content_hash in path_list:
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				self.db.execute("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?)",
+						(path, stat.st_size, int(stat.st_mtime), content_hash))
+			self.db.commit()
+		finally:
+			self.lock.release()
+
+	def find(self, size, content_hash):
+		" The local files with a content hash, which are unchanged since they were verified "
+		self.lock.acquire()
+		try:
+			row_list = self.db.execute("SELECT path, size, mtime FROM verified WHERE hash = ?",
+					(content_hash,)).fetchall()
+		finally:
+			self.lock.release()
+		path_list = []
+		for path, row_size, mtime in row_list:
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			if row_size == size and stat.st_size == size and int(stat.st_mtime) == mtime:
+				path_list.append(path)
+		return path_list
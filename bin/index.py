@@ -0,0 +1,92 @@
+"""
+ Persistent local album index for Music Mover.
+
+ Every directory scanned under the local music dirs is stored in sqlite with
+ its mtime. A directory's mtime changes when entries are added, removed or
+ renamed in it, so on refresh only directories whose mtime moved are listed
+ again, the rest are answered from the index.
+"""
+
+import os
+import sqlite3
+
+from walker import AlbumWalker
+
+
+class AlbumIndex(object):
+	" An sqlite index of the local album directories "
+
+	schema_version = 1
+
+	def __init__(self, path):
+		index_dir = os.path.dirname(path)
+		if index_dir and not os.path.isdir(index_dir):
+			os.makedirs(index_dir)
+		self.path = path
+		# a refresh may run in a background thread, see LocalMusic.start_refresh,
+		# the connection is never used from two threads at once
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		# paths are byte strings, as returned by os.listdir
+		self.db.text_factory = str
+		self._create()
+
+	def _create(self):
+		version = self.db.execute("PRAGMA user_version").fetchone()[0]
+		if version == self.schema_version:
+			return
+		self.db.executescript("""
+			DROP TABLE IF EXISTS dir;
+			CREATE TABLE dir (
+				path TEXT PRIMARY KEY,
+				parent TEXT,
+				root TEXT NOT NULL,
+				depth INTEGER NOT NULL,
+				mtime REAL NOT NULL,
+				partial INTEGER NOT NULL DEFAULT 0
+			);
+			CREATE INDEX dir_parent ON dir (parent);
+			PRAGMA user_version = %d;
+		""" % (self.schema_version))
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def album_list(self):
+		" Paths of every album in the index "
+		return [row[0] for row in self.db.execute(
+				"SELECT path FROM dir WHERE depth > 0 AND partial = 0 ORDER BY path")]
+
+	def refresh(self, root_list, max_depth, partial_marker, workers=8):
+		"""
+		Bring the index up to date with the directories under root_list, down
+		to max_depth. Only directories whose mtime changed are listed. Returns
+		a list of (path, error) for directories which could not be read.
+		"""
+		known = {}
+		row_list = self.db.execute("SELECT path, parent, mtime, partial FROM dir").fetchall()
+		for path, parent, mtime, partial in row_list:
+			known[path] = (mtime, partial, [])
+		for path, parent, mtime, partial in row_list:
+			if parent in known:
+				known[parent][2].append(path)
+
+		walker = AlbumWalker(max_depth, partial_marker, workers, known)
+		seen = set()
+		for node in walker.walk(root_list):
+			if node.error:
+				# forget it, so it is listed again next time
+				self.db.execute("DELETE FROM dir WHERE path = ?", (node.path,))
+				continue
+			seen.add(node.path)
+			if node.scanned:
+				self.db.execute("INSERT OR REPLACE INTO dir VALUES (?, ?, ?, ?, ?, ?)",
+						(node.path, node.parent, node.root, node.depth, node.mtime,
+						int(node.partial)))
+		# directories which are gone, or below a partial album, or a root
+		# which is no longer configured
+		for path in known:
+			if path not in seen:
+				self.db.execute("DELETE FROM dir WHERE path = ?", (path,))
+		self.db.commit()
+		return walker.error_list
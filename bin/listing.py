@@ -0,0 +1,161 @@
+"""
+ Remote album listings, and their cache, for Music Mover.
+
+ Albums are listed with one find per site, which prints the dir and the
+ relative path of each entry at the album depth NUL delimited, so names may
+ hold any byte but NUL. The output is parsed as it arrives, a record at a
+ time.
+"""
+
+import os
+import re
+import json
+import time
+import posixpath
+from stat import S_ISDIR
+
+from manifest import shell_quote, read_nul_records
+
+
+def listing_command(dir_list, depth):
+	"""
+	The remote find listing every entry depth levels below the dirs in
+	dir_list, hidden entries and anything below them are skipped
+	"""
+	return "find -L %s -mindepth 1 -maxdepth %d -name '.*' -prune -o -printf '%%H\\t%%P\\0'" % (
+			" ".join([shell_quote(dir) for dir in dir_list]), depth)
+
+
+def parse_listing(stream, depth):
+	" Yield (dir, path) of each album in the output of listing_command as it arrives "
+	for record in read_nul_records(stream):
+		part_list = record.split('\t', 1)
+		# dirs above the album depth are printed on the way down
+		if len(part_list) == 2 and part_list[1].count('/') == depth - 1:
+			yield part_list[0], part_list[1]
+
+
+def walk_listing(scp_client, dir, depth):
+	" Yield (dir, path) of each album below dir, with sftp, for hosts without a GNU find "
+	path_list = ['']
+	for level in range(depth):
+		next_list = []
+		for path in path_list:
+			for attr in scp_client.listdir_attr(posixpath.join(dir, path)):
+				name = attr.filename
+				# sftp decodes utf-8 names, the find listing gives bytes
+				if isinstance(name, unicode):
+					name = name.encode('utf-8')
+				if name.startswith('.'):
+					continue
+				if level == depth - 1:
+					yield dir, posixpath.join(path, name)
+				elif S_ISDIR(attr.st_mode):
+					next_list.append(posixpath.join(path, name))
+		path_list = next_list
+
+
+def mtime_command(dir_list, depth):
+	" The remote find printing the mtime of each dir in dir_list and the dirs above the album depth "
+	return "find -L %s -maxdepth %d -type d -printf '%%H\\t%%T@\\0'" % (
+			" ".join([shell_quote(dir) for dir in dir_list]), depth - 1)
+
+
+def parse_mtimes(stream):
+	"""
+	Return a map of dir to the latest mtime in the output of mtime_command,
+	an album added at any depth changes the mtime of its parent
+	"""
+	mtime_map = {}
+	for record in read_nul_records(stream):
+		part_list = record.rsplit('\t', 1)
+		if len(part_list) != 2:
+			continue
+		dir, mtime = part_list
+		try:
+			if dir not in mtime_map or float(mtime) > float(mtime_map[dir]):
+				mtime_map[dir] = mtime
+		except ValueError:
+			continue
+	return mtime_map
+
+
+def album_entry(dir, path):
+	" The album name and remote parent dir of path, an album found below dir "
+	parent, album = posixpath.split(path)
+	if parent:
+		dir = posixpath.join(dir, parent)
+	return album, dir
+
+
+class ListingCache(object):
+	"""
+	The album listing of each remote dir of a site, with the dir's mtime when
+	it was listed and the time it was last checked. Albums are paths relative
+	to the dir. Stored as json, one file per site.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.dir_map = {}
+		self._load()
+
+	@staticmethod
+	def site_path(cache_dir, remote_site):
+		" The cache file of remote_site in cache_dir "
+		name = re.sub(r'[^\w.-]', '_', "%s@%s_%s" % (remote_site.username,
+				remote_site.hostname, remote_site.port))
+		return os.path.join(cache_dir, name + '.json')
+
+	def get(self, dir):
+		" Return (mtime, album list) for a dir, or None if it is not cached "
+		entry = self.dir_map.get(dir)
+		if entry is None:
+			return None
+		return entry['mtime'], entry['albums']
+
+	def put(self, dir, mtime, album_list):
+		self.dir_map[dir] = {'mtime': mtime, 'albums': album_list, 'checked': time.time()}
+
+	def touch(self, dir):
+		" Record that dir was found unchanged "
+		self.dir_map[dir]['checked'] = time.time()
+
+	def age(self, dir_list):
+		" Seconds since the least recently checked dir, None if one is not cached "
+		checked_list = []
+		for dir in dir_list:
+			if dir not in self.dir_map:
+				return None
+			checked_list.append(self.dir_map[dir]['checked'])
+		if not checked_list:
+			return None
+		return time.time() - min(checked_list)
+
+	def save(self):
+		" Write the cache, atomically "
+		cache_dir = os.path.dirname(self.path)
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		tmp_path = self.path + '.tmp'
+		f_cache = open(tmp_path, 'w')
+		# names are byte strings in any encoding, latin-1 keeps every byte
+		f_cache.write(json.dumps(self.dir_map, encoding='latin-1'))
+		f_cache.close()
+		os.rename(tmp_path, self.path)
+
+	def _load(self):
+		try:
+			f_cache = open(self.path)
+			try:
+				dir_map = json.loads(f_cache.read())
+			finally:
+				f_cache.close()
+		except (IOError, ValueError):
+			return
+		for dir, entry in dir_map.items():
+			self.dir_map[dir.encode('latin-1')] = {
+				'mtime': entry['mtime'].encode('latin-1'),
+				'checked': entry['checked'],
+				'albums': [album.encode('latin-1') for album in entry['albums']],
+			}
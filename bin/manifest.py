@@ -0,0 +1,173 @@
+"""
+ Remote tree manifests for Music Mover.
+
+ A manifest lists every directory and file below a remote album, with sizes
+ and mtimes, fetched in one exchange so a transfer can be planned without a
+ stat round trip per entry.
+"""
+
+import posixpath
+from stat import S_ISDIR
+
+
+def shell_quote(arg):
+	" Quote an argument for the remote shell "
+	return "'" + arg.replace("'", "'\\''") + "'"
+
+
+def read_nul_records(stream, bufsize=32768):
+	" Yield NUL terminated records from a file like object as they arrive "
+	pending = ''
+	while(True):
+		data = stream.read(bufsize)
+		if not data:
+			break
+		pending += data
+		record_list = pending.split('\0')
+		pending = record_list.pop()
+		for record in record_list:
+			yield record
+	if pending:
+		yield pending
+
+
+class ManifestEntry(object):
+	" A directory or file in a manifest, path is relative to the manifest root "
+
+	DIR = 'd'
+	FILE = 'f'
+
+	def __init__(self, path, type, size, mtime):
+		self.path = path
+		self.type = type
+		self.size = size
+		self.mtime = mtime
+
+	def is_dir(self):
+		return self.type == ManifestEntry.DIR
+
+	def depth(self):
+		return self.path.count('/') + 1
+
+	def __repr__(self):
+		return "<ManifestEntry %s %s %d>" % (self.type, self.path, self.size)
+
+
+class ManifestFilter(object):
+	" File filters pushed to the remote side, sizes are in bytes, 0 for no limit "
+
+	def __init__(self, extension_list=None, min_size=0, max_size=0):
+		self.extension_list = [ext.lower().lstrip('.') for ext in extension_list or []
+				if ext.strip()]
+		self.min_size = min_size
+		self.max_size = max_size
+
+	@staticmethod
+	def from_site(remote_site):
+		" Build the filter from a remote site's settings "
+		return ManifestFilter(remote_site.extension_filter.split(','),
+				remote_site.min_file_size * 1024, remote_site.max_file_size * 1024)
+
+	def find_args(self):
+		" find tests selecting the files that pass the filter "
+		arg_list = ['-type', 'f']
+		if self.extension_list:
+			name_list = []
+			for ext in self.extension_list:
+				name_list.append("-iname %s" % (shell_quote('*.' + ext)))
+			arg_list.append("\\( %s \\)" % (" -o ".join(name_list)))
+		if self.min_size:
+			arg_list.extend(['-size', '+%dc' % (self.min_size - 1)])
+		if self.max_size:
+			arg_list.extend(['-size', '-%dc' % (self.max_size + 1)])
+		return " ".join(arg_list)
+
+	def match(self, name, size):
+		" Apply the filter locally, for manifests built without find "
+		if self.extension_list:
+			ext = posixpath.splitext(name)[1].lower().lstrip('.')
+			if ext not in self.extension_list:
+				return False
+		if self.min_size and size < self.min_size:
+			return False
+		if self.max_size and size > self.max_size:
+			return False
+		return True
+
+
+class Manifest(object):
+	" The directories and files below a remote root "
+
+	find_format = '%y\\t%s\\t%T@\\t%P\\0'
+
+	def __init__(self, root, entry_list):
+		self.root = root
+		self.entry_list = entry_list
+
+	def dir_list(self):
+		" Directories, parents before their children "
+		dir_list = [entry for entry in self.entry_list if entry.is_dir()]
+		dir_list.sort(key=lambda entry: entry.path)
+		return dir_list
+
+	def file_list(self):
+		return [entry for entry in self.entry_list if not entry.is_dir()]
+
+	def total_size(self):
+		return sum([entry.size for entry in self.file_list()])
+
+	@staticmethod
+	def find_command(root, max_depth, file_filter):
+		" The remote find command which prints the manifest for root "
+		return "find %s -mindepth 1 -maxdepth %d \\( -type d -o \\( %s \\) \\) -printf '%s'" % (
+				shell_quote(root), max_depth, file_filter.find_args(), Manifest.find_format)
+
+	@staticmethod
+	def parse(root, stream, max_depth):
+		" Build a manifest from the NUL delimited output of find_command "
+		entry_list = []
+		for record in read_nul_records(stream):
+			try:
+				type, size, mtime, path = record.split('\t', 3)
+				entry = ManifestEntry(path, type, int(size), int(float(mtime)))
+			except ValueError:
+				continue
+			if entry.is_dir() and entry.depth() >= max_depth:
+				# beyond the copy depth, nothing is pulled into it
+				continue
+			entry_list.append(entry)
+		return Manifest(root, entry_list)
+
+	@staticmethod
+	def fetch(ssh_client, root, max_depth, file_filter):
+		" Fetch the manifest for root with a single remote find "
+		stdin, stdout, stderr = ssh_client.exec_command(
+				Manifest.find_command(root, max_depth, file_filter))
+		manifest = Manifest.parse(root, stdout, max_depth)
+		if stdout.channel.recv_exit_status() != 0 and not manifest.entry_list:
+			stdout.channel.close()
+			raise IOError("find failed on %s: %s" % (root, stderr.read().strip()))
+		return manifest
+
+	@staticmethod
+	def walk(scp_client, root, max_depth, file_filter):
+		"""
+		Build the manifest with one listdir_attr per directory, for hosts
+		without a GNU find.
+		"""
+		entry_list = []
+		dir_queue = [('', 1)]
+		while dir_queue:
+			rel_dir, depth = dir_queue.pop(0)
+			for attr in scp_client.listdir_attr(posixpath.join(root, rel_dir)):
+				path = posixpath.join(rel_dir, attr.filename)
+				if S_ISDIR(attr.st_mode):
+					if depth < max_depth:
+						entry_list.append(ManifestEntry(path, ManifestEntry.DIR, 0,
+								attr.st_mtime))
+						dir_queue.append((path, depth+1))
+					continue
+				if file_filter.match(attr.filename, attr.st_size):
+					entry_list.append(ManifestEntry(path, ManifestEntry.FILE,
+							attr.st_size, attr.st_mtime))
+		return Manifest(root, entry_list)
@@ -0,0 +1,138 @@
+"""
+ Album name matching for Music Mover.
+"""
+
+import re
+import math
+
+
+year_pattern = re.compile(r'[\(\[]?\b(19|20)\d\d\b[\)\]]?', re.UNICODE)
+disc_pattern = re.compile(r'\b(disc|disk|cd)\s*\d+\b', re.UNICODE)
+punct_pattern = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize(name):
+	"""
+	The key used to compare album names. Case, punctuation, years and disc
+	numbers are dropped, so "Artist - Album (2009)" and "artist_-_album" share
+	a key.
+	"""
+	if not isinstance(name, unicode):
+		name = name.decode('utf-8', 'replace')
+	key = name.lower().replace('&', ' and ')
+	key = year_pattern.sub(' ', key)
+	key = disc_pattern.sub(' ', key)
+	key = " ".join(punct_pattern.sub(' ', key).split())
+	# a name which is only a year, or only punctuation
+	return key or name.lower()
+
+
+def trigrams(key):
+	" The set of three character pieces of a key, padded at the ends "
+	key = "  %s " % (key)
+	return frozenset([key[i:i+3] for i in range(len(key) - 2)])
+
+
+class AlbumMatch(object):
+	" A remote album found locally, confidence is from 0 to 1 "
+
+	EXACT = 'exact'
+	NORMALIZED = 'normalized'
+	FUZZY = 'fuzzy'
+	CONTENT = 'content'
+
+	def __init__(self, album, local, kind, confidence):
+		self.album = album
+		self.local = local
+		self.kind = kind
+		self.confidence = confidence
+
+	def __str__(self):
+		return "%s (%d%%)" % (self.local, self.confidence * 100)
+
+
+class AlbumMatcher(object):
+	"""
+	Match remote album names against the local albums. Exact names are looked
+	up in a set, then the normalized key of the name in a map of local keys.
+	If fuzzy is set (0 to 1) names without a key match are compared to local
+	keys by the similarity of their trigram sets, and matched at or above it.
+	"""
+
+	# confidence of a match on the normalized key
+	normalized_confidence = 0.9
+
+	def __init__(self, local_list, normalized=True, fuzzy=0):
+		self.exact_set = set(local_list)
+		self.normalized = normalized
+		self.fuzzy = fuzzy
+		self.key_map = {}
+		self.gram_map = {}
+		self.key_grams = {}
+		self.gram_rank = {}
+		if not normalized and not fuzzy:
+			return
+		for local in local_list:
+			key = normalize(local)
+			self.key_map.setdefault(key, local)
+		if not fuzzy:
+			return
+		gram_count = {}
+		for key in self.key_map:
+			gram_set = trigrams(key)
+			self.key_grams[key] = gram_set
+			for gram in gram_set:
+				gram_count[gram] = gram_count.get(gram, 0) + 1
+		self.gram_rank = gram_count
+		# only the rarest grams of each key are indexed, see _fuzzy_match
+		for key, gram_set in self.key_grams.iteritems():
+			for gram in self._prefix(gram_set):
+				self.gram_map.setdefault(gram, []).append(key)
+
+	def match(self, album):
+		" Return the AlbumMatch for album, or None if it is not local "
+		if album in self.exact_set:
+			return AlbumMatch(album, album, AlbumMatch.EXACT, 1.0)
+		if not self.key_map:
+			return None
+		key = normalize(album)
+		if self.normalized and key in self.key_map:
+			return AlbumMatch(album, self.key_map[key], AlbumMatch.NORMALIZED,
+					self.normalized_confidence)
+		if self.fuzzy:
+			return self._fuzzy_match(album, key)
+		return None
+
+	def _prefix(self, gram_set):
+		"""
+		Two keys scoring at least fuzzy share at least fuzzy times as many
+		trigrams as either has. With every key's trigrams in the same order,
+		rarest first, they then share one in the first len - shared + 1 of
+		each, so only those are indexed and looked up.
+		"""
+		need = int(math.ceil(self.fuzzy * len(gram_set)))
+		gram_list = sorted(gram_set, key=lambda gram: (self.gram_rank.get(gram, 0), gram))
+		return gram_list[:len(gram_list) - need + 1]
+
+	def _fuzzy_match(self, album, key):
+		gram_set = trigrams(key)
+		candidate_set = set()
+		for gram in self._prefix(gram_set):
+			candidate_set.update(self.gram_map.get(gram, ()))
+
+		best_key, best_score = None, 0
+		min_size, max_size = self.fuzzy * len(gram_set), len(gram_set) / self.fuzzy
+		for candidate in candidate_set:
+			candidate_grams = self.key_grams[candidate]
+			# too short or too long to score fuzzy
+			if not min_size <= len(candidate_grams) <= max_size:
+				continue
+			shared = len(gram_set & candidate_grams)
+			score = float(shared) / (len(gram_set) + len(candidate_grams) - shared)
+			if score > best_score:
+				best_key, best_score = candidate, score
+		if best_key is None or best_score < self.fuzzy:
+			return None
+		# never as sure as a key match
+		return AlbumMatch(album, self.key_map[best_key], AlbumMatch.FUZZY,
+				min(best_score, self.normalized_confidence - 0.01))
@@ -3,7 +3,11 @@
 """
 
 import os
-from stat import ST_MODE, S_ISDIR
+import threading
+
+from index import AlbumIndex
+from walker import AlbumWalker
+from watcher import AlbumWatcher
 
 
 class MusicSite(object):
@@ -29,11 +33,22 @@ class LocalMusic(MusicSite):
 	" a local music site "
 
 	max_recurse = 3
+	# left in an album directory while it is being pulled
+	partial_marker = '.mover-partial'
+	# threads used to walk the music dirs
+	walk_workers = 8
+	# persistent album index, see open_index
+	_index = None
+	# live album watcher, see start_watcher
+	_watcher = None
+	# album refresh running in the background, see start_refresh
+	_refresh = None
 
 	def __init__(self):
 		self._active_save_dir = 0
 		self._album_cache = []
-		self.recurse_count = 0
+		self._album_path_map = {}
+		self._album_path_list = []
 		super(LocalMusic, self).__init__()
 
 	def set_save_dir(self, index):
@@ -46,40 +61,218 @@ class LocalMusic(MusicSite):
 		return self._dir_list[self._active_save_dir]
 
 	def get_album_cache(self):
+		self._apply_watcher_changes()
 		return self._album_cache
 
+	def get_album_paths(self):
+		" Return the local paths of every album "
+		self._apply_watcher_changes()
+		return self._album_path_list
+
+	def get_album_path(self, album):
+		" Return the local path of an album, or None if it is not local "
+		self._apply_watcher_changes()
+		return self._album_path_map.get(album)
+
 	def clear_album_cache(self):
 		self._album_cache = []
+		self._album_path_map = {}
+		self._album_path_list = []
+
+	def open_index(self, path):
+		" Use the album index at path, the cache is filled from it right away "
+		self._index = AlbumIndex(path)
+		self._set_album_cache(self._index.album_list())
+
+	def close_index(self):
+		" Close the album index, it is not part of the saved config "
+		self.wait_refresh()
+		if self._index:
+			self._index.close()
+		self._index = None
 		
+	def start_watcher(self):
+		" Keep the album cache current with inotify, returns False if it is not available "
+		self.stop_watcher()
+		self._watcher = self._new_watcher()
+		return self._watcher is not None
+
+	def is_watching(self):
+		" True while the watcher keeps the album cache current "
+		self._apply_watcher_changes()
+		return self._watcher is not None
+
+	def _new_watcher(self):
+		watcher = AlbumWatcher(self._dir_list, self.max_recurse, self.partial_marker)
+		if not watcher.start():
+			return None
+		return watcher
+
+	def stop_watcher(self):
+		" Stop the album watcher, it is not part of the saved config "
+		self.wait_refresh()
+		if self._watcher:
+			self._watcher.stop()
+		self._watcher = None
+
+	def start_refresh(self, watch=False, done=None):
+		"""
+		Refresh the album cache in a background thread, the albums already
+		cached are used until it finishes. The watcher is started once the
+		refresh is done if watch is set, done is called from the thread with
+		the list of (path, error) for the directories which could not be read.
+		"""
+		self.stop_watcher()
+		refresh = {'watch': watch, 'done': done}
+		refresh['thread'] = threading.Thread(target=self._run_refresh, args=(refresh,))
+		refresh['thread'].setDaemon(True)
+		self._refresh = refresh
+		refresh['thread'].start()
+
+	def wait_refresh(self):
+		" Wait for a background refresh, and take its albums into the cache "
+		if self._refresh:
+			self._refresh['thread'].join()
+			self._apply_refresh()
+
+	def _run_refresh(self, refresh):
+		# the index is only used here until the thread is joined
+		refresh['album_path_list'], error_list = self._scan()
+		if refresh['watch']:
+			refresh['watcher'] = self._new_watcher()
+		if refresh['done']:
+			refresh['done'](error_list)
+
+	def _apply_refresh(self):
+		refresh = self._refresh
+		if not refresh or refresh['thread'].isAlive():
+			return
+		self._refresh = None
+		if 'album_path_list' in refresh:
+			self._set_album_cache(refresh['album_path_list'])
+		if refresh.get('watcher'):
+			self._watcher = refresh['watcher']
+
+	def _apply_watcher_changes(self):
+		self._apply_refresh()
+		if not self._watcher:
+			return
+		change_list = self._watcher.changes()
+		if not self._watcher.is_alive():
+			# keep the cache as it is, refreshed on request from now on
+			self._watcher = None
+		if not change_list:
+			return
+		album_path_set = set(self._album_path_list)
+		for action, path in change_list:
+			if action == 'refresh':
+				self.refresh_album_cache()
+				album_path_set = set(self._album_path_list)
+			elif action == 'add':
+				album_path_set.add(path)
+			elif action == 'remove':
+				for album_path in list(album_path_set):
+					if album_path == path or album_path.startswith(path + os.sep):
+						album_path_set.remove(album_path)
+		self._set_album_cache(sorted(album_path_set))
+
 	def refresh_album_cache(self):
-		" Build the list of albums. "
+		"""
+		Build the list of albums. Returns a list of (path, error) for the
+		directories which could not be read.
+		"""
+		self.wait_refresh()
+		if self._watcher and self._watcher.root_list != self._dir_list:
+			# the music dirs changed
+			self.start_watcher()
+		album_path_list, error_list = self._scan()
+		self._set_album_cache(album_path_list)
+		return error_list
+
+	def _scan(self):
+		" Walk the music dirs, returns the album paths and the read errors "
+		if self._index:
+			error_list = self._index.refresh(self._dir_list, self.max_recurse,
+					self.partial_marker, self.walk_workers)
+			return self._index.album_list(), error_list
+		walker = AlbumWalker(self.max_recurse, self.partial_marker, self.walk_workers)
+		walker.walk(self._dir_list)
+		return walker.album_list(), walker.error_list
+
+	def _set_album_cache(self, album_path_list):
 		self.clear_album_cache()
-		for dir in self._dir_list:
-			album_list = self._search_dir_for_album(dir)
-			self._album_cache.extend(album_list)
-
-	def _search_dir_for_album(self, dir):
-		if self.recurse_count >= LocalMusic.max_recurse:
-			return []
-		dir_list = []
-		try:
-			for album_dir in os.listdir(dir):
-				full_dir = os.path.join(dir, album_dir)
-				if not S_ISDIR(os.stat(full_dir)[ST_MODE]):
-					continue
-				dir_list.append(album_dir)
-				self.recurse_count += 1
-				dir_list.extend(self._search_dir_for_album(full_dir))
-				self.recurse_count -= 1
-			return dir_list
-		except OSError, err:
-			# TODO: log error
-			return []
+		self._album_path_list = list(album_path_list)
+		for album_path in album_path_list:
+			album = os.path.basename(album_path)
+			self._album_cache.append(album)
+			self._album_path_map.setdefault(album, album_path)
 
 
 class RemoteSite(MusicSite):
 	" Model for remote sites "
 
+	# per site settings, defaults are class attributes so that sites loaded
+	# from older configs pick them up
+	transfer_workers = 3
+	window_size = 2097152
+	chunk_size = 32768
+	read_ahead = 64
+	range_channels = 4
+	large_file_size = 16
+	extension_filter = ''
+	min_file_size = 0
+	max_file_size = 0
+	sync_albums = False
+	delta_min_size = 1024
+	delta_block_size = 16384
+	connections = 2
+	keepalive = 30
+	preconnect = False
+	transfer_engine = 'auto'
+	compression = 'off'
+	compression_level = 1
+	rate_limit = 0
+	match_normalized = True
+	fuzzy_match = 0
+	listing_ttl = 10
+	fingerprint_albums = False
+	album_depth = 1
+	verify_transfers = False
+
+	settings = [
+		('transfer_workers', 'Parallel transfers'),
+		('window_size', 'SSH window size (bytes)'),
+		('chunk_size', 'Read request size (bytes)'),
+		('read_ahead', 'Read requests in flight'),
+		('range_channels', 'Channels per large file'),
+		('large_file_size', 'Large file size (MB)'),
+		('extension_filter', 'Only pull extensions (a,b)'),
+		('min_file_size', 'Min file size (KB, 0 none)'),
+		('max_file_size', 'Max file size (KB, 0 none)'),
+		('sync_albums', 'Sync albums already local'),
+		('delta_min_size', 'Delta sync min size (KB)'),
+		('delta_block_size', 'Delta block size (bytes)'),
+		('connections', 'Ssh connections in pool'),
+		('keepalive', 'Keepalive interval (s, 0 off)'),
+		('preconnect', 'Connect in background at start'),
+		('transfer_engine', 'Album transfer (sftp/tar/auto)'),
+		('compression', 'Compression (off/on/auto)'),
+		('compression_level', 'Compression level (1-9)'),
+		('rate_limit', 'Rate limit (KB/s, 0 none)'),
+		('match_normalized', 'Match names ignoring case/years'),
+		('fuzzy_match', 'Fuzzy match min score (%, 0 off)'),
+		('listing_ttl', 'Listing cache TTL (min)'),
+		('fingerprint_albums', 'Find local albums by content'),
+		('album_depth', 'Album depth below dirs (1=dir/album)'),
+		('verify_transfers', 'Verify pulled files by hash'),
+	]
+
+	# names the site's files in the config store
+	store_id = None
+	# the config store reads the block list on first use, see ConfigStore
+	_blocked_album_list = None
+	_block_loader = None
+
 	def __init__(self, name, username, hostname, port):
 		self.hostname = hostname
 		self.port = port
@@ -88,4 +281,29 @@ class RemoteSite(MusicSite):
 		self.blocked_album_list = []
 		super(RemoteSite, self).__init__()
 
+	def _get_blocked_album_list(self):
+		if self._blocked_album_list is None:
+			self._blocked_album_list = []
+			if self._block_loader:
+				self._blocked_album_list = self._block_loader()
+		return self._blocked_album_list
+
+	def _set_blocked_album_list(self, album_list):
+		self._blocked_album_list = album_list
+	blocked_album_list = property(_get_blocked_album_list, _set_blocked_album_list,
+			doc="Albums never pulled from this site")
+
+	def get_settings(self):
+		" Return a list of (name, description, value) for the site settings "
+		return [(name, desc, getattr(self, name)) for name, desc in self.settings]
+
+	def set_setting(self, name, value):
+		" Set a site setting, converted to the type of the current value "
+		current = getattr(self, name)
+		if isinstance(current, bool):
+			value = str(value).lower() in ('1', 'y', 'yes', 'true', 'on')
+		elif current is not None:
+			value = type(current)(value)
+		setattr(self, name, value)
+
 
@@ -7,7 +7,6 @@ Date: 2010-01-08
 
  TODO for version 0.4:
 	- handle blank/of input on action inputs
-	- thread it, so more albums can be queued while some transfer
 	- prompt for accept unknown host key
 	- TBD
 
@@ -16,17 +15,15 @@ Date: 2010-01-08
 	- nicer UI (with status bar)
 	- self tunneling
 	- allow remove remote files
-	- allow push music as well
-	- combine all sites into one listing
 
 """
 
 from view import Menu, Message, Input, Color
 from models import LocalMusic, RemoteSite
-import jsonpickle
+from store import ConfigStore, utf8_bytes
 import sys
-import re
 import socket
+import signal
 import os
 
 
@@ -41,157 +38,868 @@ class Configuration(dict):
 		# set defaults
 		self['local_music']  = LocalMusic()
 		self['sites'] = []
+		# bandwidth limits in KB/s, profiles are dicts of start hour, end hour
+		# and rate, and override the global limit while active
+		self['global_rate_limit'] = 0
+		self['bandwidth_profiles'] = []
 
 		# set values from command line
+		self.config_dir = os.path.expanduser("~/.mediaMover/config")
+		if 'config_dir' in config_args:
+			self.config_dir = config_args['config_dir']
+		self.store = ConfigStore(self.config_dir)
+		# set when the config could not be read, so it is not overwritten
+		self.read_only = False
+		# the jsonpickle config of older versions, migrated to the store
 		self.serial_config_file = os.path.expanduser("~/.mediaMover/conf_json")
 		if 'config_file' in config_args:
 			self.serial_config_file = config_args['config_file']
+		self.stats_log_file = os.path.expanduser("~/.mediaMover/stats.log")
+		if 'stats_log' in config_args:
+			self.stats_log_file = config_args['stats_log']
+		self.album_index_file = os.path.expanduser("~/.mediaMover/album_index.db")
+		if 'album_index' in config_args:
+			self.album_index_file = config_args['album_index']
+		self.fingerprint_index_file = os.path.expanduser("~/.mediaMover/fingerprints.db")
+		if 'fingerprint_index' in config_args:
+			self.fingerprint_index_file = config_args['fingerprint_index']
+		self.listing_cache_dir = os.path.expanduser("~/.mediaMover/listings")
+		if 'listing_cache' in config_args:
+			self.listing_cache_dir = config_args['listing_cache']
+		self.watch_albums = config_args.get('watch', 'yes') not in ('no', 'off')
+		# a fast startup shows the menu at once and refreshes the albums
+		# behind it, a full one refreshes them first
+		self.fast_startup = config_args.get('startup', 'fast') != 'full'
 		if 'color' in config_args:
 			Color.color_on = False
 
 	def load(self):
 		" Load the config "
-		# attempt load
 		try:
-			f_config = open(self.serial_config_file)
-			config = jsonpickle.decode(f_config.read())
-			self.update(config)
-			f_config.close()
-		except (IOError, ValueError):
-			Message.err("No serialized config found, or error reading config.")
+			if self.store.exists():
+				self.update(self.store.load())
+			elif os.path.exists(self.serial_config_file):
+				self._migrate()
+			else:
+				Message.err("No config found, starting with an empty one.")
+				self['local_music'].open_index(self.album_index_file)
+				return
+		except (IOError, ValueError, KeyError), err:
+			Message.err("Error reading config, changes will not be saved: %s" % (err))
+			self.read_only = True
+			self['local_music'].open_index(self.album_index_file)
 			return
 
-		self['local_music'].refresh_album_cache()
+		# answer from the index at once, then rescan what changed
+		self['local_music'].open_index(self.album_index_file)
+		if self.fast_startup:
+			self['local_music'].start_refresh(self.watch_albums, self._report_refresh)
+			return
+		self._report_refresh(self['local_music'].refresh_album_cache())
 		Message.note("Album cache refreshed")
+		if self.watch_albums and self['local_music'].start_watcher():
+			Message.note("Watching local music for new albums")
+
+	def _report_refresh(self, error_list):
+		for path, err in error_list:
+			Message.err("Could not read %s: %s" % (path, err))
+
+	def _migrate(self):
+		" Move the jsonpickle config of older versions into the store "
+		# only needed once, and slow to import, like paramiko
+		import jsonpickle
+		f_config = open(self.serial_config_file)
+		try:
+			config = jsonpickle.decode(f_config.read())
+		finally:
+			f_config.close()
+		# jsonpickle read the names back as unicode, they were utf-8 when written
+		for obj in [config['local_music']] + config['sites']:
+			for name, value in obj.__dict__.items():
+				setattr(obj, name, utf8_bytes(value))
+		for key in config:
+			if key not in ('local_music', 'sites'):
+				config[key] = utf8_bytes(config[key])
+		self.update(config)
+		self.store.save(self)
+		# kept, but never read again
+		os.rename(self.serial_config_file, self.serial_config_file + '.migrated')
+		Message.note("Config moved to %s" % (self.config_dir))
 
 	def save(self):
 		" Save the config "
-		# clear album cache
-		self['local_music'].clear_album_cache()
-		save_dir = os.path.expanduser("~/.mediaMover/")
-		if not os.path.isdir(save_dir):
-			os.mkdir(save_dir)
-		# serialize the configuration
-		f_config = open(self.serial_config_file, "w")
-		json_string = jsonpickle.encode(self)
-		f_config.write(json_string)
-		f_config.close()
+		# the index persists the album cache
+		self['local_music'].close_index()
+		self['local_music'].stop_watcher()
+		if self.read_only:
+			Message.err("Config not saved, it could not be read at start.")
+			return
+		self.store.save(self)
 
 
 
 # imports for connectionManager
-import paramiko
-from paramiko.ssh_exception import SSHException
 from stat import S_ISDIR 
 import os
+import tempfile
+import threading
+import time
+import shutil
+from transfer import TransferQueue, download_file, pull_tar, is_compressible, split_entries
+from transfer import pipelined_write
+from manifest import Manifest, ManifestFilter, ManifestEntry
+from delta import delta_file
+from pool import ConnectionPool
+from scheduler import BandwidthScheduler
+from stats import StatsCollector
+from matcher import AlbumMatcher, AlbumMatch
+from listing import ListingCache, listing_command, parse_listing, walk_listing
+from listing import mtime_command, parse_mtimes, album_entry
+from catalog import Catalog
+from browser import AlbumBrowser
+from fingerprint import FingerprintIndex, HashStore, remote_fingerprints
+from verify import RemoteHashes
+from sync import SyncRule, SyncReport
+import sync
+
+# paramiko takes longer to import than the rest of the program takes to
+# start, so it is imported on the first connection, see load_paramiko
+paramiko = None
+
+class SSHException(Exception):
+	" Stands in for paramiko's SSHException, which nothing raises before it is imported "
+
+def load_paramiko():
+	" Import paramiko, a no-op once it has been "
+	global paramiko, SSHException
+	import paramiko
+	from paramiko.ssh_exception import SSHException
+
 class ConnectionManager(object):
 	" Manage a connection to an ssh server "
 	
-	dir_pattern = re.compile('/\w+')
 	max_recurse = 3
+	# albums are pushed into a hidden dir named .<album><push_suffix>, then
+	# renamed into place
+	push_suffix = '.mover-push'
+	# the auto transfer engine uses tar for albums with this many small files
+	tar_small_size = 1024 * 1024
+	tar_min_small_files = 16
 
-	def __init__(self, remote_site, local_music):
+	def __init__(self, remote_site, local_music, interactive=True, scheduler=None,
+				stats=None, listing_dir=None, hash_db=None):
+		load_paramiko()
 		self.remote_site = remote_site
 		self.password = None
-		self.ssh_client = None
-		self.scp_client = None
-		self.connect()
 		self.local_music = local_music
-		self.recurse_count = 0
+		self.scheduler = scheduler
+		self.stats = stats
+		self.listing_cache = None
+		if listing_dir:
+			self.listing_cache = ListingCache(ListingCache.site_path(listing_dir, remote_site))
+		# per worker thread state for the job being pulled
+		self.job_state = threading.local()
+		self.transfer_queue = None
+		self._scp_client = None
+		# verified hashes are stored in hash_db, opened on first use
+		self.hash_db = hash_db
+		self.hash_store = None
+		self.hash_lock = threading.Lock()
+		self.pool = ConnectionPool(self._new_client, remote_site.connections,
+				remote_site.keepalive)
+		self.connect(interactive)
 
-	def connect(self):
-		" connect to the host "
-		# ssh
+	def connect(self, interactive=True):
+		" connect to the host, then open the rest of the pool in the background "
+		self.pool.get_client(interactive)
+		self.pool.warm()
+
+	def _new_client(self, interactive):
+		" open a new authenticated ssh client, prompting for a password if allowed "
 		ssh_client = paramiko.SSHClient()
 		ssh_client.load_system_host_keys()
 		try:
 			ssh_client.connect(self.remote_site.hostname, self.remote_site.port,
 						self.remote_site.username, self.password)
 		except SSHException, err:
-			if self.password:
-				raise SSHException("Password authentication failed: %s" % (err))
+			if self.password or not interactive:
+				raise SSHException("Authentication failed: %s" % (err))
 			Message.err("Connect failed: %s" % (err))
 			self.password = Input.prompt_pass()	
-			self.connect()
+			return self._new_client(interactive)
+
+		# channels opened from now on use the site's window size
+		ssh_client.get_transport().window_size = self.remote_site.window_size
+		return ssh_client
+
+	def _get_ssh_client(self):
+		return self.pool.get_client()
+	ssh_client = property(_get_ssh_client,
+			doc="A healthy ssh client from the pool, reconnected if it went stale")
 
-		if self.ssh_client == None:
-			self.ssh_client = ssh_client
-		if self.scp_client == None:
-			transport = ssh_client.get_transport()
-			self.scp_client = paramiko.SFTPClient.from_transport(transport)
+	def _get_scp_client(self):
+		if self._scp_client is None or self._scp_client.sock.closed:
+			self._scp_client = self.open_sftp()
+		return self._scp_client
+	scp_client = property(_get_scp_client, doc="The sftp channel used by the menu")
 
+	def open_sftp(self):
+		" open a new sftp channel on a connection from the pool "
+		return self.pool.open_sftp()
 		
 	def disconnect(self):
 		" disconnect from the host "
-		if self.ssh_client:
-			self.ssh_client.close()
-		if self.scp_client:
-			self.scp_client.close()
-
-	def get_album_list(self):
-		stdin, stdout, stderr = self.ssh_client.exec_command("ls -1 %s" % (
-						" ".join(self.remote_site.get_dir_list())))
-		error_list = map(lambda s: s.rstrip(), stderr.readlines())
-		album_map = self._parse_album_list(stdout)
-		return album_map, error_list
-
-	def pull_album(self, path, file):
-		" Pull an album over the local using sftp "
+		if self.transfer_queue:
+			self.transfer_queue.stop()
+			self.transfer_queue = None
+		if self._scp_client:
+			self._scp_client.close()
+			self._scp_client = None
+		if self.hash_store:
+			self.hash_store.close()
+			self.hash_store = None
+		self.pool.close()
+
+	def get_album_list(self, force=False):
+		"""
+		Return a map of album to remote dir, and a list of errors. Dirs listed
+		within the site's listing ttl come from the listing cache, after that
+		the dir mtimes are checked and only changed dirs are listed again.
+		force lists every dir.
+		"""
+		dir_list = self.remote_site.get_dir_list()
+		if self.listing_cache is None:
+			path_map, error_list = self._list_albums(dir_list)
+			return self._album_map(dir_list, path_map), error_list
+		age = self.listing_cache.age(dir_list)
+		if not force and age is not None and age < self.remote_site.listing_ttl * 60:
+			return self._album_map(dir_list, {}), []
+
+		mtime_map = self._dir_mtimes(dir_list)
+		stale_list = []
+		for dir in dir_list:
+			cached = self.listing_cache.get(dir)
+			if force or not cached or cached[0] != mtime_map.get(dir):
+				stale_list.append(dir)
+			else:
+				self.listing_cache.touch(dir)
+		fresh_map = {}
+		error_list = []
+		if stale_list:
+			fresh_map, error_list = self._list_albums(stale_list)
+			for dir in stale_list:
+				# a dir which could not be checked is listed again next time
+				if dir in mtime_map:
+					self.listing_cache.put(dir, mtime_map[dir], fresh_map[dir])
+		self.listing_cache.save()
+		return self._album_map(dir_list, fresh_map), error_list
+
+	def _album_map(self, dir_list, path_map):
+		" The map of album to remote parent dir of dir_list, from path_map or else the listing cache "
+		album_map = {}
+		for dir in dir_list:
+			if dir in path_map:
+				path_list = path_map[dir]
+			else:
+				path_list = self.listing_cache.get(dir)[1]
+			for path in path_list:
+				album, parent = album_entry(dir, path)
+				album_map[album] = parent
+		return album_map
+
+	def iter_albums(self, dir_list, error_list):
+		"""
+		Yield (dir, path) for each album below the remote dirs in dir_list as
+		the listing arrives, path is relative to dir. Errors are added to
+		error_list once the listing is done. Only the parse is incremental, the
+		album menu collects every album before it is shown.
+		"""
+		depth = max(1, self.remote_site.album_depth)
+		stdin, stdout, stderr = self.ssh_client.exec_command(listing_command(dir_list, depth))
+		listed = False
+		for entry in parse_listing(stdout, depth):
+			listed = True
+			yield entry
+		message_list = [line.rstrip() for line in stderr.readlines()]
+		if listed or stdout.channel.recv_exit_status() == 0:
+			error_list.extend(message_list)
+			return
+		# no GNU find on the remote, list each directory instead
+		for dir in dir_list:
+			try:
+				for entry in walk_listing(self.scp_client, dir, depth):
+					yield entry
+			except IOError, err:
+				error_list.append("%s: %s" % (dir, err))
+
+	def _list_albums(self, dir_list):
+		"""
+		Return a map of remote dir to the album paths below it, and a list of
+		errors. The whole listing is kept, the listing cache, blocks, sorting
+		and local matching need every album.
+		"""
+		path_map = {}
+		for dir in dir_list:
+			path_map[dir] = []
+		error_list = []
+		for dir, path in self.iter_albums(dir_list, error_list):
+			path_map.setdefault(dir, []).append(path)
+		return path_map, error_list
+
+	def get_fingerprints(self, album_path_list):
+		" Return a map of remote album path to the fingerprints of its files "
+		return remote_fingerprints(self.ssh_client, album_path_list)
+
+	def _dir_mtimes(self, dir_list):
+		" Return a map of remote dir to the latest mtime above its albums, using one find "
+		stdin, stdout, stderr = self.ssh_client.exec_command(
+				mtime_command(dir_list, max(1, self.remote_site.album_depth)))
+		return parse_mtimes(stdout)
+
+	def queue_album(self, path, file, urgent=False, helper_list=None):
+		"""
+		Queue an album to be pulled in the background, urgent albums go first.
+		helper_list is (conn_manager, path) of other sites with the album, they
+		pull a share of its files.
+		"""
+		if self.transfer_queue is None:
+			self.transfer_queue = TransferQueue(self, self.remote_site.transfer_workers)
+		# the album cache is only read on this thread, not by the workers
+		return self.transfer_queue.put(path, file, urgent, helper_list, self.album_dest(file))
+
+	def queue_push(self, local_path, remote_dir, urgent=False):
+		" Queue a local album to be pushed into remote_dir in the background "
+		if self.transfer_queue is None:
+			self.transfer_queue = TransferQueue(self, self.remote_site.transfer_workers)
+		return self.transfer_queue.put_push(local_path, remote_dir, urgent)
+
+	def pending_transfers(self):
+		" Return the number of albums queued or transferring "
+		if self.transfer_queue is None:
+			return 0
+		return self.transfer_queue.pending()
+
+	def wait_for_transfers(self):
+		" Block until all queued albums have been pulled "
+		if self.transfer_queue:
+			self.transfer_queue.wait()
+
+	def get_throttle(self):
+		"""
+		Return the function transfers for the job on this thread call with
+		their byte counts, it records them and applies the bandwidth limits.
+		"""
+		urgent = getattr(self.job_state, 'urgent', False)
+		album_stats = getattr(self.job_state, 'album_stats', None)
+		def throttle(amount):
+			if album_stats:
+				self.stats.add_bytes(album_stats, amount)
+			if self.scheduler:
+				self.scheduler.consume(self.remote_site, amount, urgent)
+		return throttle
+
+	def album_dest(self, file):
+		" The local path an album is pulled into, from the album cache "
+		if self.remote_site.sync_albums and self.local_music.get_album_path(file):
+			# sync into the existing copy
+			return self.local_music.get_album_path(file)
+		return self.local_music.get_save_dir().rstrip("/") + "/" + file
+
+	def pull_album(self, path, file, scp_client=None, urgent=False, helper_list=None,
+				dest=None):
+		"""
+		Pull an album over the local using sftp, returns True on success. dest
+		is the local path from album_dest, looked up here if not given.
+		"""
+		if scp_client is None:
+			scp_client = self.scp_client
+		if dest is None:
+			dest = self.album_dest(file)
+		self.job_state.urgent = urgent
+		self.job_state.album_stats = None
+		if self.stats:
+			self.job_state.album_stats = self.stats.start_album(self.remote_site.name, file)
+		success = False
+		try:
+			success = self._pull_album(path, file, dest, scp_client, helper_list)
+		finally:
+			if self.job_state.album_stats:
+				self.job_state.album_stats.finish(not success)
+			self.job_state.album_stats = None
+		return success
+
+	def _album_size(self, total_bytes):
+		" record the size of the album being pulled on this thread "
+		if getattr(self.job_state, 'album_stats', None):
+			self.job_state.album_stats.total_bytes = total_bytes
+
+	def _file_done(self, start):
+		" record the time taken by a file pulled on this thread "
+		if getattr(self.job_state, 'album_stats', None):
+			self.stats.add_file(self.job_state.album_stats, time.time() - start)
+
+	def pull_entries(self, remote_dir, dest, entry_list, file, urgent=False):
+		"""
+		Pull files of an album being pulled from another site, from this site's
+		copy in remote_dir. Returns the entries which failed, or which differ
+		in size here.
+		"""
+		self.job_state.urgent = urgent
+		self.job_state.album_stats = None
+		if self.stats:
+			self.job_state.album_stats = self.stats.start_album(self.remote_site.name, file)
+		self._album_size(sum([entry.size for entry in entry_list]))
+		failed_list = []
+		scp_client = None
+		try:
+			scp_client = self.open_sftp()
+			for entry in entry_list:
+				remote_path = "%s/%s" % (remote_dir.rstrip('/'), entry.path)
+				try:
+					if scp_client.stat(remote_path).st_size != entry.size:
+						failed_list.append(entry)
+						continue
+					self._get_file(scp_client, remote_path, os.path.join(dest, entry.path),
+							entry.size, entry.mtime)
+				except (IOError, OSError, SSHException), err:
+					failed_list.append(entry)
+		except (IOError, OSError, SSHException), err:
+			Message.err("Failed to open %s: %s" % (self.remote_site.name, err))
+			failed_list = entry_list
+		if scp_client:
+			scp_client.close()
+		if self.job_state.album_stats:
+			self.job_state.album_stats.finish(len(failed_list) == len(entry_list))
+		self.job_state.album_stats = None
+		return failed_list
+
+	def _pull_album(self, path, file, dest, scp_client, helper_list=None):
 		target = path+file
-		dest = self.local_music.get_save_dir().rstrip("/") + "/" + file
 		# Check if target is a directory
 		try:
-			if S_ISDIR(self.scp_client.stat(target).st_mode):
-				self._copy_dir(target, dest)
-			else:
+			stat = scp_client.stat(target)
+			if not S_ISDIR(stat.st_mode):
 				# copy single file
-				self.scp_client.get(target, dest)
-		except (IOError, OSError), err:
+				self._album_size(stat.st_size)
+				if self._compress(file) and self._file_action(dest, stat.st_size,
+						stat.st_mtime) == 'pull':
+					self._pull_compressed(path, os.path.dirname(dest), [ManifestEntry(
+							file, ManifestEntry.FILE, stat.st_size, stat.st_mtime)])
+					return True
+				self._get_file(scp_client, target, dest, stat.st_size, stat.st_mtime)
+				return True
+		except (IOError, OSError, SSHException), err:
 			Message.err("Failed to move file %s: %s" % (file, err))
+			return False
 
+		# the marker keeps a partly pulled album out of the local album cache
+		# until every file is in place
+		marker = os.path.join(dest, LocalMusic.partial_marker)
+		try:
+			self._make_dir(dest)
+			open(marker, 'w').close()
+		except (IOError, OSError), err:
+			Message.err("Failed to create dir %s: %s" % (dest, err))
+			return False
+		helper_list = [(helper, helper_path + file) for helper, helper_path in helper_list or []]
+		if not self._copy_dir(scp_client, target, dest, helper_list=helper_list):
+			return False
+		os.remove(marker)
+		return True
+
+
+	def _make_dir(self, dest):
+		" mkdir on local, an existing directory is left from an earlier attempt "
+		if not os.path.isdir(dest):
+			os.mkdir(dest)
+
+	def get_manifest(self, remote_dir, scp_client=None):
+		" Fetch the manifest of a remote album, filtered by the site settings "
+		file_filter = ManifestFilter.from_site(self.remote_site)
+		try:
+			return Manifest.fetch(self.ssh_client, remote_dir, self.max_recurse, file_filter)
+		except (IOError, SSHException):
+			# no GNU find on the remote, list each directory instead
+			if scp_client is None:
+				scp_client = self.scp_client
+			return Manifest.walk(scp_client, remote_dir, self.max_recurse, file_filter)
+
+	def _copy_dir(self, scp_client, remote_dir, dest, engine=None, helper_list=None):
+		"""
+		copy a directory to local, skipping files already complete. helper_list
+		is (conn_manager, remote dir) of other sites with the same directory,
+		which pull a share of the files weighted by their throughput
+		"""
+		try:
+			manifest = self.get_manifest(remote_dir, scp_client)
+		except (IOError, OSError, SSHException), err:
+			Message.err("Failed to list %s: %s" % (remote_dir, err))
+			return False
 
-	def _copy_dir(self, remote_dir, dest):
-		" copy a directory to local "
-		if self.recurse_count >= self.max_recurse:
+		entry = None
+		helper_thread_list = []
+		helper_failed_list = []
+		remote_hashes = None
+		try:
+			for entry in manifest.dir_list():
+				self._make_dir(os.path.join(dest, entry.path))
+			self._album_size(manifest.total_size())
+			file_list = manifest.file_list()
+			pull_list = [item for item in file_list if self._file_action(
+					os.path.join(dest, item.path), item.size, item.mtime) == 'pull']
+			def pull_share(helper, helper_dir, share, urgent):
+				try:
+					failed_list = helper.pull_entries(helper_dir, dest, share,
+							os.path.basename(dest), urgent)
+				except Exception, err:
+					Message.err("Failed to pull from %s: %s" % (helper.remote_site.name, err))
+					failed_list = share
+				helper_failed_list.extend(failed_list)
+			if helper_list and pull_list:
+				share_list = split_entries(pull_list, self._source_weights(helper_list))
+				pull_list = share_list[0]
+				for (helper, helper_dir), share in zip(helper_list, share_list[1:]):
+					if not share:
+						continue
+					share_set = set(share)
+					file_list = [item for item in file_list if item not in share_set]
+					thread = threading.Thread(target=pull_share, args=(helper, helper_dir,
+							share, getattr(self.job_state, 'urgent', False)))
+					thread.setDaemon(True)
+					thread.start()
+					helper_thread_list.append(thread)
+			# the remote hashes are computed while the files are pulled, and
+			# the pulled files are hashed as they arrive
+			if self.remote_site.verify_transfers and pull_list:
+				remote_hashes = RemoteHashes(self.ssh_client, [self._remote_path(remote_dir,
+						item) for item in pull_list])
+				self.job_state.hash_map = {}
+			zip_list = [item for item in pull_list if self._compress(item.path)]
+			if zip_list:
+				self._pull_compressed(remote_dir, dest, zip_list)
+			tar_list = []
+			if self._use_tar(file_list, engine):
+				tar_list = [item for item in pull_list if item not in zip_list]
+				if tar_list:
+					pull_tar(self.ssh_client, remote_dir, dest, tar_list,
+							throttle=self.get_throttle(), file_done=self._file_done,
+							hash_done=self._hash_done(dest))
+			# files to skip or delta sync are left to _get_file
+			file_list = [item for item in file_list
+					if item not in zip_list and item not in tar_list]
+			for entry in file_list:
+				self._get_file(scp_client, self._remote_path(remote_dir, entry),
+						os.path.join(dest, entry.path), entry.size, entry.mtime)
+			# files the other sites could not pull are pulled from here
+			for thread in helper_thread_list:
+				thread.join()
+			for entry in helper_failed_list:
+				self._get_file(scp_client, self._remote_path(remote_dir, entry),
+						os.path.join(dest, entry.path), entry.size, entry.mtime)
+			if remote_hashes:
+				entry = None
+				self._verify(remote_hashes, scp_client, remote_dir, dest, pull_list)
+		except (IOError, OSError, SSHException), err:
+			Message.err("Failed to move file(s) %s: %s" % (entry and entry.path or remote_dir, err))
+			return False
+		finally:
+			# helpers write into dest, they finish before the album does
+			for thread in helper_thread_list:
+				thread.join()
+			if remote_hashes:
+				remote_hashes.close()
+			self.job_state.hash_map = None
+		return True
+
+	def _remote_path(self, remote_dir, entry):
+		return "%s/%s" % (remote_dir, entry.path)
+
+	def _hash_done(self, dest):
+		" The hash_done of pull_tar for the album pulled into dest on this thread, None unless verifying "
+		hash_map = getattr(self.job_state, 'hash_map', None)
+		if hash_map is None:
+			return None
+		def hash_done(path, content_hash):
+			hash_map[os.path.join(dest, path)] = content_hash
+		return hash_done
+
+	def _verify(self, remote_hashes, scp_client, remote_dir, dest, entry_list):
+		"""
+		Compare the hashes of the files pulled from remote_dir into dest with
+		the remote hashes, and pull the files which differ once more, or copy
+		them from a verified local file with the same content. Raises IOError,
+		removing them, for files which still differ. The verified hashes are
+		stored for finding those duplicates.
+		"""
+		hash_map = self.job_state.hash_map
+		try:
+			remote_map = remote_hashes.wait()
+		except (IOError, SSHException), err:
+			Message.err("Could not verify %s: %s" % (os.path.basename(dest), err))
 			return
+		verified_list = []
+		retry_list = []
+		for attempt in range(2):
+			if retry_list:
+				for entry in retry_list:
+					Message.err("%s does not match the remote file, pulling it again." % (
+							entry.path))
+					local_path = os.path.join(dest, entry.path)
+					os.remove(local_path)
+					del hash_map[local_path]
+					size, content_hash = remote_map[self._remote_path(remote_dir, entry)]
+					if self._copy_verified(local_path, size, content_hash, entry.mtime):
+						hash_map[local_path] = content_hash
+						continue
+					self._get_file(scp_client, self._remote_path(remote_dir, entry), local_path,
+							size, entry.mtime)
+				entry_list = retry_list
+			retry_list = []
+			for entry in entry_list:
+				local_path = os.path.join(dest, entry.path)
+				remote = remote_map.get(self._remote_path(remote_dir, entry))
+				# files skipped as complete, or not hashed on both sides, are not verified
+				if local_path not in hash_map or remote is None:
+					continue
+				if hash_map[local_path] == remote[1]:
+					verified_list.append((local_path, remote[1]))
+				else:
+					retry_list.append(entry)
+			if not retry_list:
+				break
+		if verified_list and self.hash_db:
+			self._get_hash_store().add(verified_list)
+		if retry_list:
+			for entry in retry_list:
+				os.remove(os.path.join(dest, entry.path))
+			raise IOError("%d file(s) do not match the remote files: %s" % (len(retry_list),
+					", ".join([entry.path for entry in retry_list])))
+
+	def _copy_verified(self, local_path, size, content_hash, mtime):
+		" Copy a verified local file with the content to local_path, returns False if there is none "
+		if not self.hash_db:
+			return False
+		for path in self._get_hash_store().find(size, content_hash):
+			if path == local_path:
+				continue
+			try:
+				shutil.copyfile(path, local_path)
+				os.utime(local_path, (mtime, mtime))
+			except (IOError, OSError):
+				continue
+			Message.note("Copied %s from the verified file %s." % (os.path.basename(local_path),
+					path))
+			self._get_hash_store().add([(local_path, content_hash)])
+			return True
+		return False
+
+	def _get_hash_store(self):
+		self.hash_lock.acquire()
 		try:
-			# mkdir on local
-			os.mkdir(dest)
-		except OSError, err:
-			Message.err("Failed to create dir %s: %s" % (dest, err))
+			if self.hash_store is None:
+				self.hash_store = HashStore(self.hash_db)
+			return self.hash_store
+		finally:
+			self.hash_lock.release()
+
+	def _source_weights(self, helper_list):
+		" The throughput of this site then each helper, equal if unmeasured "
+		if not self.stats:
+			return [1.0] * (len(helper_list) + 1)
+		return self.stats.site_rates([self.remote_site.name] +
+				[helper.remote_site.name for helper, helper_dir in helper_list])
+
+	def _use_tar(self, file_list, engine=None):
+		" True if the files should be pulled as a tar stream rather than over sftp "
+		if engine is None:
+			engine = self.remote_site.transfer_engine
+		if engine == 'auto':
+			small_list = [entry for entry in file_list if entry.size < self.tar_small_size]
+			return len(small_list) >= self.tar_min_small_files
+		return engine == 'tar'
+
+	def _compress(self, name):
+		" True if the file should be sent compressed "
+		compression = self.remote_site.compression
+		if compression == 'auto':
+			return is_compressible(name)
+		return compression == 'on'
+
+	def _pull_compressed(self, remote_dir, dest, entry_list):
+		" pull files as a gzipped tar stream and report what compression saved "
+		stats = pull_tar(self.ssh_client, remote_dir, dest, entry_list,
+				self.remote_site.compression_level, self.get_throttle(), self._file_done,
+				self._hash_done(dest))
+		Message.note("Compressed %d file(s) from %s: %s" % (len(entry_list),
+				os.path.basename(remote_dir.rstrip('/')), stats))
+		return stats
+
+	def _file_action(self, dest, size, mtime):
+		" decide how to bring a local file up to date: skip, delta or pull "
+		site = self.remote_site
+		if not os.path.isfile(dest):
+			return 'pull'
+		stat = os.stat(dest)
+		if stat.st_size == size and (not site.sync_albums or int(stat.st_mtime) == mtime):
+			# completed by an earlier attempt, or unchanged
+			return 'skip'
+		if site.sync_albums and size >= site.delta_min_size * 1024:
+			return 'delta'
+		return 'pull'
+
+	def _get_file(self, scp_client, remote_path, dest, size, mtime):
+		" copy a single file, large files are split across channels "
+		site = self.remote_site
+		action = self._file_action(dest, size, mtime)
+		if action == 'skip':
 			return
+		start = time.time()
+		if action == 'delta':
+			try:
+				literal_bytes = delta_file(self.ssh_client, remote_path, dest, mtime,
+						site.delta_block_size, self.get_throttle())
+				Message.note("Synced %s, %d KB changed." % (
+						os.path.basename(dest), literal_bytes / 1024))
+				self._file_done(start)
+				return
+			except (IOError, SSHException), err:
+				Message.err("%s, pulling the whole file." % (err))
+		parts = 1
+		if size >= site.large_file_size * 1024 * 1024:
+			parts = site.range_channels
+		hash_map = getattr(self.job_state, 'hash_map', None)
+		content_hash = download_file(self, scp_client, remote_path, dest, size, mtime, parts,
+				verify=(hash_map is not None))
+		if content_hash:
+			hash_map[dest] = content_hash
+		self._file_done(start)
 
+	def push_album(self, local_path, remote_dir, scp_client=None, urgent=False):
+		" Push a local album into remote_dir using sftp, returns True on success "
+		if scp_client is None:
+			scp_client = self.scp_client
+		album = os.path.basename(local_path.rstrip('/'))
+		self.job_state.urgent = urgent
+		self.job_state.album_stats = None
+		if self.stats:
+			self.job_state.album_stats = self.stats.start_album(self.remote_site.name, album)
+		success = False
 		try:
-			# loop through all files
-			for sub_file in self.scp_client.listdir(path=remote_dir):
-				path_sub_file = "%s/%s" % (remote_dir, sub_file)
-				if S_ISDIR(self.scp_client.stat(path_sub_file).st_mode):
-					# recurse into directories
-					self.recurse_count += 1
-					self._copy_dir(path_sub_file, "%s/%s" % (dest, sub_file))
-					self.recurse_count -= 1
+			success = self._push_album(local_path.rstrip('/'), remote_dir.rstrip('/'), album,
+					scp_client)
+		finally:
+			if self.job_state.album_stats:
+				self.job_state.album_stats.finish(not success)
+			self.job_state.album_stats = None
+		return success
+
+	def _push_album(self, local_path, remote_dir, album, scp_client):
+		"""
+		Files go into a hidden dir, each under a .part name renamed when it is
+		whole, and the dir is renamed to the album once every file is there.
+		A push which failed part way is resumed from the files it finished.
+		"""
+		target = "%s/%s" % (remote_dir, album)
+		tmp_dir = "%s/.%s%s" % (remote_dir, album, self.push_suffix)
+		try:
+			scp_client.stat(target)
+			Message.err("%s is already on %s." % (album, self.remote_site.name))
+			return False
+		except IOError:
+			pass
+
+		dir_list = []
+		file_list = []
+		for dir, sub_dir_list, name_list in os.walk(local_path):
+			rel_dir = dir[len(local_path):].lstrip(os.sep)
+			if rel_dir:
+				dir_list.append(rel_dir)
+			for name in name_list:
+				if name == self.local_music.partial_marker:
 					continue
+				rel_path = os.path.join(rel_dir, name)
+				file_list.append((rel_path, os.stat(os.path.join(local_path, rel_path))))
+		self._album_size(sum([stat.st_size for rel_path, stat in file_list]))
 
-				# copy the file then
-				self.scp_client.get(path_sub_file, "%s/%s" % (dest, sub_file))
-		except (IOError, OSError), err:
-			Message.err("Failed to move file(s) %s: %s" % (sub_file, err))
+		try:
+			self._remote_mkdir(scp_client, tmp_dir)
+			for rel_dir in dir_list:
+				self._remote_mkdir(scp_client, "%s/%s" % (tmp_dir, rel_dir.replace(os.sep, '/')))
+			for rel_path, stat in file_list:
+				self._put_file(scp_client, os.path.join(local_path, rel_path),
+						"%s/%s" % (tmp_dir, rel_path.replace(os.sep, '/')), stat)
+			scp_client.rename(tmp_dir, target)
+		except (IOError, OSError, SSHException), err:
+			Message.err("Failed to push %s: %s" % (album, err))
+			return False
+		return True
 
+	def _remote_mkdir(self, scp_client, path):
+		" make a remote dir, unless it is left from an earlier push "
+		try:
+			scp_client.mkdir(path)
+		except IOError:
+			if not S_ISDIR(scp_client.stat(path).st_mode):
+				raise
+
+	def _put_file(self, scp_client, local_path, remote_path, stat):
+		" copy a single file to remote_path, through a .part file "
+		try:
+			remote_stat = scp_client.stat(remote_path)
+			if remote_stat.st_size == stat.st_size:
+				# pushed by an earlier attempt
+				return
+			scp_client.remove(remote_path)
+		except IOError:
+			pass
+		start = time.time()
+		part_path = remote_path + '.part'
+		pipelined_write(scp_client, local_path, part_path, self.remote_site.chunk_size,
+				self.get_throttle())
+		scp_client.utime(part_path, (stat.st_atime, stat.st_mtime))
+		scp_client.rename(part_path, remote_path)
+		self._file_done(start)
+
+	def benchmark_album(self, remote_dir):
+		"""
+		Pull remote_dir with the sftp and the tar engines, returns a tuple of
+		(size, file count, sftp seconds, tar seconds).
+		"""
+		manifest = self.get_manifest(remote_dir)
+		bench_dir = tempfile.mkdtemp(prefix="mover-bench-")
+		time_list = []
+		try:
+			for engine in ('sftp', 'tar'):
+				dest = os.path.join(bench_dir, engine)
+				os.mkdir(dest)
+				start = time.time()
+				if not self._copy_dir(self.scp_client, remote_dir, dest, engine):
+					raise IOError("%s pull of %s failed" % (engine, remote_dir))
+				time_list.append(time.time() - start)
+		finally:
+			shutil.rmtree(bench_dir, ignore_errors=True)
+		return manifest.total_size(), len(manifest.file_list()), time_list[0], time_list[1]
+
+	def benchmark_download(self, remote_path):
+		"""
+		Download remote_path with sftp get and with the large file path, returns
+		a tuple of (size, get seconds, large file seconds).
+		"""
+		stat = self.scp_client.stat(remote_path)
+		bench_dir = tempfile.mkdtemp(prefix="mover-bench-")
+		try:
+			start = time.time()
+			self.scp_client.get(remote_path, os.path.join(bench_dir, "get"))
+			get_time = time.time() - start
+			start = time.time()
+			download_file(self, self.scp_client, remote_path,
+					os.path.join(bench_dir, "large"), stat.st_size, stat.st_mtime,
+					self.remote_site.range_channels)
+			range_time = time.time() - start
+		finally:
+			shutil.rmtree(bench_dir, ignore_errors=True)
+		return stat.st_size, get_time, range_time
 
-	def _parse_album_list(self, stdout):
-		" Parse the directory listing into a map "
-		active_dir = self.remote_site.get_dir_list()[0]
-		album_map = {} 
-		for line in stdout:
-			line = line.rstrip()
-			if len(line) < 1:
-				continue
-			if self.dir_pattern.match(line):
-				active_dir = line.rstrip(':')
-				continue
-			album_map[line] = active_dir
-		return album_map
-			
 
 class MoverController(object):
 	" Controller class for the application "
@@ -200,9 +908,52 @@ class MoverController(object):
 		self.config = Configuration(**args)
 		self.config.load()
 		self.connection_map = {}
+		self.preconnect_map = {}
+		self.scheduler = BandwidthScheduler(self.config)
+		self.stats = StatsCollector()
+		self.stats.load_history(self.config.stats_log_file)
+		self.fingerprint_index = None
+		Menu.status_source = self.stats.status_line
+		self._preconnect()
+
+	def _preconnect(self, site_list=None):
+		"""
+		Connect to sites in the background, without prompting, by default those
+		flagged for it. _connect waits for these before connecting itself.
+		"""
+		def connect(remote_site):
+			try:
+				self.connection_map[remote_site] = ConnectionManager(remote_site,
+						self.config['local_music'], interactive=False, scheduler=self.scheduler,
+						stats=self.stats, listing_dir=self.config.listing_cache_dir,
+						hash_db=self.config.fingerprint_index_file)
+			except (SSHException, socket.error), err:
+				# connect again, interactively, when the site is used
+				pass
+		if site_list is None:
+			site_list = [remote_site for remote_site in self.config['sites']
+					if remote_site.preconnect]
+		for remote_site in site_list:
+			if remote_site in self.connection_map or remote_site in self.preconnect_map:
+				continue
+			thread = threading.Thread(target=connect, args=(remote_site,))
+			thread.setDaemon(True)
+			thread.start()
+			self.preconnect_map[remote_site] = thread
 
 	def cleanup(self):
+		for conn_manager in self.connection_map.values():
+			pending = conn_manager.pending_transfers()
+			if pending:
+				Message.note("Waiting for %d transfer(s) from %s to finish." % (
+						pending, conn_manager.remote_site.name))
+				conn_manager.wait_for_transfers()
+			conn_manager.disconnect()
+		if self.fingerprint_index:
+			self.fingerprint_index.close()
+		# the config is saved first, it matters more than the stats
 		self.config.save()
+		self.stats.write_log(self.config.stats_log_file)
 		Message.note("Done.")
 
 	def run(self):
@@ -214,6 +965,10 @@ class MoverController(object):
 			elif opt == 2:
 				# update local directories
 				self._update_local()
+			elif opt == 3:
+				self._bandwidth()
+			elif opt == 4:
+				self._catalog()
 			else:
 				self.cleanup()
 				return
@@ -248,10 +1003,15 @@ class MoverController(object):
 				self._remote_dirs(remote_site)
 			elif action == 'b':
 				self._remote_blocks(remote_site)
-			elif action == 'm':
+			elif action == 's':
+				self._site_settings(remote_site)
+			elif action in ('m', 'p'):
 				if len(remote_site.get_dir_list()) < 1:
 					Message.err("Remote sites must have at least 1 dir to move music.")
 					continue
+				if action == 'p':
+					self._push_music(remote_site)
+					continue
 				self._move_music(remote_site)
 
 
@@ -266,6 +1026,52 @@ class MoverController(object):
 				remote_site.blocked_album_list.pop(index)
 
 
+	def _site_settings(self, remote_site):
+		" Display and edit the settings for a remote site "
+		while(True):
+			setting_list = remote_site.get_settings()
+			action, index = Menu.display_settings(setting_list)
+			if action == 'q':
+				return
+			if action == 't':
+				self._benchmark_site(remote_site)
+				continue
+			if action == 'e':
+				if index < 1:
+					Message.err("You must specify a setting to edit.")
+					continue
+				name, desc, value = setting_list[index-1]
+				new_value = Input.prompt_setting(desc, value)
+				try:
+					remote_site.set_setting(name, new_value)
+				except ValueError, err:
+					Message.err("Invalid value for %s: %s" % (desc, err))
+
+
+	def _benchmark_site(self, remote_site):
+		" Compare sftp get with the large file download, or sftp with tar on an album "
+		conn_manager = self._connect(remote_site)
+		if not conn_manager:
+			return
+		remote_path = Input.prompt_remote_file()
+		try:
+			if S_ISDIR(conn_manager.scp_client.stat(remote_path).st_mode):
+				size, count, sftp_time, tar_time = conn_manager.benchmark_album(remote_path)
+				mb = size / 1048576.0
+				Message.note("%d files, sftp: %.2f MB/s, tar: %.2f MB/s (%.1fx faster)" % (
+						count, mb / max(sftp_time, 0.001), mb / max(tar_time, 0.001),
+						sftp_time / max(tar_time, 0.001)))
+				return
+			size, get_time, range_time = conn_manager.benchmark_download(remote_path)
+		except (IOError, OSError, SSHException), err:
+			Message.err("Benchmark failed: %s" % (err))
+			return
+		mb = size / 1048576.0
+		Message.note("get: %.2f MB/s, large file path: %.2f MB/s (%.1fx faster)" % (
+				mb / max(get_time, 0.001), mb / max(range_time, 0.001),
+				get_time / max(range_time, 0.001)))
+
+
 	def _remote_dirs(self, remote_site):
 		" List remote directories, and delete "
 		while(True):
@@ -281,59 +1087,375 @@ class MoverController(object):
 				remote_site.add_dir(dir)
 
 
-	def _move_music(self, remote_site):
-		" List albums and move music "
+	def _connect(self, remote_site, interactive=True):
+		" Return the connection for a site, connecting if required "
+		if remote_site in self.preconnect_map:
+			self.preconnect_map.pop(remote_site).join()
 		if remote_site not in self.connection_map:
 			try:
 				self.connection_map[remote_site] = ConnectionManager(remote_site, 
-							self.config['local_music'])
+							self.config['local_music'], interactive=interactive,
+							scheduler=self.scheduler, stats=self.stats,
+							listing_dir=self.config.listing_cache_dir,
+							hash_db=self.config.fingerprint_index_file)
 			except (SSHException, socket.error), err:
 				Message.err("Failed to connect: %s" % (err))
+				return None
+		return self.connection_map[remote_site]
+
+
+	def _move_music(self, remote_site):
+		" List albums and move music "
+		conn_manager = self._connect(remote_site)
+		if not conn_manager:
+			return
+		album_map, album_list, local_set, match_map = self._album_listing(
+				conn_manager, remote_site)
+		browser = AlbumBrowser(album_list)
+
+		while(True):
+			action, number_list = Menu.display_album_list(browser, local_set, match_map)
+			if action == 'q':
 				return
-		conn_manager = self.connection_map[remote_site]
-		# Refresh the album list for this site 
-		album_map, error_list = conn_manager.get_album_list()
+			if action == 'r':
+				album_map, album_list, local_set, match_map = self._album_listing(
+						conn_manager, remote_site, force=True)
+				browser = AlbumBrowser(album_list)
+				continue
+			if action == 'b':
+				for number in number_list:
+					album_name = browser.album(number)
+					remote_site.blocked_album_list.append(album_name)
+					browser.remove(album_name)
+				continue
+			if action in ('m', 'u'):
+				for number in number_list:
+					album_name = browser.album(number)
+					path = album_map[album_name].rstrip('/') + "/"
+					Message.note("Queued %s." % (album_name))
+					conn_manager.queue_album(path, album_name, urgent=(action == 'u'))
+					browser.remove(album_name)
+				continue
+
+	def _album_listing(self, conn_manager, remote_site, force=False):
+		"""
+		List the albums of a site, force skips the listing cache. Returns the
+		album map, the sorted albums to show, the albums shown which are local
+		and a map of album to a likely local match.
+		"""
+		album_map, error_list = conn_manager.get_album_list(force)
 		for error in error_list:
 			Message.err(error)	
-		album_list = album_map.keys()
+
+		# remove blocks and albums already on local, sites which sync keep
+		# albums with the same name listed. Names which only match once
+		# normalized or fuzzily may be another disc or edition, so they are
+		# listed with their score
+		blocked_set = set(remote_site.blocked_album_list)
+		matcher = AlbumMatcher(self.config['local_music'].get_album_cache(),
+				remote_site.match_normalized, remote_site.fuzzy_match / 100.0)
+		album_list = []
+		local_set = set()
+		match_map = {}
+		for album in album_map:
+			if album in blocked_set:
+				continue
+			match = matcher.match(album)
+			if match is None:
+				album_list.append(album)
+			elif match.kind == AlbumMatch.EXACT:
+				if remote_site.sync_albums:
+					album_list.append(album)
+					local_set.add(album)
+			else:
+				album_list.append(album)
+				match_map[album] = match
+		if remote_site.fingerprint_albums:
+			compare_list = [album for album in album_list if album not in local_set]
+			hidden_set = self._content_matches(conn_manager, album_map, compare_list,
+					match_map)
+			if hidden_set:
+				album_list = [album for album in album_list if album not in hidden_set]
+				Message.note("%d album(s) hidden, local albums have the same files." % (
+						len(hidden_set)))
 		album_list.sort()
+		return album_map, album_list, local_set, match_map
 
-		# remove blocks
-		for block in remote_site.blocked_album_list:
-			if block in album_list:
-				album_list.remove(block)
+	def _content_matches(self, conn_manager, album_map, album_list, match_map):
+		"""
+		Compare the files of remote albums with the local albums by fingerprint.
+		Albums sharing files with a local album are added to match_map, returns
+		the set of albums with the same files as a local album.
+		"""
+		path_map = {}
+		for album in album_list:
+			path_map[album_map[album].rstrip('/') + "/" + album] = album
+		if not path_map:
+			return set()
+		try:
+			key_map = conn_manager.get_fingerprints(path_map.keys())
+		except (IOError, SSHException), err:
+			Message.err("Failed to fingerprint albums: %s" % (err))
+			return set()
+		if self.fingerprint_index is None:
+			self.fingerprint_index = FingerprintIndex(self.config.fingerprint_index_file)
+		local_music = self.config['local_music']
+		self.fingerprint_index.refresh(local_music.get_album_paths())
 
-		# remove albums already on local
-		for album in self.config['local_music'].get_album_cache():
-			if album in album_list:
-				album_list.remove(album)
+		same_set = set()
+		for path, key_list in key_map.items():
+			album = path_map.get(path)
+			if album is None:
+				continue
+			match = self.fingerprint_index.match(album, key_list)
+			if not match or match.confidence < FingerprintIndex.flag_confidence:
+				continue
+			if match.confidence == 1:
+				same_set.add(album)
+			elif album not in match_map or match_map[album].confidence < match.confidence:
+				match_map[album] = match
+		return same_set
+
+
+	def _push_music(self, remote_site):
+		" List local albums missing from a site and push them to its first dir "
+		conn_manager = self._connect(remote_site)
+		if not conn_manager:
+			return
+		local_music = self.config['local_music']
+		remote_dir = remote_site.get_dir_list()[0]
+		album_list, match_map = self._push_listing(conn_manager, remote_site)
+		browser = AlbumBrowser(album_list)
 
 		while(True):
-			action, index_list = Menu.display_album_list(album_list)
+			action, number_list = Menu.display_push_list(browser, remote_dir, match_map)
 			if action == 'q':
 				return
-			if action == 'b':
-				remove_names = []
-				for index in index_list:
-					index -= 1
-					remote_site.blocked_album_list.append(album_list[index])
-					remove_names.append(album_list[index])
-				for album in remove_names:
-					album_list.remove(album)
+			if action == 'r':
+				album_list, match_map = self._push_listing(conn_manager, remote_site, force=True)
+				browser = AlbumBrowser(album_list)
 				continue
-			if action == 'm':
-				remove_names = []
-				for index in index_list:
-					index -= 1
-					album_name = album_list[index]
-					path = album_map[album_name].rstrip('/') + "/"
-					Message.note("Moving %s." % (album_name))
-					conn_manager.pull_album(path, album_name)
-					remove_names.append(album_name)
-				for album in remove_names:
-					album_list.remove(album)
+			for number in number_list:
+				album_name = browser.album(number)
+				Message.note("Queued %s for %s." % (album_name, remote_site.name))
+				conn_manager.queue_push(local_music.get_album_path(album_name), remote_dir,
+						urgent=(action == 'u'))
+				browser.remove(album_name)
+
+	def _push_listing(self, conn_manager, remote_site, force=False):
+		"""
+		Return the local albums which are not on a site and a map of album to
+		a likely match on the site, by the site's matching. Only exact matches
+		are hidden.
+		"""
+		album_map, error_list = conn_manager.get_album_list(force)
+		for error in error_list:
+			Message.err(error)
+		matcher = AlbumMatcher(album_map.keys(), remote_site.match_normalized,
+				remote_site.fuzzy_match / 100.0)
+		album_list = []
+		match_map = {}
+		for album in set(self.config['local_music'].get_album_cache()):
+			match = matcher.match(album)
+			if match and match.kind == AlbumMatch.EXACT:
+				continue
+			album_list.append(album)
+			if match:
+				match_map[album] = match
+		album_list.sort()
+		return album_list, match_map
+
+	def _catalog(self):
+		" List the albums of every site together, and move them from the fastest site "
+		if len(self.config['local_music'].get_dir_list()) < 1:
+			Message.err("You must have at least one local dir to move music.")
+			return
+		conn_manager_list = []
+		site_list = [remote_site for remote_site in self.config['sites']
+				if len(remote_site.get_dir_list()) > 0]
+		# connect to every site at once, then prompt for those which need it
+		self._preconnect(site_list)
+		for remote_site in site_list:
+			conn_manager = self._connect(remote_site)
+			if conn_manager:
+				conn_manager_list.append(conn_manager)
+		if not conn_manager_list:
+			Message.err("No sites with dirs to list.")
+			return
+		catalog = Catalog(conn_manager_list)
+		album_list, match_map = self._catalog_listing(catalog)
+		browser = AlbumBrowser(album_list)
+
+		while(True):
+			# sites are named only for the albums on the page shown
+			action, number_list = Menu.display_catalog(browser, catalog.site_names, match_map)
+			if action == 'q':
+				return
+			if action == 'r':
+				album_list, match_map = self._catalog_listing(catalog, force=True)
+				browser = AlbumBrowser(album_list)
+				continue
+			for number in number_list:
+				album_name = browser.album(number)
+				source_list = catalog.sources(album_name, self.stats)
+				if action == 'b':
+					for conn_manager, dir in source_list:
+						conn_manager.remote_site.blocked_album_list.append(album_name)
+				elif action in ('m', 'u'):
+					conn_manager, dir = source_list[0]
+					Message.note("Queued %s from %s." % (album_name, conn_manager.remote_site.name))
+					conn_manager.queue_album(dir.rstrip('/') + "/", album_name,
+							urgent=(action == 'u'))
+				elif action == 's':
+					conn_manager, dir = source_list[0]
+					helper_list = [(helper, helper_dir.rstrip('/') + "/")
+							for helper, helper_dir in source_list[1:]]
+					Message.note("Queued %s from %s." % (album_name, ", ".join(
+							catalog.site_names(album_name))))
+					conn_manager.queue_album(dir.rstrip('/') + "/", album_name,
+							helper_list=helper_list)
+				browser.remove(album_name)
+				catalog.remove(album_name)
+
+	def _catalog_listing(self, catalog, force=False):
+		"""
+		List the catalog, returns the albums which are not local and a map of
+		album to a likely local match. Albums are matched by the settings of
+		each site with them, and the best match is kept; like _album_listing
+		only exact matches are hidden.
+		"""
+		catalog.load(force)
+		for error in catalog.error_list:
+			Message.err(error)
+		local_list = self.config['local_music'].get_album_cache()
+		matcher_map = {}
+		album_list = []
+		match_map = {}
+		for album in catalog.album_list():
+			best = None
+			for conn_manager, dir in catalog.sources(album):
+				site = conn_manager.remote_site
+				setting = (site.match_normalized, site.fuzzy_match)
+				if setting not in matcher_map:
+					matcher_map[setting] = AlbumMatcher(local_list, site.match_normalized,
+							site.fuzzy_match / 100.0)
+				match = matcher_map[setting].match(album)
+				if match and (best is None or match.confidence > best.confidence):
+					best = match
+			if best and best.kind == AlbumMatch.EXACT:
+				continue
+			album_list.append(album)
+			if best:
+				match_map[album] = best
+		return album_list, match_map
+
+	def sync(self, site='', match='*', exclude='', report=None, interval=0):
+		"""
+		Pull every album matching the rule from the named sites, comma
+		separated, or from every site, without prompting. With an interval in
+		minutes the sites are polled until interrupted. Returns the exit code
+		of the last pass finished, see sync, or INTERRUPTED if none finished.
+		"""
+		name_list = [name.strip() for name in site.split(',') if name.strip()]
+		site_list = [remote_site for remote_site in self.config['sites']
+				if not name_list or remote_site.name in name_list]
+		missing = set(name_list) - set([remote_site.name for remote_site in site_list])
+		if missing or not site_list:
+			Message.err("No sites named %s." % (", ".join(sorted(missing)) or site))
+			return sync.USAGE
+		if len(self.config['local_music'].get_dir_list()) < 1:
+			Message.err("You must have at least one local dir to move music.")
+			return sync.USAGE
+		rule = SyncRule(match, exclude)
+		try:
+			interval = float(interval)
+		except ValueError:
+			Message.err("Invalid interval %s." % (interval))
+			return sync.USAGE
+
+		status = sync.INTERRUPTED
+		passes = 0
+		try:
+			while(True):
+				status = self._sync_pass(site_list, rule, passes, report).exit_code()
+				passes += 1
+				if not interval:
+					break
+				Message.note("Next sync in %g minute(s)." % (interval))
+				time.sleep(interval * 60)
+		except KeyboardInterrupt:
+			Message.note("Sync stopped.")
+		self.cleanup()
+		return status
+
+	def _sync_pass(self, site_list, rule, passes, report_path=None):
+		" Queue the albums matching rule on every site, wait for them and report "
+		local_music = self.config['local_music']
+		local_music.wait_refresh()
+		if passes and not local_music.is_watching():
+			self.config._report_refresh(local_music.refresh_album_cache())
+
+		report = SyncReport()
+		queued_set = set()
+		for remote_site in site_list:
+			entry = report.site(remote_site.name)
+			if len(remote_site.get_dir_list()) < 1:
 				continue
-				
+			conn_manager = self._connect(remote_site, interactive=False)
+			if not conn_manager:
+				entry['error'] = "Failed to connect"
+				continue
+			try:
+				album_map, album_list, local_set, match_map = self._album_listing(
+						conn_manager, remote_site)
+			except (IOError, SSHException, socket.error), err:
+				Message.err("Failed to list %s: %s" % (remote_site.name, err))
+				entry['error'] = str(err)
+				continue
+			for album in album_list:
+				if album in local_set or album in queued_set or not rule.matches(album):
+					continue
+				if album in match_map:
+					# likely local already, left for a person to decide
+					entry['skipped'].append(album)
+					continue
+				Message.note("Queued %s from %s." % (album, remote_site.name))
+				entry['jobs'].append(conn_manager.queue_album(
+						album_map[album].rstrip('/') + "/", album))
+				queued_set.add(album)
+
+		# sites pull in parallel, each with its own workers
+		for remote_site in site_list:
+			if remote_site in self.connection_map:
+				self.connection_map[remote_site].wait_for_transfers()
+		report.finish()
+		Message.note(report.summary())
+		if report_path:
+			try:
+				report.write(report_path)
+			except (IOError, OSError), err:
+				Message.err("Failed to write report %s: %s" % (report_path, err))
+		return report
+
+	def _bandwidth(self):
+		" List, add and remove bandwidth profiles, set the global limit "
+		while(True):
+			action, index = Menu.display_bandwidth(self.config['bandwidth_profiles'],
+						self.config['global_rate_limit'])
+			if action == 'q':
+				return
+			if action == 'a':
+				profile = Input.prompt_profile()
+				if profile:
+					self.config['bandwidth_profiles'].append(profile)
+			elif action == 'd':
+				if index > 0 and Input.confirm_delete():
+					self.config['bandwidth_profiles'].pop(index-1)
+			elif action == 'g':
+				rate = Input.prompt_rate()
+				if rate is not None:
+					self.config['global_rate_limit'] = rate
+
 
 	def _update_local(self):
 		" Update local directories. "
@@ -354,14 +1476,40 @@ class MoverController(object):
 
 
 
+def stop_on_term(signum, frame):
+	" Stop a sync on SIGTERM the way Ctrl-C does, so transfers finish "
+	raise KeyboardInterrupt()
+
+
 if __name__ == "__main__":
+	arg_list = sys.argv[1:]
+	headless = arg_list[:1] == ['sync']
+	if headless:
+		arg_list = arg_list[1:]
 	config_args = {}
-	for params in sys.argv[1:]:
+	for params in arg_list:
 		try:
-			key, value = params.split('=')
+			key, value = params.split('=', 1)
 			config_args[key] = value
 		except ValueError, err:
 			Message.err("Invalid param %s." % (params))
+			if headless:
+				sys.exit(sync.USAGE)
 
-	mover = MoverController(**config_args)
-	mover.run()
+	if not headless:
+		mover = MoverController(**config_args)
+		mover.run()
+	else:
+		# usage: mover.py sync site=NAME[,NAME] match=GLOB[,GLOB] [exclude=GLOB]
+		#        [report=PATH] [interval=MINUTES] [config args]
+		if not sys.stdout.isatty():
+			Color.color_on = False
+		signal.signal(signal.SIGTERM, stop_on_term)
+		# the albums must be known before anything is listed
+		config_args.setdefault('startup', 'full')
+		sync_args = {}
+		for key in ('site', 'match', 'exclude', 'report', 'interval'):
+			if key in config_args:
+				sync_args[key] = config_args.pop(key)
+		mover = MoverController(**config_args)
+		sys.exit(mover.sync(**sync_args))
@@ -0,0 +1,181 @@
+"""
+ Ssh connection pool for Music Mover.
+"""
+
+import time
+import socket
+import threading
+
+from view import Message
+
+
+class ConnectionPool(object):
+	"""
+	A pool of authenticated ssh connections to one site. Each connection sends
+	keepalives, is health checked before it is handed out and reconnected when
+	stale. Sftp channels for parallel workers are spread across the pool.
+
+	connect is called with an interactive flag to open a new connected
+	SSHClient, only the first connection may prompt the user.
+	"""
+
+	# connections idle longer than this are probed before use
+	probe_idle = 60
+	probe_timeout = 10
+
+	def __init__(self, connect, size, keepalive):
+		self.connect = connect
+		self.size = max(1, size)
+		self.keepalive = keepalive
+		self.client_list = []
+		self.last_used = {}
+		self.next_index = 0
+		self.lock = threading.Lock()
+
+	def get_client(self, interactive=False):
+		"""
+		Return a healthy connection from the pool, round robin. The lock is
+		only held to pick and replace connections, probing and connecting,
+		which may prompt, happen outside it so other workers carry on.
+		"""
+		index, client = self._next()
+		if client is None:
+			return self._add(self._open(interactive))
+		if self._alive(client):
+			self._touch(client)
+			return client
+		Message.note("Reconnecting to %s." % (self._peer(client)))
+		self._close(client)
+		return self._replace(index, client, self._open(interactive))
+
+	def _next(self):
+		" (index, connection) of the next connection, (None, None) if there are none "
+		self.lock.acquire()
+		try:
+			if not self.client_list:
+				return None, None
+			index = self.next_index % len(self.client_list)
+			self.next_index += 1
+			return index, self.client_list[index]
+		finally:
+			self.lock.release()
+
+	def _touch(self, client):
+		self.lock.acquire()
+		try:
+			self.last_used[client] = time.time()
+		finally:
+			self.lock.release()
+
+	def _add(self, client):
+		" Add a new connection, unless another thread filled the pool first "
+		self.lock.acquire()
+		try:
+			if len(self.client_list) < self.size:
+				self.client_list.append(client)
+				self.last_used[client] = time.time()
+				return client
+		finally:
+			self.lock.release()
+		self._close(client)
+		return self.get_client()
+
+	def _replace(self, index, stale, client):
+		" Put client in the slot of stale, unless another thread replaced it first "
+		self.lock.acquire()
+		try:
+			if index < len(self.client_list) and self.client_list[index] is stale:
+				self.client_list[index] = client
+				self.last_used[client] = time.time()
+				return client
+		finally:
+			self.lock.release()
+		self._close(client)
+		return self.get_client()
+
+	def open_sftp(self):
+		" Open an sftp channel on the next connection in the pool "
+		# imported by the ConnectionManager which made the pool
+		import paramiko
+		return paramiko.SFTPClient.from_transport(self.get_client().get_transport())
+
+	def warm(self):
+		" Open the rest of the pool in the background "
+		thread = threading.Thread(target=self._fill)
+		thread.setDaemon(True)
+		thread.start()
+
+	def close(self):
+		" Close every connection in the pool "
+		self.lock.acquire()
+		try:
+			for client in self.client_list:
+				self._close(client)
+			self.client_list = []
+			self.last_used = {}
+		finally:
+			self.lock.release()
+
+	def _fill(self):
+		while(True):
+			self.lock.acquire()
+			try:
+				if len(self.client_list) >= self.size:
+					return
+			finally:
+				self.lock.release()
+			try:
+				client = self._open(False)
+			except Exception, err:
+				Message.err("Failed to open extra connection: %s" % (err))
+				return
+			# get_client may have filled the pool while this one connected
+			self.lock.acquire()
+			try:
+				if len(self.client_list) < self.size:
+					self.client_list.append(client)
+					self.last_used[client] = time.time()
+					client = None
+			finally:
+				self.lock.release()
+			if client:
+				self._close(client)
+				return
+
+	def _open(self, interactive):
+		client = self.connect(interactive)
+		transport = client.get_transport()
+		transport.set_keepalive(self.keepalive)
+		# let the os notice a dead peer on an otherwise idle link
+		transport.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+		return client
+
+	def _alive(self, client):
+		" Check the connection, probing the remote if it has been idle "
+		transport = client.get_transport()
+		if transport is None or not transport.is_active():
+			return False
+		if time.time() - self.last_used.get(client, 0) < self.probe_idle:
+			return True
+		reply = []
+		def probe():
+			transport.global_request('keepalive@lag.net', wait=True)
+			reply.append(transport.is_active())
+		thread = threading.Thread(target=probe)
+		thread.setDaemon(True)
+		thread.start()
+		thread.join(self.probe_timeout)
+		return bool(reply) and reply[0]
+
+	def _close(self, client):
+		self.last_used.pop(client, None)
+		try:
+			client.close()
+		except (socket.error, EOFError):
+			pass
+
+	def _peer(self, client):
+		try:
+			return "%s:%s" % client.get_transport().getpeername()[:2]
+		except (AttributeError, socket.error):
+			return "site"
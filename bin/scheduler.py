@@ -0,0 +1,123 @@
+"""
+ Bandwidth scheduling for Music Mover.
+"""
+
+import time
+import threading
+
+
+class TokenBucket(object):
+	"""
+	Limit a flow of bytes to rate bytes per second, with bursts up to one
+	second's worth. A rate of 0 is unlimited. Urgent consumers are served
+	before any normal consumer waiting on the same bucket.
+	"""
+
+	def __init__(self, rate=0):
+		self.rate = rate
+		self.tokens = rate
+		self.last_fill = time.time()
+		self.urgent_waiting = 0
+		self.cond = threading.Condition()
+
+	def set_rate(self, rate):
+		self.cond.acquire()
+		try:
+			if rate != self.rate:
+				self.rate = rate
+				self.tokens = min(self.tokens, rate)
+				self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+	def consume(self, amount, urgent=False):
+		" Block until amount bytes may be sent "
+		self.cond.acquire()
+		if urgent:
+			self.urgent_waiting += 1
+		try:
+			while(True):
+				if not self.rate:
+					return
+				self._fill()
+				if self.tokens > 0 and (urgent or not self.urgent_waiting):
+					# may go into debt for a request larger than the burst
+					self.tokens -= amount
+					return
+				self.cond.wait(max(0.01, -self.tokens / float(self.rate)))
+		finally:
+			if urgent:
+				self.urgent_waiting -= 1
+				self.cond.notifyAll()
+			self.cond.release()
+
+	def _fill(self):
+		now = time.time()
+		self.tokens = min(self.rate, self.tokens + (now - self.last_fill) * self.rate)
+		self.last_fill = now
+
+
+class BandwidthScheduler(object):
+	"""
+	Shape transfer bandwidth with a token bucket per site and one shared by
+	all sites. The global limit comes from the time of day profiles in the
+	configuration, falling back to the global rate limit. Limits are read on
+	every call so edits apply to running transfers.
+	"""
+
+	def __init__(self, config):
+		self.config = config
+		self.global_bucket = TokenBucket()
+		self.site_bucket_map = {}
+		self.lock = threading.Lock()
+
+	def global_rate(self, now=None):
+		" The global limit in bytes per second for the current time, 0 for none "
+		if now is None:
+			now = time.localtime()
+		for profile in self.config['bandwidth_profiles']:
+			if profile_active(profile, now.tm_hour):
+				return profile['rate'] * 1024
+		return self.config['global_rate_limit'] * 1024
+
+	def consume(self, remote_site, amount, urgent=False):
+		" Block until amount bytes may be transferred from remote_site "
+		self.lock.acquire()
+		try:
+			if remote_site not in self.site_bucket_map:
+				self.site_bucket_map[remote_site] = TokenBucket()
+			site_bucket = self.site_bucket_map[remote_site]
+		finally:
+			self.lock.release()
+		site_bucket.set_rate(remote_site.rate_limit * 1024)
+		self.global_bucket.set_rate(self.global_rate())
+		site_bucket.consume(amount, urgent)
+		self.global_bucket.consume(amount, urgent)
+
+
+def profile_active(profile, hour):
+	" True if hour falls in the profile, which may wrap past midnight "
+	start, end = profile['start'], profile['end']
+	if start <= end:
+		return start <= hour < end
+	return hour >= start or hour < end
+
+
+class ThrottledReader(object):
+	" A file like reader which passes every read through a throttle "
+
+	def __init__(self, stream, throttle):
+		self.stream = stream
+		self.throttle = throttle
+
+	def read(self, size=-1):
+		data = self.stream.read(size)
+		if data:
+			self.throttle(len(data))
+		return data
+
+	def readline(self):
+		line = self.stream.readline()
+		if line:
+			self.throttle(len(line))
+		return line
@@ -0,0 +1,226 @@
+"""
+ Transfer statistics for Music Mover.
+"""
+
+import os
+import time
+import json
+import threading
+from collections import deque
+
+from view import Message
+
+
+def percentile(value_list, fraction):
+	" The value at fraction (0 - 1) of the sorted list, 0 for an empty list "
+	if not value_list:
+		return 0
+	value_list = sorted(value_list)
+	return value_list[min(len(value_list)-1, int(len(value_list) * fraction))]
+
+
+def format_rate(rate):
+	return "%.1f MB/s" % (rate / 1048576.0)
+
+
+class TransferStats(object):
+	" Bytes, files and throughput for one album, or for all albums from a site "
+
+	# seconds of history used for the rolling throughput
+	window = 10.0
+
+	def __init__(self, name, site_name=None, total_bytes=0):
+		self.name = name
+		self.site_name = site_name
+		self.total_bytes = total_bytes
+		self.bytes = 0
+		self.files = 0
+		self.file_time_list = []
+		self.start = time.time()
+		self.end = None
+		self.failed = False
+		self.recent = deque()
+
+	def add_bytes(self, amount):
+		now = time.time()
+		self.bytes += amount
+		self.recent.append((now, amount))
+		while self.recent and self.recent[0][0] < now - self.window:
+			self.recent.popleft()
+
+	def add_file(self, seconds):
+		self.files += 1
+		self.file_time_list.append(seconds)
+
+	def finish(self, failed=False):
+		self.end = time.time()
+		self.failed = failed
+
+	def elapsed(self):
+		return (self.end or time.time()) - self.start
+
+	def rate(self):
+		" Bytes per second over the last window, or overall once finished "
+		if self.end:
+			return self.bytes / max(self.elapsed(), 0.001)
+		span = min(self.window, max(self.elapsed(), 0.001))
+		return sum([amount for when, amount in self.recent]) / span
+
+	def eta(self):
+		" Seconds left, None if the total or the rate is unknown "
+		rate = self.rate()
+		if not self.total_bytes or not rate:
+			return None
+		return max(0, self.total_bytes - self.bytes) / rate
+
+	def to_dict(self):
+		return {
+			'name': self.name,
+			'site': self.site_name,
+			'bytes': self.bytes,
+			'total_bytes': self.total_bytes,
+			'files': self.files,
+			'seconds': round(self.elapsed(), 3),
+			'rate': round(self.bytes / max(self.elapsed(), 0.001)),
+			'failed': self.failed,
+			'file_seconds_p50': round(percentile(self.file_time_list, 0.5), 3),
+			'file_seconds_p95': round(percentile(self.file_time_list, 0.95), 3),
+			'file_seconds_max': round(max(self.file_time_list or [0]), 3),
+		}
+
+
+class StatsCollector(object):
+	" Collects transfer stats per album and per site for the session "
+
+	# sessions read back from the log for the throughput of each site
+	history_sessions = 20
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.site_map = {}
+		self.album_list = []
+		self.history_map = {}
+		self.start = time.time()
+
+	def load_history(self, path):
+		" Read the album rates of recent sessions from the log at path "
+		try:
+			f_log = open(path)
+			try:
+				line_list = f_log.readlines()[-self.history_sessions:]
+			finally:
+				f_log.close()
+		except IOError:
+			return
+		for line in line_list:
+			try:
+				session = json.loads(line)
+			except ValueError:
+				continue
+			for album in session.get('albums', []):
+				if album['site'] and album['bytes'] and not album['failed']:
+					self.history_map.setdefault(album['site'], []).append(album['rate'])
+
+	def site_rate(self, site_name):
+		"""
+		The mean throughput in bytes per second of the albums pulled from a site
+		this session and in the log, None if there are none
+		"""
+		self.lock.acquire()
+		try:
+			rate_list = [stats.rate() for stats in self.album_list
+					if stats.site_name == site_name and stats.end and stats.bytes and
+					not stats.failed]
+		finally:
+			self.lock.release()
+		rate_list.extend(self.history_map.get(site_name, []))
+		if not rate_list:
+			return None
+		return sum(rate_list) / float(len(rate_list))
+
+	def site_rates(self, site_name_list):
+		" The rate of each site, sites without one get the mean of the others "
+		rate_list = [self.site_rate(site_name) for site_name in site_name_list]
+		known_list = [rate for rate in rate_list if rate]
+		default = known_list and sum(known_list) / len(known_list) or 1.0
+		return [rate or default for rate in rate_list]
+
+	def start_album(self, site_name, album):
+		" Start counting an album, returns its stats "
+		stats = TransferStats(album, site_name)
+		self.lock.acquire()
+		try:
+			if site_name not in self.site_map:
+				self.site_map[site_name] = TransferStats(site_name)
+			self.album_list.append(stats)
+		finally:
+			self.lock.release()
+		return stats
+
+	def add_bytes(self, album_stats, amount):
+		self.lock.acquire()
+		try:
+			album_stats.add_bytes(amount)
+			self.site_map[album_stats.site_name].add_bytes(amount)
+		finally:
+			self.lock.release()
+
+	def add_file(self, album_stats, seconds):
+		self.lock.acquire()
+		try:
+			album_stats.add_file(seconds)
+			self.site_map[album_stats.site_name].add_file(seconds)
+		finally:
+			self.lock.release()
+
+	def status_line(self):
+		" One line summary of the active transfers, empty when idle "
+		self.lock.acquire()
+		try:
+			active_list = [stats for stats in self.album_list if not stats.end]
+			if not active_list:
+				return ""
+			part_list = []
+			for site_name in sorted(self.site_map.keys()):
+				site_active = [stats for stats in active_list if stats.site_name == site_name]
+				if site_active:
+					part_list.append("%s: %d active %s" % (site_name, len(site_active),
+							format_rate(self.site_map[site_name].rate())))
+			# the album closest to done
+			album = max(active_list, key=lambda stats: stats.total_bytes and
+					float(stats.bytes) / stats.total_bytes)
+			line = "%s | %s" % (" | ".join(part_list), album.name[:30])
+			if album.total_bytes:
+				line += " %d%%" % (album.bytes * 100 / album.total_bytes)
+			eta = album.eta()
+			if eta is not None:
+				line += " ETA %dm%02ds" % (eta / 60, eta % 60)
+			return line
+		finally:
+			self.lock.release()
+
+	def write_log(self, path):
+		" Append the session stats to path as one line of json "
+		self.lock.acquire()
+		try:
+			if not self.album_list:
+				return
+			session = {
+				'start': self.start,
+				'end': time.time(),
+				'sites': [stats.to_dict() for stats in self.site_map.values()],
+				'albums': [stats.to_dict() for stats in self.album_list],
+			}
+		finally:
+			self.lock.release()
+		log_dir = os.path.dirname(path)
+		try:
+			if log_dir and not os.path.isdir(log_dir):
+				os.makedirs(log_dir)
+			f_log = open(path, 'a')
+			try:
+				f_log.write(json.dumps(session) + "\n")
+			finally:
+				f_log.close()
+		except (IOError, OSError), err:
+			Message.err("Failed to write the stats log %s: %s" % (path, err))
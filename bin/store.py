@@ -0,0 +1,203 @@
+"""
+ Config store for Music Mover.
+
+ The config is kept in config.json, with an explicit schema and a version.
+ Each site's block list is kept in its own file in blocks/, read the first
+ time it is used and only written again when it changed. Every file is
+ written to a temporary file and renamed over the old one, so a crash leaves
+ either the old config or the new one.
+"""
+
+import os
+import re
+import json
+
+from models import LocalMusic, RemoteSite
+
+
+SCHEMA_VERSION = 1
+
+# keys of the config dict which are kept as they are
+PLAIN_KEYS = ['global_rate_limit', 'bandwidth_profiles']
+
+
+def to_bytes(value):
+	" Turn the unicode strings json returns back into byte strings "
+	if isinstance(value, unicode):
+		return value.encode('latin-1')
+	if isinstance(value, list):
+		return [to_bytes(item) for item in value]
+	if isinstance(value, dict):
+		return dict([(to_bytes(key), to_bytes(item)) for key, item in value.items()])
+	return value
+
+
+def utf8_bytes(value):
+	" Turn the unicode strings of an old jsonpickle config into byte strings "
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	if isinstance(value, list):
+		return [utf8_bytes(item) for item in value]
+	if isinstance(value, dict):
+		return dict([(utf8_bytes(key), utf8_bytes(item)) for key, item in value.items()])
+	return value
+
+
+def write_atomic(path, data):
+	" Write data to path through a temporary file and a rename "
+	tmp_path = path + '.tmp'
+	f_out = open(tmp_path, 'w')
+	try:
+		f_out.write(data)
+		f_out.flush()
+		os.fsync(f_out.fileno())
+	finally:
+		f_out.close()
+	os.rename(tmp_path, path)
+
+
+def dump_json(value):
+	# names and paths are byte strings in any encoding, latin-1 keeps every byte
+	return json.dumps(value, encoding='latin-1', indent=1)
+
+
+def read_json(path):
+	f_in = open(path)
+	try:
+		return to_bytes(json.loads(f_in.read()))
+	finally:
+		f_in.close()
+
+
+class ConfigStore(object):
+	"""
+	Reads and writes the config dict of a Configuration in dir. Raises
+	IOError or ValueError for a config which can not be read, including
+	one written by a newer version.
+	"""
+
+	def __init__(self, dir):
+		self.dir = dir
+		self.path = os.path.join(dir, 'config.json')
+		self.block_dir = os.path.join(dir, 'blocks')
+		# the block lists as last read or written, by site id
+		self.saved_blocks = {}
+
+	def exists(self):
+		return os.path.exists(self.path)
+
+	def load(self):
+		" Return the config dict "
+		data = read_json(self.path)
+		version = data.get('version')
+		if not isinstance(version, int) or version > SCHEMA_VERSION:
+			raise ValueError("Unknown config version %s in %s" % (version, self.path))
+		data = self._upgrade(data)
+
+		config = {}
+		for key in PLAIN_KEYS:
+			if key in data:
+				config[key] = data[key]
+		local_music = LocalMusic()
+		local_music._dir_list = data['local_music']['dirs']
+		local_music._active_save_dir = data['local_music']['active_save_dir']
+		config['local_music'] = local_music
+		config['sites'] = [self._load_site(site_data) for site_data in data['sites']]
+		return config
+
+	def _upgrade(self, data):
+		" Bring data written by an older version up to the current schema "
+		# there is only one version so far, upgrades go here as version n -> n+1
+		return data
+
+	def _load_site(self, site_data):
+		site = RemoteSite(site_data['name'], site_data['username'],
+				site_data['hostname'], site_data['port'])
+		site.store_id = site_data['id']
+		site._dir_list = site_data['dirs']
+		setting_set = set([name for name, desc in RemoteSite.settings])
+		for name, value in site_data['settings'].items():
+			if name in setting_set:
+				setattr(site, name, value)
+		# read on first use
+		site._blocked_album_list = None
+		site._block_loader = lambda: self._load_blocks(site.store_id)
+		return site
+
+	def _block_path(self, site_id):
+		return os.path.join(self.block_dir, site_id + '.json')
+
+	def _load_blocks(self, site_id):
+		try:
+			album_list = read_json(self._block_path(site_id))
+		except IOError:
+			album_list = []
+		self.saved_blocks[site_id] = list(album_list)
+		return album_list
+
+	def save(self, config):
+		" Write the config dict, and the block lists which changed "
+		if not os.path.isdir(self.block_dir):
+			os.makedirs(self.block_dir)
+		site_list = config['sites']
+		self._assign_ids(site_list)
+
+		# block lists first, so the config never names a missing one
+		for site in site_list:
+			album_list = site._blocked_album_list
+			if album_list is None or album_list == self.saved_blocks.get(site.store_id):
+				continue
+			write_atomic(self._block_path(site.store_id), dump_json(album_list))
+			self.saved_blocks[site.store_id] = list(album_list)
+
+		local_music = config['local_music']
+		data = {
+			'version': SCHEMA_VERSION,
+			'local_music': {
+				'dirs': local_music.get_dir_list(),
+				'active_save_dir': local_music._active_save_dir,
+			},
+			'sites': [self._site_data(site) for site in site_list],
+		}
+		for key in PLAIN_KEYS:
+			data[key] = config[key]
+		write_atomic(self.path, dump_json(data))
+		self._remove_stale_blocks(site_list)
+
+	def _site_data(self, site):
+		# only settings which were set, so the others follow the defaults
+		settings = {}
+		for name, desc in RemoteSite.settings:
+			if name in site.__dict__:
+				settings[name] = site.__dict__[name]
+		return {
+			'id': site.store_id,
+			'name': site.name,
+			'username': site.username,
+			'hostname': site.hostname,
+			'port': site.port,
+			'dirs': site.get_dir_list(),
+			'settings': settings,
+		}
+
+	def _assign_ids(self, site_list):
+		" Give new sites an id, used to name their files "
+		used_set = set([site.store_id for site in site_list if site.store_id])
+		for site in site_list:
+			if site.store_id:
+				continue
+			base = re.sub(r'[^\w.-]', '_', "%s@%s" % (site.username, site.hostname))
+			site_id, count = base, 1
+			while site_id in used_set or os.path.exists(self._block_path(site_id)):
+				count += 1
+				site_id = "%s-%d" % (base, count)
+			site.store_id = site_id
+			used_set.add(site_id)
+
+	def _remove_stale_blocks(self, site_list):
+		" Remove the block lists of deleted sites "
+		id_set = set([site.store_id for site in site_list])
+		for name in os.listdir(self.block_dir):
+			if name.endswith('.json') and name[:-len('.json')] not in id_set:
+				os.remove(os.path.join(self.block_dir, name))
+				self.saved_blocks.pop(name[:-len('.json')], None)
@@ -0,0 +1,114 @@
+"""
+ Rules and reports for the headless sync of Music Mover.
+"""
+
+import os
+import time
+import json
+import fnmatch
+
+from store import write_atomic
+from transfer import TransferJob
+
+
+# exit codes of a sync
+OK = 0
+ALBUMS_FAILED = 1
+SITES_FAILED = 2
+USAGE = 3
+INTERRUPTED = 4
+
+
+class SyncRule(object):
+	"""
+	Which albums a sync pulls. match and exclude are comma separated glob
+	patterns, compared without case. An album is pulled if it matches one of
+	the match patterns and none of the exclude ones.
+	"""
+
+	def __init__(self, match='*', exclude=''):
+		self.match_list = self._patterns(match)
+		self.exclude_list = self._patterns(exclude)
+
+	def _patterns(self, patterns):
+		return [pattern.strip().lower() for pattern in patterns.split(',') if pattern.strip()]
+
+	def matches(self, album):
+		name = album.lower()
+		for pattern in self.exclude_list:
+			if fnmatch.fnmatchcase(name, pattern):
+				return False
+		for pattern in self.match_list:
+			if fnmatch.fnmatchcase(name, pattern):
+				return True
+		return False
+
+
+class SyncReport(object):
+	" The result of one sync pass, per site "
+
+	def __init__(self):
+		self.start = time.time()
+		self.end = None
+		self.site_list = []
+		self.site_map = {}
+
+	def site(self, name):
+		" The report entry of a site, added on first use "
+		if name not in self.site_map:
+			entry = {'name': name, 'error': None, 'skipped': [], 'jobs': []}
+			self.site_map[name] = entry
+			self.site_list.append(entry)
+		return self.site_map[name]
+
+	def finish(self):
+		self.end = time.time()
+
+	def _albums(self, status):
+		album_list = []
+		for entry in self.site_list:
+			album_list.extend([job.file for job in entry['jobs'] if job.status == status])
+		return album_list
+
+	def exit_code(self):
+		if [entry for entry in self.site_list if entry['error']]:
+			return SITES_FAILED
+		for entry in self.site_list:
+			for job in entry['jobs']:
+				if job.status != TransferJob.DONE:
+					return ALBUMS_FAILED
+		return OK
+
+	def summary(self):
+		" One line summary of the pass "
+		skipped = sum([len(entry['skipped']) for entry in self.site_list])
+		site_errors = len([entry for entry in self.site_list if entry['error']])
+		return "Sync: %d pulled, %d failed, %d skipped as likely local, %d site error(s) in %ds" % (
+				len(self._albums(TransferJob.DONE)), len(self._albums(TransferJob.FAILED)), skipped,
+				site_errors, (self.end or time.time()) - self.start)
+
+	def to_dict(self):
+		site_list = []
+		for entry in self.site_list:
+			site_list.append({
+				'name': entry['name'],
+				'error': entry['error'],
+				'skipped': entry['skipped'],
+				'pulled': [job.file for job in entry['jobs'] if job.status == TransferJob.DONE],
+				'failed': [job.file for job in entry['jobs'] if job.status != TransferJob.DONE],
+			})
+		return {
+			'start': self.start,
+			'end': self.end,
+			'status': self.exit_code(),
+			'summary': self.summary(),
+			'sites': site_list,
+		}
+
+	def write(self, path):
+		" Write the report to path as json "
+		report_dir = os.path.dirname(path)
+		if report_dir and not os.path.isdir(report_dir):
+			os.makedirs(report_dir)
+		# names are byte strings in any encoding, latin-1 keeps every byte
+		write_atomic(path, json.dumps(self.to_dict(), encoding='latin-1', indent=1))
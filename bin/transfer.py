@@ -0,0 +1,588 @@
+"""
+ Transfer queue and transfer engines for Music Mover.
+"""
+
+import os
+import re
+import time
+import zlib
+import json
+import shutil
+import tarfile
+import threading
+import Queue
+
+from view import Message
+from manifest import shell_quote
+from scheduler import ThrottledReader
+from verify import StreamHash, BLOCK
+
+
+class TransferJob(object):
+	"""
+	An album (or single file) waiting to be pulled from a remote site, or a
+	local album waiting to be pushed to one
+	"""
+
+	QUEUED = 'queued'
+	ACTIVE = 'active'
+	DONE = 'done'
+	FAILED = 'failed'
+
+	# queue priorities, lowest first
+	URGENT = 0
+	NORMAL = 1
+
+	def __init__(self, path, file, urgent=False, helper_list=None, push=False, dest=None):
+		self.path = path
+		self.file = file
+		# the local path an album is pulled into
+		self.dest = dest
+		self.urgent = urgent
+		# (conn_manager, path) of other sites sharing the files
+		self.helper_list = helper_list
+		# path is the local album and file the remote dir to push it to
+		self.push = push
+		self.status = TransferJob.QUEUED
+
+	def priority(self):
+		if self.urgent:
+			return TransferJob.URGENT
+		return TransferJob.NORMAL
+
+	def name(self):
+		" The album name "
+		if self.push:
+			return os.path.basename(self.path.rstrip('/'))
+		return self.file
+
+	def __repr__(self):
+		if self.push:
+			return "<TransferJob push %s to %s (%s)>" % (self.path, self.file, self.status)
+		return "<TransferJob %s%s (%s)>" % (self.path, self.file, self.status)
+
+
+class TransferQueue(object):
+	"""
+	A queue of albums to pull from one site, serviced by a pool of worker
+	threads. Each worker opens its own sftp channel on the site's transport, so
+	albums transfer in parallel while more are being queued. Urgent albums are
+	taken before the rest of the queue.
+	"""
+
+	# sorts after every job, so workers stop once the queue is empty
+	STOP = 2
+
+	def __init__(self, conn_manager, workers):
+		self.conn_manager = conn_manager
+		self.queue = Queue.PriorityQueue()
+		self.sequence = 0
+		self.job_list = []
+		self.lock = threading.Lock()
+		self.worker_list = []
+		for i in range(max(1, workers)):
+			worker = threading.Thread(target=self._work, name="transfer-%d" % (i))
+			worker.setDaemon(True)
+			worker.start()
+			self.worker_list.append(worker)
+
+	def put(self, path, file, urgent=False, helper_list=None, dest=None):
+		" Queue an album for transfer into dest, helper_list sites share its files "
+		job = TransferJob(path, file, urgent, helper_list, dest=dest)
+		self._put(job.priority(), job)
+		return job
+
+	def put_push(self, local_path, remote_dir, urgent=False):
+		" Queue a local album to be pushed into remote_dir "
+		job = TransferJob(local_path, remote_dir, urgent, push=True)
+		self._put(job.priority(), job)
+		return job
+
+	def _put(self, priority, job):
+		" Queue in priority order, first in first out within a priority "
+		self.lock.acquire()
+		try:
+			if job:
+				self.job_list.append(job)
+			self.sequence += 1
+			self.queue.put((priority, self.sequence, job))
+		finally:
+			self.lock.release()
+
+	def pending(self):
+		" Return the number of jobs queued or in progress "
+		self.lock.acquire()
+		try:
+			return len([job for job in self.job_list
+					if job.status in (TransferJob.QUEUED, TransferJob.ACTIVE)])
+		finally:
+			self.lock.release()
+
+	def wait(self):
+		" Block until every queued job has finished "
+		self.queue.join()
+
+	def stop(self):
+		" Stop the workers once the queue is empty "
+		for worker in self.worker_list:
+			self._put(self.STOP, None)
+		for worker in self.worker_list:
+			worker.join()
+		self.worker_list = []
+
+	def _work(self):
+		" Worker loop, pull jobs off the queue until stopped "
+		scp_client = None
+		while(True):
+			priority, sequence, job = self.queue.get()
+			if job is None:
+				self.queue.task_done()
+				break
+			job.status = TransferJob.ACTIVE
+			try:
+				if scp_client is None:
+					scp_client = self.conn_manager.open_sftp()
+				if job.push:
+					success = self.conn_manager.push_album(job.path, job.file, scp_client,
+							job.urgent)
+				else:
+					success = self.conn_manager.pull_album(job.path, job.file, scp_client,
+							job.urgent, job.helper_list, job.dest)
+				if success:
+					job.status = TransferJob.DONE
+					Message.note("Finished %s." % (job.name()))
+				else:
+					job.status = TransferJob.FAILED
+			except Exception, err:
+				job.status = TransferJob.FAILED
+				Message.err("Transfer of %s failed: %s" % (job.name(), err))
+				# the channel may be broken, open a fresh one for the next job
+				scp_client = None
+			self.queue.task_done()
+
+		if scp_client:
+			scp_client.close()
+
+
+def split_ranges(size, parts, align=1):
+	" Split size bytes into at most parts (offset, length) ranges, starting at multiples of align "
+	parts = max(1, min(parts, size))
+	range_size = size / parts
+	if align > 1:
+		range_size = max(align, (range_size + align - 1) / align * align)
+		parts = max(1, min(parts, (size + range_size - 1) / range_size))
+	range_list = []
+	offset = 0
+	for i in range(parts):
+		length = range_size
+		if i == parts-1:
+			length = size - offset
+		range_list.append((offset, length))
+		offset += length
+	return range_list
+
+
+def split_entries(entry_list, weight_list):
+	"""
+	Share manifest entries between sources in proportion to weight_list,
+	largest first to the source which would finish it first. Returns a list of
+	entries for each source.
+	"""
+	share_list = [[] for weight in weight_list]
+	load_list = [0.0] * len(weight_list)
+	index_list = range(len(weight_list))
+	for entry in sorted(entry_list, key=lambda entry: entry.size, reverse=True):
+		index = min(index_list, key=lambda i: (load_list[i] + entry.size) / weight_list[i])
+		share_list[index].append(entry)
+		load_list[index] += entry.size
+	return share_list
+
+
+def pipelined_read(scp_client, remote_path, local_file, offset, length,
+			chunk_size, read_ahead, progress=None, throttle=None, hasher=None):
+	"""
+	Copy length bytes starting at offset from the remote file into local_file
+	at the same offset. Up to read_ahead requests of chunk_size are kept in
+	flight, so the transfer is not bound by one round trip per block. If given,
+	progress is called with the offset reached after each window is written,
+	throttle with the size of each window before it is requested, and the
+	StreamHash hasher is fed the data as it is written.
+	"""
+	end = offset + length
+	remote_file = scp_client.open(remote_path, 'rb')
+	try:
+		while offset < end:
+			chunk_list = []
+			window_end = offset
+			while window_end < end and len(chunk_list) < read_ahead:
+				size = min(chunk_size, end - window_end)
+				chunk_list.append((window_end, size))
+				window_end += size
+			if throttle:
+				throttle(window_end - offset)
+			local_file.seek(offset)
+			position = offset
+			for data in remote_file.readv(chunk_list):
+				local_file.write(data)
+				if hasher:
+					hasher.update(position, data)
+				position += len(data)
+			offset = window_end
+			if progress:
+				local_file.flush()
+				progress(offset)
+	finally:
+		remote_file.close()
+
+
+def pipelined_write(scp_client, local_path, remote_path, chunk_size, throttle=None):
+	"""
+	Copy a local file to remote_path. Writes are pipelined, sent without
+	waiting for each to be acknowledged, so the transfer is not bound by one
+	round trip per block; a failed write is raised when the file is closed.
+	throttle is called with the size of each block before it is sent.
+	"""
+	f_local = open(local_path, 'rb')
+	try:
+		remote_file = scp_client.open(remote_path, 'wb')
+		try:
+			remote_file.set_pipelined(True)
+			while(True):
+				data = f_local.read(chunk_size)
+				if not data:
+					break
+				if throttle:
+					throttle(len(data))
+				remote_file.write(data)
+		finally:
+			remote_file.close()
+	finally:
+		f_local.close()
+
+
+class PartialFile(object):
+	"""
+	A download in progress. Data is written to <dest>.part and the offset
+	reached in each byte range is recorded in <dest>.part.json, so an
+	interrupted download resumes where it stopped. The file is renamed into
+	place once complete.
+	"""
+
+	part_ext = '.part'
+	progress_ext = '.part.json'
+	save_interval = 1.0
+
+	def __init__(self, dest, size, mtime):
+		self.dest = dest
+		self.part_path = dest + self.part_ext
+		self.progress_path = dest + self.progress_ext
+		self.size = size
+		self.mtime = mtime
+		self.range_list = []
+		self.lock = threading.Lock()
+		self.last_save = 0
+
+	def open(self, parts, align=1):
+		"""
+		Resume an earlier attempt at the same remote file, or start a new one
+		split into parts ranges starting at multiples of align. Returns a list
+		of (index, offset, length) for the ranges still to fetch.
+		"""
+		if not self._load():
+			local_file = open(self.part_path, 'wb')
+			local_file.truncate(self.size)
+			local_file.close()
+			self.range_list = [[offset, offset+length, offset]
+					for offset, length in split_ranges(self.size, parts, align)]
+			self._save()
+		return [(index, done, end-done)
+				for index, (start, end, done) in enumerate(self.range_list) if done < end]
+
+	def advance(self, index, offset):
+		" Record that range index is complete up to offset "
+		self.lock.acquire()
+		try:
+			self.range_list[index][2] = offset
+			if time.time() - self.last_save > self.save_interval:
+				self._save()
+		finally:
+			self.lock.release()
+
+	def complete(self):
+		" Move the finished file into place and drop the progress record "
+		os.rename(self.part_path, self.dest)
+		# keep the remote mtime so a later sync can tell the file is unchanged
+		os.utime(self.dest, (self.mtime, self.mtime))
+		if os.path.exists(self.progress_path):
+			os.remove(self.progress_path)
+
+	def abort(self):
+		" Save the progress so a later attempt can resume "
+		self.lock.acquire()
+		try:
+			self._save()
+		finally:
+			self.lock.release()
+
+	def _load(self):
+		" Load progress from an earlier attempt, False if there is none to resume "
+		if not os.path.exists(self.part_path):
+			return False
+		try:
+			f_progress = open(self.progress_path)
+			progress = json.loads(f_progress.read())
+			f_progress.close()
+		except (IOError, ValueError):
+			return False
+		if progress.get('size') != self.size or progress.get('mtime') != self.mtime:
+			# remote file changed since the last attempt
+			return False
+		self.range_list = progress['ranges']
+		return True
+
+	def _save(self):
+		progress = {'size': self.size, 'mtime': self.mtime, 'ranges': self.range_list}
+		tmp_path = self.progress_path + '.tmp'
+		f_progress = open(tmp_path, 'w')
+		f_progress.write(json.dumps(progress))
+		f_progress.close()
+		os.rename(tmp_path, self.progress_path)
+		self.last_save = time.time()
+
+
+def download_file(conn_manager, scp_client, remote_path, dest, size, mtime, parts=1,
+			verify=False):
+	"""
+	Download a file through a .part file, resuming an earlier attempt if one
+	was interrupted. With parts > 1 the file is split into byte ranges, each
+	fetched with pipelined reads on its own sftp channel and written into place.
+	With verify the file is hashed as it arrives, and its content hash is
+	returned.
+	"""
+	site = conn_manager.remote_site
+	throttle = conn_manager.get_throttle()
+	partial = PartialFile(dest, size, mtime)
+	hasher = None
+	if verify:
+		hasher = StreamHash(size)
+		# ranges of whole blocks are hashed without reading them back
+		todo_list = partial.open(parts, BLOCK)
+	else:
+		todo_list = partial.open(parts)
+
+	error_list = []
+	def fetch_range(index, offset, length, range_client):
+		def progress(reached):
+			partial.advance(index, reached)
+		try:
+			range_file = open(partial.part_path, 'r+b')
+			try:
+				pipelined_read(range_client, remote_path, range_file, offset, length,
+						site.chunk_size, site.read_ahead, progress, throttle, hasher)
+			finally:
+				range_file.close()
+		except Exception, err:
+			error_list.append(err)
+
+	thread_list = []
+	client_list = []
+	try:
+		for index, offset, length in todo_list[1:]:
+			range_client = conn_manager.open_sftp()
+			client_list.append(range_client)
+			thread = threading.Thread(target=fetch_range,
+					args=(index, offset, length, range_client))
+			thread.setDaemon(True)
+			thread.start()
+			thread_list.append(thread)
+
+		# the first range is fetched on the caller's channel
+		if todo_list:
+			fetch_range(todo_list[0][0], todo_list[0][1], todo_list[0][2], scp_client)
+	except Exception, err:
+		error_list.append(err)
+	finally:
+		for thread in thread_list:
+			thread.join()
+		for range_client in client_list:
+			range_client.close()
+
+	if error_list:
+		partial.abort()
+		raise IOError("Failed to download %s: %s" % (remote_path, error_list[0]))
+	content_hash = None
+	if hasher:
+		content_hash = hasher.hexdigest(partial.part_path)
+	partial.complete()
+	return content_hash
+
+
+# formats which shrink on the wire, everything else is sent raw in content
+# aware mode since it is already compressed (mp3, flac, ogg, jpg, ...)
+compressible_ext = ['wav', 'aif', 'aiff', 'log', 'cue', 'txt', 'nfo', 'm3u',
+		'm3u8', 'sfv', 'md5', 'accurip', 'bmp', 'tif', 'tiff', 'xml', 'htm', 'html']
+
+
+def is_compressible(name):
+	" True if the file type is worth compressing for transfer "
+	return os.path.splitext(name)[1].lower().lstrip('.') in compressible_ext
+
+
+class CompressionStats(object):
+	" Byte counts and cpu cost of a compressed transfer "
+
+	def __init__(self, raw_bytes, wire_bytes, remote_cpu, local_cpu):
+		self.raw_bytes = raw_bytes
+		self.wire_bytes = wire_bytes
+		self.remote_cpu = remote_cpu
+		self.local_cpu = local_cpu
+
+	def ratio(self):
+		" Wire bytes as a fraction of the raw bytes "
+		return self.wire_bytes / float(max(self.raw_bytes, 1))
+
+	def __str__(self):
+		return "%.1f MB sent as %.1f MB (%.0f%%), remote cpu %.2fs, local cpu %.2fs" % (
+				self.raw_bytes / 1048576.0, self.wire_bytes / 1048576.0,
+				self.ratio() * 100, self.remote_cpu, self.local_cpu)
+
+
+class InflateReader(object):
+	" Reads a gzip stream as plain data, counting bytes and the time spent inflating "
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		self.wire_bytes = 0
+		self.raw_bytes = 0
+		self.inflate_time = 0.0
+
+	def read(self, size):
+		data_list = []
+		wanted = size
+		while wanted > 0:
+			compressed = self.inflater.unconsumed_tail
+			if not compressed:
+				compressed = self.stream.read(65536)
+				if not compressed:
+					break
+				self.wire_bytes += len(compressed)
+			start = time.time()
+			data = self.inflater.decompress(compressed, wanted)
+			self.inflate_time += time.time() - start
+			data_list.append(data)
+			wanted -= len(data)
+		data = ''.join(data_list)
+		self.raw_bytes += len(data)
+		return data
+
+
+# printed to stderr before the output of times
+TIMES_MARKER = '--mover-times--'
+
+
+def parse_times(line_list):
+	" Sum the child user and system cpu from the output of the shell times builtin "
+	cpu = 0.0
+	if not line_list:
+		return cpu
+	for minutes, seconds in re.findall(r'(\d+)m([\d.]+)s', line_list[-1]):
+		cpu += int(minutes) * 60 + float(seconds)
+	return cpu
+
+
+def copy_hashed(src, dest, hasher):
+	" Copy the file like object src to dest, feeding hasher "
+	offset = 0
+	while(True):
+		data = src.read(65536)
+		if not data:
+			break
+		dest.write(data)
+		hasher.update(offset, data)
+		offset += len(data)
+
+
+def pull_tar(ssh_client, remote_dir, dest, entry_list, compress_level=0, throttle=None,
+			file_done=None, hash_done=None):
+	"""
+	Pull the manifest entries in entry_list from remote_dir into dest as a
+	single tar stream, extracting each file as it arrives. Saves the per file
+	open/stat/close of sftp on albums with many small files.
+
+	With a compress_level the stream is gzipped on the remote, and a
+	CompressionStats for the transfer is returned. If given, throttle is
+	called with the size of each read from the stream, and file_done with the
+	time each file started arriving once it is in place. With hash_done each
+	file is hashed as it is extracted, and hash_done is called with its path
+	and content hash.
+	"""
+	command = "tar cf - -C %s --null -T -" % (shell_quote(remote_dir))
+	if compress_level:
+		# a pipeline exits with the status of gzip, so tar's is passed out on
+		# fd 4, and the output of times follows a marker line on stderr
+		command = ("exec 3>&1; s=$( { { %s; echo $? >&4; } | gzip -%d >&3; } 4>&1 ); "
+				"echo %s >&2; times >&2; exit ${s:-1}" % (command, compress_level,
+				TIMES_MARKER))
+	stdin, stdout, stderr = ssh_client.exec_command(command)
+	def send_names():
+		for entry in entry_list:
+			stdin.write(entry.path + '\0')
+		stdin.flush()
+		stdin.channel.shutdown_write()
+	sender = threading.Thread(target=send_names)
+	sender.setDaemon(True)
+	sender.start()
+
+	stream = stdout
+	if throttle:
+		stream = ThrottledReader(stream, throttle)
+	if compress_level:
+		stream = InflateReader(stream)
+	tar = tarfile.open(fileobj=stream, mode='r|')
+	try:
+		for member in tar:
+			path = os.path.normpath(member.name)
+			if os.path.isabs(path) or path.startswith('..'):
+				continue
+			target = os.path.join(dest, path)
+			if member.isdir():
+				if not os.path.isdir(target):
+					os.makedirs(target)
+				continue
+			if not member.isfile():
+				continue
+			if not os.path.isdir(os.path.dirname(target)):
+				os.makedirs(os.path.dirname(target))
+			# same .part then rename as the sftp path
+			start = time.time()
+			part_path = target + PartialFile.part_ext
+			f_part = open(part_path, 'wb')
+			try:
+				if hash_done:
+					hasher = StreamHash(member.size)
+					copy_hashed(tar.extractfile(member), f_part, hasher)
+				else:
+					shutil.copyfileobj(tar.extractfile(member), f_part, 65536)
+			finally:
+				f_part.close()
+			if hash_done:
+				hash_done(path, hasher.hexdigest(part_path))
+			os.rename(part_path, target)
+			os.utime(target, (member.mtime, member.mtime))
+			if file_done:
+				file_done(start)
+	finally:
+		tar.close()
+	sender.join()
+	status = stdout.channel.recv_exit_status()
+	error_list = [line.rstrip() for line in stderr.readlines()]
+	cpu_lines = []
+	if TIMES_MARKER in error_list:
+		index = error_list.index(TIMES_MARKER)
+		cpu_lines, error_list = error_list[index+1:], error_list[:index]
+	if status != 0:
+		raise IOError("tar failed on %s: %s" % (remote_dir, " ".join(error_list)))
+	if compress_level:
+		return CompressionStats(stream.raw_bytes, stream.wire_bytes,
+				parse_times(cpu_lines), stream.inflate_time)
@@ -0,0 +1,150 @@
+"""
+ Transfer verification for Music Mover.
+
+ A file's content hash is the md5 of the md5 digests of its 1MB blocks.
+ Blocks let the ranges of a file pulled over several channels be hashed as
+ they stream in, each in its own order, with no second read of the file.
+ The remote hashes are computed by a script run with exec_command while
+ the album is being pulled.
+"""
+
+import hashlib
+import threading
+
+from delta import python_command
+from manifest import read_nul_records
+
+
+BLOCK = 1024 * 1024
+
+# Runs on the remote host under python 2 or 3. Reads file paths, NUL
+# separated, on stdin and writes "<path>\t<size>\t<content hash>\0" for each
+# as it is hashed. argv is the block size.
+REMOTE_SCRIPT = r'''
+import sys, hashlib
+inp = getattr(sys.stdin, "buffer", sys.stdin)
+out = getattr(sys.stdout, "buffer", sys.stdout)
+block = int(sys.argv[1])
+for path in inp.read().split(b"\0"):
+    if not path:
+        continue
+    whole = hashlib.md5()
+    size = 0
+    try:
+        f = open(path, "rb")
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            size += len(data)
+            whole.update(hashlib.md5(data).digest())
+        f.close()
+    except (IOError, OSError):
+        continue
+    out.write(path + b"\t" + str(size).encode("ascii") + b"\t" +
+            whole.hexdigest().encode("ascii") + b"\0")
+    out.flush()
+'''
+
+
+class StreamHash(object):
+	"""
+	The content hash of a file, computed from its data as it is written.
+	Each range must be fed in order, ranges may be fed from several threads.
+	Blocks not fed whole and in order, like those split between two ranges
+	or written by an earlier attempt, are read back from the file.
+	"""
+
+	def __init__(self, size):
+		self.size = size
+		self.lock = threading.Lock()
+		self.digest_map = {}
+		# block index to (md5, bytes fed) of blocks being fed
+		self.partial_map = {}
+
+	def update(self, offset, data):
+		" Feed data written at offset "
+		self.lock.acquire()
+		try:
+			while data:
+				index = offset / BLOCK
+				block_end = min((index + 1) * BLOCK, self.size)
+				md5, fed = self.partial_map.pop(index, (None, 0))
+				take = block_end - offset
+				if md5 is None and offset == index * BLOCK:
+					md5 = hashlib.md5()
+				if md5 is not None and offset == index * BLOCK + fed:
+					md5.update(data[:take])
+					fed += len(data[:take])
+					if index * BLOCK + fed == block_end:
+						self.digest_map[index] = md5.digest()
+					else:
+						self.partial_map[index] = (md5, fed)
+				# else the block is read back by hexdigest
+				offset += take
+				data = data[take:]
+		finally:
+			self.lock.release()
+
+	def hexdigest(self, path):
+		" The content hash, reading back from path the blocks which were not fed "
+		whole = hashlib.md5()
+		f_local = None
+		try:
+			for index in range((self.size + BLOCK - 1) / BLOCK):
+				if index not in self.digest_map:
+					if f_local is None:
+						f_local = open(path, 'rb')
+					f_local.seek(index * BLOCK)
+					self.digest_map[index] = hashlib.md5(f_local.read(BLOCK)).digest()
+				whole.update(self.digest_map[index])
+		finally:
+			if f_local:
+				f_local.close()
+		return whole.hexdigest()
+
+
+class RemoteHashes(object):
+	"""
+	The content hashes of remote files, computed in the background. The
+	remote script hashes the files in the order given, so it keeps ahead of
+	a transfer pulling them in the same order.
+	"""
+
+	def __init__(self, ssh_client, path_list):
+		self.hash_map = {}
+		self.error = None
+		self.stdin, self.stdout, self.stderr = ssh_client.exec_command(
+				python_command(REMOTE_SCRIPT, [str(BLOCK)]))
+		self.thread = threading.Thread(target=self._read, args=(path_list,))
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def _read(self, path_list):
+		try:
+			self.stdin.write("\0".join(path_list))
+			self.stdin.flush()
+			self.stdin.channel.shutdown_write()
+			for record in read_nul_records(self.stdout):
+				part_list = record.rsplit('\t', 2)
+				if len(part_list) == 3:
+					self.hash_map[part_list[0]] = (int(part_list[1]), part_list[2])
+			if self.stdout.channel.recv_exit_status() != 0 and not self.hash_map:
+				self.stdout.channel.close()
+				self.error = "Remote hashes failed: %s" % (self.stderr.read().strip())
+		except Exception, err:
+			self.error = "Remote hashes failed: %s" % (err)
+
+	def close(self):
+		" Stop the remote script, if it is still hashing "
+		self.stdout.channel.close()
+
+	def wait(self):
+		"""
+		Return a map of remote path to (size, content hash) once every file is
+		hashed. Raises IOError if none could be.
+		"""
+		self.thread.join()
+		if self.error:
+			raise IOError(self.error)
+		return self.hash_map
@@ -56,44 +56,32 @@ class Input(object):
 			return (values[0], option)
 
 	@staticmethod
-	def action_list_input(item_list, action_list):
+	def browser_input(browser, action_list):
+		"""
+		Get an action for an AlbumBrowser. Returns ('>', None) or ('<', None)
+		to turn the page, and ('/', None) or ('^', None) once the filter is
+		set, else the action and the album numbers selected.
+		"""
 		while(True):
-			action = raw_input(Color.make(Color.blue, "Enter Action: "))
+			action = raw_input(Color.make(Color.blue, "Enter Action: ")).strip()
+			if action in ('', '>'):
+				return '>', None
+			if action == '<':
+				return '<', None
+			if action[0] in ('/', '^'):
+				browser.set_filter(action[1:], prefix=(action[0] == '^'))
+				return action[0], None
 			values = action.split()
 			if values[0] not in action_list:
 				print Color.make(Color.lred, "Invalid action %s (try %s)" % (values[0], action_list))
 				continue
 			if len(values) < 2:
 				return values[0], []
+			try:
+				return values[0], browser.select(values[1])
+			except ValueError, err:
+				print Color.make(Color.lred, "Invalid selection: %s" % (err))
 
-			index_list = []
-			# split up sections
-			for index_range in values[1].split(','):
-				if '-' not in index_range:
-					# parse singles
-					try:
-						option = int(index_range)
-						index_list.append(option)
-					except ValueError, err:
-						print Color.make(Color.lred, "Not a number %s." % (index_range))
-						break
-				else:
-					# parse ranges
-					try:
-						min, max = map(int, index_range.split('-'))
-						index_list.extend(range(min, max+1))
-					except ValueError, err:
-						print Color.make(Color.lred, "Invalid range, or not a number %s." % (err))
-						break
-			else:
-				for index in index_list:
-					if index < 1 or index > len(item_list)-1:
-						print Color.make(Color.lred, "Selection (%d) out of range (%d - %d)." % (index, 1, len(item_list)-1))
-						break
-				else:
-					return values[0], index_list
-	
-		
 	@staticmethod
 	def menu_input(item_list, min_option=1):
 		" Get the input, and make sure it is in range "
@@ -127,6 +115,10 @@ class Input(object):
 	def prompt_add_remote_dir():
 		return raw_input(Color.make(Color.blue, "Directory name: "))
 
+	@staticmethod
+	def prompt_remote_file():
+		return raw_input(Color.make(Color.blue, "Remote file or album to download: "))
+
 
 	@staticmethod
 	def site_data():
@@ -150,6 +142,47 @@ class Input(object):
 			break
 		return (True, data)
 
+	@staticmethod
+	def prompt_setting(desc, value):
+		new_value = raw_input(Color.make(Color.blue, "Enter a new value for %s [%s]: " % (desc, value)))
+		if len(new_value) == 0:
+			return value
+		return new_value
+
+	@staticmethod
+	def prompt_number(prompt, min_value, max_value):
+		" Prompt for a number in range, None on blank input "
+		while(True):
+			value = raw_input(Color.make(Color.blue, prompt))
+			if len(value) == 0:
+				return None
+			try:
+				value = int(value)
+			except ValueError, err:
+				print Color.make(Color.lred, "Not a number.")
+				continue
+			if value < min_value or value > max_value:
+				print Color.make(Color.lred, "Out of range (%d - %d)." % (min_value, max_value))
+				continue
+			return value
+
+	@staticmethod
+	def prompt_profile():
+		profile = {}
+		for key, prompt, max_value in [
+				('start', "Start hour (0-23): ", 23),
+				('end', "End hour (0-23): ", 23),
+				('rate', "Rate limit in KB/s (0 for none): ", 1048576)]:
+			value = Input.prompt_number(prompt, 0, max_value)
+			if value is None:
+				return None
+			profile[key] = value
+		return profile
+
+	@staticmethod
+	def prompt_rate():
+		return Input.prompt_number("Global rate limit in KB/s (0 for none): ", 0, 1048576)
+
 	@staticmethod
 	def prompt_pass():
 		return getpass.getpass(Color.make(Color.lblue, "Password: "))
@@ -171,6 +204,8 @@ class Menu(object):
 	" Display Menu to the user "
 
 	split_size = 50
+	# returns a status line shown under each menu, set by the controller
+	status_source = None
 
 	@staticmethod
 	def _display_menu(item_list, star_index=-1):
@@ -205,6 +240,10 @@ class Menu(object):
 
 		# footer
 		print Color.make(Color.yellow, " " * 4 + ". " * 38)
+		if Menu.status_source:
+			status = Menu.status_source()
+			if status:
+				print Color.make(Color.green, " " * 4 + status)
 
 	@staticmethod
 	def main():
@@ -214,6 +253,8 @@ class Menu(object):
 			'Main Menu',
 			'Remote Sites menu (Move music)',
 			'Local music menu',
+			'Bandwidth menu',
+			'All sites catalog (Move music)',
 			'Exit'
 		]
 		Menu._display_menu(menu)
@@ -255,22 +296,136 @@ class Menu(object):
 						site.hostname, site.port, len(site.get_dir_list()), len(site.blocked_album_list)))
 		Menu._display_menu(menu)
 		print Color.make(Color.lblue, "Enter the action (n: new site, m: move music, "
-					"d: del site, l: dir menu, b: block menu), or q to return.")
-		return Input.action_input(menu, ['n', 'd', 'm', 'l', 'b', 'q'])
+					"p: push music, d: del site, l: dir menu, b: block menu, s: settings), "
+					"or q to return.")
+		return Input.action_input(menu, ['n', 'd', 'm', 'p', 'l', 'b', 's', 'q'])
+
+	@staticmethod
+	def display_settings(setting_list):
+		menu = ['Site Settings']
+		for name, desc, value in setting_list:
+			menu.append("%-30s %s" % (desc, value))
+		Menu._display_menu(menu)
+		print Color.make(Color.lblue, "Enter the action (e: edit setting, t: test download speed) "
+					"or q to return.")
+		return Input.action_input(menu, ['e', 't', 'q'])
 		
 
 	@staticmethod
-	def display_album_list(album_list):
-		if len(album_list) == 0:
-			menu = ["No albums."]
+	def _browse(title, browser, label, help_list, action_list):
+		" Page through an AlbumBrowser until an action is entered "
+		while(True):
+			Menu._display_page(title, browser, label)
+			for help in help_list:
+				print Color.make(Color.lblue, help)
+			print Color.make(Color.lblue, "Enter > or < to turn the page, /text to show albums "
+						"containing text, ^text for those starting with it, / to show all.")
+			action, number_list = Input.browser_input(browser, action_list)
+			if action == '>':
+				browser.next_page()
+			elif action == '<':
+				browser.prev_page()
+			elif action in ('/', '^'):
+				continue
+			else:
+				return action, number_list
+
+	@staticmethod
+	def _display_page(title, browser, label=None):
+		" Display the current page of an AlbumBrowser, label formats an album "
+		if browser.filter:
+			title = "%s, %s '%s'" % (title, browser.prefix and "starting with" or "containing",
+					browser.filter)
+		text = "\n    [```  %s  ```]  " % (title)
+		print Color.make(Color.yellow, text + ". " * max(0, (80-len(text))/2))
+		item_list = browser.page_items()
+		if not item_list:
+			print Color.make(Color.lgray, "  No albums.")
+		for number, album in item_list:
+			if label:
+				album = label(album)
+			print Color.make(Color.lgray, "  %5d. %s" % (number, album))
+		print Color.make(Color.yellow, " " * 4 + ". " * 38)
+		print Color.make(Color.yellow, "    page %d of %d, %d album(s)" % (browser.page + 1,
+				browser.page_count(), len(browser.view)))
+		if Menu.status_source:
+			status = Menu.status_source()
+			if status:
+				print Color.make(Color.green, " " * 4 + status)
+
+	@staticmethod
+	def display_album_list(browser, local_set=(), match_map={}):
+		def label(album):
+			if album in local_set:
+				return "%s (sync)" % (album)
+			if album in match_map:
+				return "%s (local? %s)" % (album, match_map[album])
+			return album
+		help_list = []
+		if local_set:
+			help_list.append("Albums marked (sync) are local, moving them fetches only changed files.")
+		if match_map:
+			help_list.append("Albums marked (local?) are like a local album, with the match score.")
+		help_list.append("Enter the action (b: block, m: move, u: move urgently, "
+					"r: refresh listing) [ex: m 1,3-5] or q to return.")
+		return Menu._browse('Album List', browser, label, help_list, ['b','m','u','r','q'])
+
+	@staticmethod
+	def display_push_list(browser, remote_dir, match_map={}):
+		def label(album):
+			if album in match_map:
+				return "%s (on site? %s)" % (album, match_map[album])
+			return album
+		help_list = [
+			"Albums are pushed to %s." % (remote_dir),
+		]
+		if match_map:
+			help_list.append("Albums marked (on site?) are like an album on the site, "
+					"with the match score.")
+		help_list += [
+			"Enter the action (p: push, u: push urgently, "
+					"r: refresh listing) [ex: p 1,3-5] or q to return.",
+		]
+		return Menu._browse('Local albums missing from the site', browser, label, help_list,
+				['p','u','r','q'])
+
+	@staticmethod
+	def display_catalog(browser, site_names, match_map={}):
+		" site_names returns the names of the sites with an album "
+		def label(album):
+			label = "%s [%s]" % (album, ", ".join(site_names(album)))
+			if album in match_map:
+				label = "%s (local? %s)" % (label, match_map[album])
+			return label
+		help_list = [
+			"Albums move from the fastest site, s shares the files between every site "
+					"with the album.",
+		]
+		if match_map:
+			help_list.append("Albums marked (local?) are like a local album, with the match score.")
+		help_list += [
+			"Enter the action (b: block, m: move, u: move urgently, "
+					"s: move from every site, r: refresh listing) [ex: m 1,3-5] or q to return.",
+		]
+		return Menu._browse('Catalog of all sites', browser, label, help_list,
+				['b','m','u','s','r','q'])
+
+	@staticmethod
+	def display_bandwidth(profile_list, global_rate):
+		if len(profile_list) == 0:
+			menu = ["No bandwidth profiles"]
 		else:
-			menu = ['Album List']
-			menu.extend(album_list)
+			menu = ['Bandwidth Profiles']
+			for profile in profile_list:
+				menu.append("%02d:00 - %02d:00  %d KB/s" % (profile['start'], profile['end'],
+						profile['rate']))
 		Menu._display_menu(menu)
-		print Color.make(Color.lblue, "Enter the action (b: block, m: move) [ex: m 1,3-5] or q to return.")
-		return Input.action_list_input(menu, ['b','m','q'])
+		print Color.make(Color.lblue, "Global limit outside profiles: %s" % (
+					global_rate and "%d KB/s" % (global_rate) or "none"))
+		print Color.make(Color.lblue, "Enter the action (a: add profile, d: delete, "
+					"g: set global limit) or q to return.")
+		return Input.action_input(menu, ['a', 'd', 'g', 'q'])
 
-	
 	@staticmethod
 	def display_blocks(block_list):
 		if len(block_list) == 0:
@@ -0,0 +1,164 @@
+"""
+ Parallel local directory walker for Music Mover.
+"""
+
+import os
+import Queue
+import threading
+from stat import S_ISDIR
+
+# scandir gives the entry type from the directory listing itself, so sub
+# directories are found without a stat per entry
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+def list_dir(path):
+	" Return (names, sub directory names) of the entries in path "
+	name_list = []
+	dir_list = []
+	if scandir:
+		for entry in scandir(path):
+			name_list.append(entry.name)
+			try:
+				if entry.is_dir():
+					dir_list.append(entry.name)
+			except OSError:
+				continue
+		return name_list, dir_list
+
+	name_list = os.listdir(path)
+	for name in name_list:
+		try:
+			if S_ISDIR(os.stat(os.path.join(path, name)).st_mode):
+				dir_list.append(name)
+		except OSError:
+			# a dangling link
+			continue
+	return name_list, dir_list
+
+
+class DirNode(object):
+	" A directory found by the walker "
+
+	def __init__(self, path, parent, root, depth):
+		self.path = path
+		self.parent = parent
+		self.root = root
+		self.depth = depth
+		self.mtime = None
+		self.partial = False
+		self.child_list = []
+		# listed on this walk, rather than taken from known
+		self.scanned = False
+		self.error = None
+
+
+class AlbumWalker(object):
+	"""
+	Walk directory trees down to max_depth with a pool of threads, each
+	directory is a separate job so a large tree is spread over every worker.
+	Directories below the roots are albums unless they hold the partial
+	marker, which also stops the walk into them.
+
+	known is an optional map of path to (mtime, partial, child paths) from an
+	earlier walk. A directory with an unchanged mtime is not listed again.
+	Directories which could not be read are collected in error_list as
+	(path, error) rather than stopping the walk.
+	"""
+
+	def __init__(self, max_depth, partial_marker, workers=8, known=None):
+		self.max_depth = max_depth
+		self.partial_marker = partial_marker
+		self.workers = max(1, workers)
+		self.known = known
+		self.node_list = []
+		self.error_list = []
+		self.lock = threading.Lock()
+		self.queue = Queue.Queue()
+
+	def walk(self, root_list):
+		" Walk every root, returns the list of DirNode found "
+		self.node_list = []
+		self.error_list = []
+		for root in root_list:
+			self.queue.put(DirNode(root, None, root, 0))
+
+		thread_list = []
+		for i in range(self.workers):
+			thread = threading.Thread(target=self._work)
+			thread.setDaemon(True)
+			thread.start()
+			thread_list.append(thread)
+		self.queue.join()
+		for thread in thread_list:
+			self.queue.put(None)
+		for thread in thread_list:
+			thread.join()
+		return self.node_list
+
+	def album_list(self):
+		" Paths of the albums found by the last walk "
+		return sorted([node.path for node in self.node_list
+				if node.depth > 0 and not node.partial and not node.error])
+
+	def _work(self):
+		while(True):
+			node = self.queue.get()
+			if node is None:
+				return
+			try:
+				self._walk_node(node)
+			finally:
+				self.queue.task_done()
+
+	def _walk_node(self, node):
+		try:
+			self._visit(node)
+		except OSError, err:
+			node.error = err
+			self.lock.acquire()
+			try:
+				self.error_list.append((node.path, str(err)))
+			finally:
+				self.lock.release()
+		self.lock.acquire()
+		try:
+			self.node_list.append(node)
+		finally:
+			self.lock.release()
+		if node.partial or node.error:
+			return
+		for child in node.child_list:
+			child_node = DirNode(child, node.path, node.root, node.depth+1)
+			if child_node.depth >= self.max_depth:
+				# the bottom level is only a stat each, not worth a job
+				self._walk_node(child_node)
+			else:
+				self.queue.put(child_node)
+
+	def _visit(self, node):
+		if self.known is not None:
+			node.mtime = os.stat(node.path).st_mtime
+			if node.path in self.known:
+				mtime, partial, child_list = self.known[node.path]
+				if mtime == node.mtime:
+					node.partial = partial
+					node.child_list = child_list
+					return
+
+		node.scanned = True
+		if node.depth >= self.max_depth:
+			# only the marker matters, the album itself is not searched
+			node.partial = os.path.exists(os.path.join(node.path, self.partial_marker))
+			return
+		name_list, dir_list = list_dir(node.path)
+		if node.depth > 0 and self.partial_marker in name_list:
+			node.partial = True
+			return
+		node.child_list = [os.path.join(node.path, name) for name in dir_list]
@@ -0,0 +1,223 @@
+"""
+ Live local album cache for Music Mover, using inotify on Linux.
+"""
+
+import os
+import sys
+import errno
+import Queue
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+from walker import list_dir
+from view import Message
+
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+# wd, mask, cookie, length of the name which follows
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_libc():
+	" Return libc if it has inotify, or None "
+	if not sys.platform.startswith('linux'):
+		return None
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	except OSError:
+		return None
+	if not hasattr(libc, 'inotify_init'):
+		return None
+	return libc
+
+
+class Inotify(object):
+	" A thin wrapper around an inotify file descriptor "
+
+	def __init__(self, libc):
+		self.libc = libc
+		self.fd = libc.inotify_init()
+		if self.fd < 0:
+			self._raise("inotify")
+
+	def add_watch(self, path, mask):
+		wd = self.libc.inotify_add_watch(self.fd, path, mask)
+		if wd < 0:
+			self._raise(path)
+		return wd
+
+	def rm_watch(self, wd):
+		self.libc.inotify_rm_watch(self.fd, wd)
+
+	def read_events(self, timeout):
+		" Return a list of (wd, mask, name), empty if none came within timeout "
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		data = os.read(self.fd, 65536)
+		event_list = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = data[offset:offset+length].rstrip('\0')
+			offset += length
+			event_list.append((wd, mask, name))
+		return event_list
+
+	def close(self):
+		os.close(self.fd)
+
+	def _raise(self, path):
+		code = ctypes.get_errno()
+		raise OSError(code, os.strerror(code), path)
+
+
+class AlbumWatcher(object):
+	"""
+	Watch the local music dirs down to max_depth with inotify and turn the
+	events into album changes. Changes are queued as ('add', path),
+	('remove', path) for an album and everything below it, or ('refresh',
+	None) when events were lost, and are read with changes() by the owner of
+	the album cache, so the cache is only touched from one thread.
+	"""
+
+	def __init__(self, root_list, max_depth, partial_marker):
+		self.root_list = list(root_list)
+		self.max_depth = max_depth
+		self.partial_marker = partial_marker
+		self.change_queue = Queue.Queue()
+		self.wd_map = {}
+		self.path_map = {}
+		self.running = False
+		self.thread = None
+		self.inotify = None
+
+	def start(self):
+		" Start watching, returns False if inotify is not available "
+		libc = load_libc()
+		if libc is None:
+			return False
+		self.inotify = Inotify(libc)
+		self.running = True
+		self.thread = threading.Thread(target=self._run)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return True
+
+	def stop(self):
+		self.running = False
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+	def is_alive(self):
+		return self.running
+
+	def changes(self):
+		" Return the changes queued since the last call "
+		change_list = []
+		while(True):
+			try:
+				change_list.append(self.change_queue.get_nowait())
+			except Queue.Empty:
+				return change_list
+
+	def _run(self):
+		try:
+			try:
+				for root in self.root_list:
+					self._watch_tree(root, 0, False)
+				while self.running:
+					for wd, mask, name in self.inotify.read_events(1.0):
+						self._handle(wd, mask, name)
+			except OSError, err:
+				if err.errno == errno.ENOSPC:
+					Message.err("Too many directories to watch, raise "
+							"fs.inotify.max_user_watches. Album watcher stopped.")
+				else:
+					Message.err("Album watcher stopped: %s" % (err))
+		finally:
+			self.running = False
+			self.inotify.close()
+
+	def _watch_tree(self, path, depth, announce):
+		"""
+		Watch path and the directories below it. New albums are queued when
+		announce is set, the initial albums come from a refresh.
+		"""
+		try:
+			wd = self.inotify.add_watch(path, WATCH_MASK)
+		except OSError, err:
+			if err.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+				return
+			raise
+		self.wd_map[wd] = (path, depth)
+		self.path_map[path] = wd
+		# listed after the watch is added, so nothing created between is lost
+		try:
+			name_list, dir_list = list_dir(path)
+		except OSError:
+			return
+		if depth > 0 and self.partial_marker in name_list:
+			return
+		if depth > 0 and announce:
+			self.change_queue.put(('add', path))
+		if depth >= self.max_depth:
+			return
+		for name in dir_list:
+			self._watch_tree(os.path.join(path, name), depth+1, announce)
+
+	def _unwatch_tree(self, path, keep_top=False):
+		for watched in self.path_map.keys():
+			if watched == path and keep_top:
+				continue
+			if watched == path or watched.startswith(path + os.sep):
+				wd = self.path_map.pop(watched)
+				self.wd_map.pop(wd, None)
+				self.inotify.rm_watch(wd)
+
+	def _handle(self, wd, mask, name):
+		if mask & IN_Q_OVERFLOW:
+			self.change_queue.put(('refresh', None))
+			return
+		if mask & IN_IGNORED:
+			# the directory itself is gone
+			if wd in self.wd_map:
+				path, depth = self.wd_map.pop(wd)
+				if self.path_map.get(path) == wd:
+					del self.path_map[path]
+			return
+		if wd not in self.wd_map:
+			return
+		parent, depth = self.wd_map[wd]
+		path = os.path.join(parent, name)
+
+		if name == self.partial_marker and not mask & IN_ISDIR and depth > 0:
+			if mask & (IN_CREATE | IN_MOVED_TO):
+				# a pull started, the album is not whole until it is removed
+				self._unwatch_tree(parent, keep_top=True)
+				self.change_queue.put(('remove', parent))
+			else:
+				self._watch_tree(parent, depth, True)
+			return
+
+		if not mask & IN_ISDIR or depth >= self.max_depth:
+			return
+		if mask & (IN_CREATE | IN_MOVED_TO):
+			self._watch_tree(path, depth+1, True)
+		elif mask & (IN_DELETE | IN_MOVED_FROM):
+			self._unwatch_tree(path)
+			self.change_queue.put(('remove', path))
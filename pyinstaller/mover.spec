@@ -6,7 +6,24 @@ a = Analysis([
 	os.path.join(HOMEPATH,'support/useUnicode.py'), 
 	PROJ_HOME + '/bin/mover.py', 
 	PROJ_HOME + '/bin/models.py', 
-	PROJ_HOME + '/bin/view.py'],
+	PROJ_HOME + '/bin/view.py',
+	PROJ_HOME + '/bin/transfer.py',
+	PROJ_HOME + '/bin/manifest.py',
+	PROJ_HOME + '/bin/delta.py',
+	PROJ_HOME + '/bin/pool.py',
+	PROJ_HOME + '/bin/scheduler.py',
+	PROJ_HOME + '/bin/stats.py',
+	PROJ_HOME + '/bin/index.py',
+	PROJ_HOME + '/bin/walker.py',
+	PROJ_HOME + '/bin/watcher.py',
+	PROJ_HOME + '/bin/matcher.py',
+	PROJ_HOME + '/bin/listing.py',
+	PROJ_HOME + '/bin/catalog.py',
+	PROJ_HOME + '/bin/fingerprint.py',
+	PROJ_HOME + '/bin/store.py',
+	PROJ_HOME + '/bin/sync.py',
+	PROJ_HOME + '/bin/browser.py',
+	PROJ_HOME + '/bin/verify.py'],
              pathex=['/home/daniel/media/software/pyinstaller'],
 			 hookspath=['PROJ_HOME' + '/pyinstaller'])
 pyz = PYZ(a.pure)
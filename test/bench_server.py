@@ -0,0 +1,279 @@
+"""
+ An in-process ssh server for the Music Mover benchmarks.
+
+ Serves sftp and exec requests for the local filesystem on localhost, with
+ any password accepted. Exec requests run under sh, like on a remote host.
+ A LinkShaper in front of the server adds latency and a bandwidth limit to
+ every connection through it.
+"""
+
+import os
+import time
+import Queue
+import socket
+import threading
+import subprocess
+import paramiko
+
+
+class BenchServer(paramiko.ServerInterface):
+	" Accepts every password, and runs exec requests with sh "
+
+	def get_allowed_auths(self, username):
+		return 'password'
+
+	def check_auth_password(self, username, password):
+		return paramiko.AUTH_SUCCESSFUL
+
+	def check_channel_request(self, kind, chanid):
+		if kind == 'session':
+			return paramiko.OPEN_SUCCEEDED
+		return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+	def check_channel_exec_request(self, channel, command):
+		thread = threading.Thread(target=run_command, args=(channel, command))
+		thread.setDaemon(True)
+		thread.start()
+		return True
+
+
+def run_command(channel, command):
+	" Run command, with its stdin, stdout and stderr on channel "
+	proc = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	def feed():
+		try:
+			while(True):
+				data = channel.recv(32768)
+				if not data:
+					break
+				proc.stdin.write(data)
+			proc.stdin.close()
+		except (IOError, OSError, socket.error):
+			pass
+	def drain_stderr():
+		while(True):
+			data = os.read(proc.stderr.fileno(), 32768)
+			if not data:
+				break
+			channel.sendall_stderr(data)
+	thread_list = []
+	for target in (feed, drain_stderr):
+		thread = threading.Thread(target=target)
+		thread.setDaemon(True)
+		thread.start()
+		thread_list.append(thread)
+	try:
+		while(True):
+			data = os.read(proc.stdout.fileno(), 32768)
+			if not data:
+				break
+			channel.sendall(data)
+		thread_list[1].join()
+	except socket.error:
+		proc.kill()
+	status = proc.wait()
+	if status < 0:
+		# killed by a signal, reported like a shell does
+		status = 128 - status
+	try:
+		channel.send_exit_status(status)
+	except socket.error:
+		pass
+	channel.close()
+
+
+class LocalHandle(paramiko.SFTPHandle):
+
+	def stat(self):
+		try:
+			return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+	def chattr(self, attr):
+		try:
+			paramiko.SFTPServer.set_file_attr(self.filename, attr)
+			return paramiko.SFTP_OK
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+	" Serves the local filesystem, paths are the same as local paths "
+
+	def list_folder(self, path):
+		path = self.canonicalize(path)
+		try:
+			attr_list = []
+			for name in os.listdir(path):
+				attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+				attr.filename = name
+				attr_list.append(attr)
+			return attr_list
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+	def stat(self, path):
+		try:
+			return paramiko.SFTPAttributes.from_stat(os.stat(self.canonicalize(path)))
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+	def lstat(self, path):
+		try:
+			return paramiko.SFTPAttributes.from_stat(os.lstat(self.canonicalize(path)))
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+
+	def open(self, path, flags, attr):
+		path = self.canonicalize(path)
+		try:
+			fd = os.open(path, flags, getattr(attr, 'st_mode', None) or 0666)
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		if flags & os.O_WRONLY:
+			mode = 'wb'
+		elif flags & os.O_RDWR:
+			mode = 'r+b'
+		else:
+			mode = 'rb'
+		handle = LocalHandle(flags)
+		handle.filename = path
+		handle.readfile = handle.writefile = os.fdopen(fd, mode)
+		return handle
+
+	def _call(self, func, *path_list):
+		try:
+			func(*[self.canonicalize(path) for path in path_list])
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		return paramiko.SFTP_OK
+
+	def remove(self, path):
+		return self._call(os.remove, path)
+
+	def rename(self, oldpath, newpath):
+		if os.path.exists(self.canonicalize(newpath)):
+			return paramiko.SFTP_FAILURE
+		return self._call(os.rename, oldpath, newpath)
+
+	def mkdir(self, path, attr):
+		return self._call(os.mkdir, path)
+
+	def rmdir(self, path):
+		return self._call(os.rmdir, path)
+
+	def chattr(self, path, attr):
+		try:
+			paramiko.SFTPServer.set_file_attr(self.canonicalize(path), attr)
+		except OSError, err:
+			return paramiko.SFTPServer.convert_errno(err.errno)
+		return paramiko.SFTP_OK
+
+
+class SSHServer(object):
+	" An ssh server on a free localhost port, serving until stopped "
+
+	def __init__(self):
+		self.host_key = paramiko.RSAKey.generate(1024)
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(16)
+		self.port = self.sock.getsockname()[1]
+		self.transport_list = []
+		thread = threading.Thread(target=self._accept)
+		thread.setDaemon(True)
+		thread.start()
+
+	def _accept(self):
+		while(True):
+			try:
+				client, addr = self.sock.accept()
+			except socket.error:
+				return
+			transport = paramiko.Transport(client)
+			transport.add_server_key(self.host_key)
+			transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPServer)
+			transport.start_server(server=BenchServer())
+			self.transport_list.append(transport)
+
+	def stop(self):
+		self.sock.close()
+		for transport in self.transport_list:
+			transport.close()
+
+
+class LinkShaper(object):
+	"""
+	A tcp proxy to port on a free localhost port. Data in each direction is
+	held for half the round trip latency (seconds) and sent no faster than
+	bandwidth (bytes per second, 0 for no limit).
+	"""
+
+	def __init__(self, port, latency=0, bandwidth=0):
+		self.target_port = port
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(16)
+		self.port = self.sock.getsockname()[1]
+		thread = threading.Thread(target=self._accept)
+		thread.setDaemon(True)
+		thread.start()
+
+	def _accept(self):
+		while(True):
+			try:
+				client, addr = self.sock.accept()
+			except socket.error:
+				return
+			server = socket.create_connection(('127.0.0.1', self.target_port))
+			for sock in (client, server):
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self._pipe(client, server)
+			self._pipe(server, client)
+
+	def _pipe(self, src, dest):
+		" Move data from src to dest, late and throttled "
+		queue = Queue.Queue()
+		def read():
+			while(True):
+				try:
+					data = src.recv(65536)
+				except socket.error:
+					data = ''
+				queue.put((time.time() + self.latency / 2.0, data))
+				if not data:
+					return
+		def write():
+			free_at = 0
+			while(True):
+				deliver_at, data = queue.get()
+				if not data:
+					break
+				send_at = max(deliver_at, free_at)
+				if self.bandwidth:
+					# the link is busy sending this until free_at
+					free_at = send_at + float(len(data)) / self.bandwidth
+				delay = send_at - time.time()
+				if delay > 0:
+					time.sleep(delay)
+				try:
+					dest.sendall(data)
+				except socket.error:
+					break
+			try:
+				dest.shutdown(socket.SHUT_WR)
+			except socket.error:
+				pass
+		for target in (read, write):
+			thread = threading.Thread(target=target)
+			thread.setDaemon(True)
+			thread.start()
+
+	def stop(self):
+		self.sock.close()
@@ -0,0 +1,122 @@
+"""
+ Benchmark for the startup of Music Mover.
+
+ Times the import of the mover module, and checks that paramiko and
+ jsonpickle are not imported with it, then runs mover.py against a synthetic
+ library of width x width albums and times how long it takes the main menu
+ to appear, with startup=full and the default fast startup, each with a cold
+ and a warm album index. Exits with 1 if a fast startup with a warm index
+ takes longer than the target, in seconds.
+
+ usage: python bench_startup.py [width] [target s] [runs]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+sys.path.append('../bin')
+from models import LocalMusic
+from store import ConfigStore
+
+BIN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'bin'))
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import mover
+print time.time() - start, 'paramiko' in sys.modules, 'jsonpickle' in sys.modules
+"""
+
+
+def build_home(home, width):
+	" A home dir with a config holding one music dir of width x width albums "
+	music = os.path.join(home, 'music')
+	for i in range(width):
+		for j in range(width):
+			os.makedirs(os.path.join(music, "artist%03d" % (i), "album%03d" % (j)))
+	local_music = LocalMusic()
+	local_music._dir_list.append(music)
+	ConfigStore(os.path.join(home, '.mediaMover', 'config')).save({'local_music': local_music,
+			'sites': [], 'global_rate_limit': 0, 'bandwidth_profiles': []})
+
+
+def time_import():
+	proc = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT], cwd=BIN_DIR,
+			stdout=subprocess.PIPE)
+	seconds, paramiko, jsonpickle = proc.communicate()[0].split()
+	return float(seconds), paramiko == 'True', jsonpickle == 'True'
+
+
+def time_menu(home, startup):
+	" Seconds until mover.py shows the main menu, then exit it "
+	env = dict(os.environ)
+	env['HOME'] = home
+	start = time.time()
+	proc = subprocess.Popen([sys.executable, '-u', 'mover.py', 'startup=' + startup,
+			'watch=no', 'color=off'], cwd=BIN_DIR, env=env,
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+	output = ''
+	while 'Main Menu' not in output:
+		data = os.read(proc.stdout.fileno(), 4096)
+		if not data:
+			raise RuntimeError("mover.py exited before the menu: %s" % (output))
+		output += data
+	elapsed = time.time() - start
+	# exit from the main menu
+	proc.communicate('5\n')
+	return elapsed
+
+
+def median(value_list):
+	value_list = sorted(value_list)
+	return value_list[len(value_list) / 2]
+
+
+def main():
+	width = 150
+	target = 1.0
+	runs = 3
+	if len(sys.argv) > 1:
+		width = int(sys.argv[1])
+	if len(sys.argv) > 2:
+		target = float(sys.argv[2])
+	if len(sys.argv) > 3:
+		runs = int(sys.argv[3])
+
+	seconds, paramiko, jsonpickle = time_import()
+	print "import mover              %6.3fs  paramiko %s, jsonpickle %s" % (
+			seconds, paramiko and 'imported' or 'deferred',
+			jsonpickle and 'imported' or 'deferred')
+
+	home = tempfile.mkdtemp()
+	try:
+		build_home(home, width)
+		print "%d albums" % (width * width)
+		index_path = os.path.join(home, '.mediaMover', 'album_index.db')
+		result_map = {}
+		for startup in ('full', 'fast'):
+			for index in ('cold', 'warm'):
+				time_list = []
+				for run in range(runs):
+					if index == 'cold' and os.path.exists(index_path):
+						os.remove(index_path)
+					if index == 'warm' and not os.path.exists(index_path):
+						time_menu(home, 'full')
+					time_list.append(time_menu(home, startup))
+				result_map[startup, index] = median(time_list)
+				print "startup=%s, %s index    %6.3fs to the menu" % (startup, index,
+						result_map[startup, index])
+	finally:
+		shutil.rmtree(home)
+
+	if paramiko or jsonpickle or result_map['fast', 'warm'] > target:
+		print "FAIL: target is %.2fs to the menu, without paramiko or jsonpickle" % (target)
+		sys.exit(1)
+	print "OK: under the %.2fs target" % (target)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,266 @@
+"""
+ Benchmark suite for the Music Mover transfer and scan paths.
+
+ Starts an in-process ssh server over a synthetic library, behind a link
+ with the given round trip latency and bandwidth, then times
+ get_album_list (listed, mtime checked and cached), pull_album, _copy_dir
+ with the sftp and tar engines and LocalMusic.refresh_album_cache (walk,
+ cold and warm index) at each library size. Each is repeated and reported
+ as p50/p90/max latency, with the throughput of the transfers.
+
+ Results may be written as json with results=PATH, and compared with
+ those of an earlier run with baseline=PATH; a p50 more than slack times
+ the baseline's is a regression, and the suite exits with 1.
+
+ usage: python bench_transfer.py [sizes=100,1000,5000] [latency=20 (ms)]
+	[bandwidth=0 (KB/s)] [pull=4 (albums)] [files=10] [file_size=512 (KB)]
+	[repeat=5] [results=PATH] [baseline=PATH] [slack=1.25]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+sys.path.append('../bin')
+import paramiko
+from bench_server import SSHServer, LinkShaper
+
+from mover import ConnectionManager
+from models import LocalMusic, RemoteSite
+from stats import StatsCollector, percentile
+
+
+class BenchConnectionManager(ConnectionManager):
+	" Connects to the bench server, accepting its new host key "
+
+	bench_port = None
+
+	def _new_client(self, interactive):
+		ssh_client = paramiko.SSHClient()
+		ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+		ssh_client.connect('127.0.0.1', self.bench_port, 'bench', 'bench',
+				allow_agent=False, look_for_keys=False)
+		ssh_client.get_transport().window_size = self.remote_site.window_size
+		return ssh_client
+
+
+def build_library(root, albums, pull, files, file_size):
+	"""
+	albums album dirs in root, each with one small file, except the first
+	pull albums which hold files tracks of file_size bytes. Returns the
+	names of the pulled albums.
+	"""
+	track = os.urandom(file_size)
+	pull_list = []
+	for i in range(albums):
+		name = "Artist %04d - Album %04d" % (i % 97, i)
+		album = os.path.join(root, name)
+		os.mkdir(album)
+		if i < pull:
+			pull_list.append(name)
+			for j in range(files):
+				f_track = open(os.path.join(album, "%02d - Track.mp3" % (j+1)), 'wb')
+				f_track.write(track)
+				f_track.close()
+		else:
+			f_track = open(os.path.join(album, "01 - Track.mp3"), 'wb')
+			f_track.write(track[:1024])
+			f_track.close()
+	return pull_list
+
+
+class Result(object):
+	" Seconds taken by each run of one measurement, and the bytes moved "
+
+	def __init__(self, name):
+		self.name = name
+		self.time_list = []
+		self.bytes = 0
+
+	def time(self, func, size=0):
+		start = time.time()
+		func()
+		self.time_list.append(time.time() - start)
+		self.bytes += size
+
+	def to_dict(self):
+		result = {
+			'p50': percentile(self.time_list, 0.5),
+			'p90': percentile(self.time_list, 0.9),
+			'max': max(self.time_list),
+			'runs': len(self.time_list),
+		}
+		if self.bytes:
+			result['rate'] = self.bytes / sum(self.time_list)
+		return result
+
+	def __str__(self):
+		result = self.to_dict()
+		line = "%-32s p50 %8.3fs  p90 %8.3fs  max %8.3fs" % (self.name, result['p50'],
+				result['p90'], result['max'])
+		if self.bytes:
+			line += "  %8.2f MB/s" % (result['rate'] / 1048576.0)
+		return line
+
+
+def bench_size(port, work_dir, albums, opts):
+	" Run every measurement over a library of albums, returns the Results "
+	remote_dir = os.path.join(work_dir, 'remote')
+	local_dir = os.path.join(work_dir, 'local')
+	os.mkdir(remote_dir)
+	os.mkdir(local_dir)
+	pull_list = build_library(remote_dir, albums, opts['pull'], opts['files'],
+			opts['file_size'])
+	album_size = opts['files'] * opts['file_size']
+	repeat = opts['repeat']
+
+	site = RemoteSite('bench', 'bench', '127.0.0.1', port)
+	site.add_dir(remote_dir)
+	local_music = LocalMusic()
+	local_music.add_dir(local_dir)
+	BenchConnectionManager.bench_port = port
+	conn_manager = BenchConnectionManager(site, local_music, interactive=False,
+			stats=StatsCollector(), listing_dir=os.path.join(work_dir, 'listings'))
+	result_list = []
+	try:
+		result = Result("get_album_list listed")
+		for i in range(repeat):
+			result.time(lambda: conn_manager.get_album_list(force=True))
+		result_list.append(result)
+		result = Result("get_album_list mtime checked")
+		site.listing_ttl = 0
+		for i in range(repeat):
+			result.time(lambda: conn_manager.get_album_list())
+		result_list.append(result)
+		result = Result("get_album_list cached")
+		site.listing_ttl = 10
+		for i in range(repeat):
+			result.time(lambda: conn_manager.get_album_list())
+		result_list.append(result)
+
+		scp_client = conn_manager.open_sftp()
+		result = Result("pull_album")
+		for i in range(repeat):
+			album = pull_list[i % len(pull_list)]
+			result.time(lambda: conn_manager.pull_album(remote_dir + '/', album, scp_client),
+					album_size)
+			shutil.rmtree(os.path.join(local_dir, album))
+		result_list.append(result)
+		for engine in ('sftp', 'tar'):
+			result = Result("_copy_dir %s" % (engine))
+			for i in range(repeat):
+				album = pull_list[i % len(pull_list)]
+				dest = os.path.join(work_dir, 'copy')
+				os.mkdir(dest)
+				result.time(lambda: conn_manager._copy_dir(scp_client,
+						os.path.join(remote_dir, album), dest, engine), album_size)
+				shutil.rmtree(dest)
+			result_list.append(result)
+		scp_client.close()
+	finally:
+		conn_manager.disconnect()
+
+	# the remote library stands in for a local one
+	local_music = LocalMusic()
+	local_music._dir_list.append(remote_dir)
+	result = Result("refresh_album_cache walk")
+	for i in range(repeat):
+		result.time(local_music.refresh_album_cache)
+	result_list.append(result)
+	index_path = os.path.join(work_dir, 'album_index.db')
+	for state in ('cold', 'warm'):
+		result = Result("refresh_album_cache %s index" % (state))
+		for i in range(repeat):
+			if state == 'cold' and os.path.exists(index_path):
+				os.remove(index_path)
+			local_music.open_index(index_path)
+			result.time(local_music.refresh_album_cache)
+			local_music.close_index()
+		result_list.append(result)
+	return result_list
+
+
+# differences smaller than this, in seconds, are noise
+MIN_CHANGE = 0.005
+
+
+def compare(result_map, baseline_map, slack):
+	" Print the measurements slower than slack times the baseline, returns their count "
+	count = 0
+	for size, result_list in result_map.items():
+		for name, result in result_list.items():
+			base = baseline_map.get(size, {}).get(name)
+			if base and result['p50'] > base['p50'] * slack + MIN_CHANGE:
+				print "REGRESSION %s albums, %s: p50 %.3fs, was %.3fs" % (size, name,
+						result['p50'], base['p50'])
+				count += 1
+	return count
+
+
+def main():
+	opts = {
+		'sizes': '100,1000,5000',
+		'latency': 20,
+		'bandwidth': 0,
+		'pull': 4,
+		'files': 10,
+		'file_size': 512,
+		'repeat': 5,
+		'results': None,
+		'baseline': None,
+		'slack': 1.25,
+	}
+	for arg in sys.argv[1:]:
+		key, value = arg.split('=', 1)
+		if key not in opts:
+			print __doc__
+			sys.exit(2)
+		opts[key] = value
+	for key in ('pull', 'files', 'repeat'):
+		opts[key] = int(opts[key])
+	opts['file_size'] = int(opts['file_size']) * 1024
+	size_list = [int(size) for size in opts['sizes'].split(',')]
+
+	server = SSHServer()
+	shaper = LinkShaper(server.port, float(opts['latency']) / 1000,
+			float(opts['bandwidth']) * 1024)
+	print "latency %sms, bandwidth %s, %d albums pulled of %d x %d KB" % (opts['latency'],
+			float(opts['bandwidth']) and "%s KB/s" % (opts['bandwidth']) or "unlimited",
+			opts['pull'], opts['files'], opts['file_size'] / 1024)
+	result_map = {}
+	try:
+		for size in size_list:
+			work_dir = tempfile.mkdtemp(prefix='bench_transfer')
+			try:
+				print "%d albums" % (size)
+				result_list = bench_size(shaper.port, work_dir, size, opts)
+			finally:
+				shutil.rmtree(work_dir)
+			for result in result_list:
+				print "  %s" % (result)
+			result_map[str(size)] = dict([(result.name, result.to_dict())
+					for result in result_list])
+	finally:
+		shaper.stop()
+		server.stop()
+
+	if opts['results']:
+		f_results = open(opts['results'], 'w')
+		f_results.write(json.dumps({'opts': opts, 'results': result_map}, indent=1))
+		f_results.close()
+	if opts['baseline']:
+		f_base = open(opts['baseline'])
+		baseline = json.loads(f_base.read())
+		f_base.close()
+		for key in ('latency', 'bandwidth', 'pull', 'files', 'file_size'):
+			if str(baseline['opts'][key]) != str(opts[key]):
+				print "Warning: %s was %s for the baseline" % (key, baseline['opts'][key])
+		if compare(result_map, baseline['results'], float(opts['slack'])):
+			sys.exit(1)
+		print "No regressions against %s" % (opts['baseline'])
+
+
+if __name__ == "__main__":
+	main()
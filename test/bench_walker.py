@@ -0,0 +1,93 @@
+"""
+ Benchmark for the local album walker.
+
+ Builds a synthetic tree of about 100k directories (50 x 45 x 45 by default)
+ and times a serial listdir and stat walk, like the old album search, against
+ the parallel walker and a refresh of a warm album index. A latency in ms
+ may be added to every stat and listdir, to act like a network or spinning
+ disk; with a warm local cache the walk is bound by the interpreter.
+
+ usage: python bench_walker.py [tree dir] [width] [latency ms]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from stat import S_ISDIR
+sys.path.append('../bin')
+from walker import AlbumWalker, scandir
+from index import AlbumIndex
+
+
+def build_tree(root, width):
+	" width artists, each with 0.9 * width albums of 0.9 * width discs "
+	count = 0
+	inner = int(width * 0.9)
+	for i in range(width):
+		for j in range(inner):
+			album = os.path.join(root, "artist%03d" % (i), "album%03d" % (j))
+			for k in range(inner):
+				os.makedirs(os.path.join(album, "disc%03d" % (k)))
+				count += 1
+			open(os.path.join(album, "track.mp3"), 'w').close()
+			count += 1
+		count += 1
+	return count
+
+
+def serial_walk(dir, depth=0, max_depth=3):
+	if depth >= max_depth:
+		return []
+	dir_list = []
+	for name in os.listdir(dir):
+		full_dir = os.path.join(dir, name)
+		if not S_ISDIR(os.stat(full_dir).st_mode):
+			continue
+		if os.path.exists(os.path.join(full_dir, '.mover-partial')):
+			continue
+		dir_list.append(full_dir)
+		dir_list.extend(serial_walk(full_dir, depth+1, max_depth))
+	return dir_list
+
+
+def timed(name, func):
+	start = time.time()
+	result = func()
+	print "%-24s %8.2fs  %d albums" % (name, time.time() - start, len(result))
+	return result
+
+
+root = len(sys.argv) > 1 and sys.argv[1] or tempfile.mkdtemp(prefix='bench_walker')
+width = len(sys.argv) > 2 and int(sys.argv[2]) or 50
+if not os.listdir(root):
+	start = time.time()
+	print "Building tree in %s" % (root)
+	print "%d directories in %.1fs" % (build_tree(root, width), time.time() - start)
+print "scandir: %s" % (scandir and "yes" or "no, listdir and stat")
+
+latency = len(sys.argv) > 3 and float(sys.argv[3]) / 1000 or 0
+if latency:
+	def slow(func):
+		def call(*args):
+			time.sleep(latency)
+			return func(*args)
+		return call
+	os.stat = slow(os.stat)
+	os.listdir = slow(os.listdir)
+	print "latency: %.1fms" % (latency * 1000)
+
+timed("serial listdir", lambda: serial_walk(root))
+for workers in (1, 4, 8, 16):
+	walker = AlbumWalker(3, '.mover-partial', workers)
+	timed("walker %d threads" % (workers), lambda: walker.walk([root]) and walker.album_list())
+
+index_path = os.path.join(tempfile.mkdtemp(), 'album_index.db')
+index = AlbumIndex(index_path)
+timed("index cold", lambda: index.refresh([root], 3, '.mover-partial') or index.album_list())
+timed("index warm", lambda: index.refresh([root], 3, '.mover-partial') or index.album_list())
+index.close()
+shutil.rmtree(os.path.dirname(index_path))
+if len(sys.argv) < 2:
+	shutil.rmtree(root)
@@ -0,0 +1,69 @@
+"""
+ Unit tests for delta.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from StringIO import StringIO
+sys.path.append('../bin')
+from delta import REMOTE_SCRIPT, block_signatures, apply_delta
+
+
+BLOCK = 4096
+
+def remote_delta(old_path, new_path):
+	" Run the remote script locally, returns the delta stream "
+	proc = subprocess.Popen([sys.executable, '-c', REMOTE_SCRIPT, new_path],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+	signature_list = block_signatures(old_path, BLOCK)
+	request = "%d %d\n" % (BLOCK, len(signature_list))
+	for weak, strong in signature_list:
+		request += "%d %s\n" % (weak, strong)
+	delta = proc.communicate(request)[0]
+	return delta
+
+def rebuild(old_path, delta):
+	" Apply delta to old_path, returns the new data and the literal bytes "
+	new_file = StringIO()
+	literal_bytes = apply_delta(StringIO(delta), old_path, new_file, BLOCK)
+	return new_file.getvalue(), literal_bytes
+
+work_dir = tempfile.mkdtemp()
+try:
+	old = os.urandom(BLOCK * 20 + 100)
+	old_path = os.path.join(work_dir, 'old')
+	open(old_path, 'wb').write(old)
+
+	case_list = [
+		('same', old),
+		('changed block', old[:BLOCK * 5] + 'x' * BLOCK + old[BLOCK * 6:]),
+		('inserted bytes', old[:BLOCK * 3 + 7] + 'inserted' + old[BLOCK * 3 + 7:]),
+		('appended', old + os.urandom(BLOCK * 2)),
+		('truncated', old[:BLOCK * 4 + 1]),
+		('empty', ''),
+		('new', os.urandom(BLOCK * 3)),
+	]
+	for name, new in case_list:
+		new_path = os.path.join(work_dir, 'new')
+		open(new_path, 'wb').write(new)
+		data, literal_bytes = rebuild(old_path, remote_delta(old_path, new_path))
+		print "%s: %d of %d bytes sent" % (name, literal_bytes, len(new))
+		assert data == new
+		if name in ('same', 'changed block', 'inserted bytes'):
+			# only the changed blocks cross the link
+			assert literal_bytes < BLOCK * 2 + 100
+
+	# a stream cut short, or not matching the remote file, is an error
+	delta = remote_delta(old_path, old_path)
+	for name, bad in [('cut', delta[:delta.rindex('E ')]), ('bad hash', delta[:delta.rindex('E ') + 2] + '0' * 32 + '\n')]:
+		try:
+			rebuild(old_path, bad)
+			print "%s: not detected" % (name)
+			assert False
+		except IOError, err:
+			print "%s: %s" % (name, err)
+finally:
+	shutil.rmtree(work_dir)
@@ -0,0 +1,58 @@
+"""
+ Unit tests for listing.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+sys.path.append('../bin')
+from listing import listing_command, parse_listing, album_entry
+
+
+class ChunkedStream(object):
+	" A stream returning a few bytes per read, like a slow channel "
+
+	def __init__(self, data, chunk):
+		self.data = data
+		self.chunk = chunk
+
+	def read(self, size):
+		data, self.data = self.data[:min(size, self.chunk)], self.data[min(size, self.chunk):]
+		return data
+
+
+name_list = ['Plain', 'With Spaces', 'Tab\there', 'New\nLine', ' leading', '-dash', '\xc3\xa9t\xc3\xa9']
+output = ""
+for name in name_list:
+	output += "/music\tArtist\0/music\tArtist/%s\0" % (name)
+for chunk in (1, 3, 1000):
+	entry_list = list(parse_listing(ChunkedStream(output, chunk), 2))
+	print "%d byte reads: %d albums" % (chunk, len(entry_list))
+	assert entry_list == [('/music', 'Artist/%s' % (name)) for name in name_list]
+# a listing cut short keeps the complete records
+assert list(parse_listing(ChunkedStream(output[:-3], 5), 2))[-1][1] == 'Artist/\xc3\xa9t'
+
+print "Albums:"
+for dir, path in [('/music', 'Album'), ('/music/', 'Artist/Album'), ('/music', 'a/b/Album')]:
+	print "  %s %s -> %s" % (dir, path, album_entry(dir, path))
+assert album_entry('/music', 'Artist/Album') == ('Album', '/music/Artist')
+
+# the find command itself, where GNU find is installed
+work_dir = tempfile.mkdtemp()
+try:
+	for path in ['a dir/Artist/Album One', 'a dir/Artist/.hidden', 'a dir/.skip/Album',
+			'a dir/Other/Album\tTwo', 'a dir/Loose']:
+		os.makedirs(os.path.join(work_dir, path))
+	dir = os.path.join(work_dir, 'a dir')
+	proc = subprocess.Popen(listing_command([dir], 2), shell=True, stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE)
+	entry_list = sorted(parse_listing(proc.stdout, 2))
+	if proc.wait() == 0:
+		print "find:", entry_list
+		assert entry_list == [(dir, 'Artist/Album One'), (dir, 'Other/Album\tTwo')]
+	else:
+		print "find: not GNU find, skipped"
+finally:
+	shutil.rmtree(work_dir)
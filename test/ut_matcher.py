@@ -0,0 +1,61 @@
+"""
+ Unit tests for matcher.
+"""
+
+import sys
+import random
+sys.path.append('../bin')
+from matcher import AlbumMatcher, AlbumMatch, normalize, trigrams
+
+
+print "Normalize:"
+for name in ["Artist - Album (2009)", "artist_-_album", "Artist - Album (Disc 2)",
+		"Artist & Band - Album [CD1]", "1999"]:
+	print "  %r -> %r" % (name, normalize(name))
+assert normalize("Artist - Album (2009)") == normalize("artist_-_album")
+
+# another disc of a local album shares its key, it must only ever be a
+# near match so the listings label it rather than hide it
+local_list = ["Artist - Album (Disc 1)", "Other - Record"]
+matcher = AlbumMatcher(local_list)
+match = matcher.match("Artist - Album (Disc 2)")
+print "Disc 2 against Disc 1:", match.kind, match
+assert match.kind == AlbumMatch.NORMALIZED
+assert matcher.match("Artist - Album (Disc 1)").kind == AlbumMatch.EXACT
+assert AlbumMatcher(local_list, normalized=False).match("Artist - Album (Disc 2)") is None
+
+print "Fuzzy:"
+matcher = AlbumMatcher(local_list, fuzzy=0.6)
+for name in ["Artist - Albun", "Othr - Record", "Someone - Else"]:
+	print "  %s -> %s" % (name, matcher.match(name))
+assert matcher.match("Artist - Albun").kind == AlbumMatch.FUZZY
+assert matcher.match("Someone - Else") is None
+
+# the trigram prefix index must find every key a full comparison would
+def best_score(album, key_list):
+	gram_set = trigrams(normalize(album))
+	best = 0
+	for key in key_list:
+		candidate_grams = trigrams(key)
+		shared = len(gram_set & candidate_grams)
+		best = max(best, float(shared) / (len(gram_set) + len(candidate_grams) - shared))
+	return best
+
+random.seed(1)
+words = ["red", "blue", "night", "day", "live", "house", "river", "gold", "sound", "echo"]
+def random_name():
+	return "%s - %s" % (" ".join(random.sample(words, 2)), " ".join(random.sample(words, 2)))
+local_list = [random_name() for i in range(200)]
+key_list = [normalize(local) for local in local_list]
+missed = 0
+for fuzzy in (0.5, 0.7, 0.9):
+	matcher = AlbumMatcher(local_list, normalized=False, fuzzy=fuzzy)
+	for i in range(200):
+		album = random_name()
+		if album in local_list:
+			continue
+		found = matcher.match(album) is not None
+		if found != (best_score(album, key_list) >= fuzzy):
+			missed += 1
+print "Trigram index misses:", missed
+assert missed == 0
@@ -0,0 +1,32 @@
+"""
+ Unit tests for transfer.
+"""
+
+import sys
+sys.path.append('../bin')
+from transfer import split_ranges
+
+
+print "Ranges:"
+for size, parts, align in [(0, 4, 1), (3, 8, 1), (10, 4, 1), (10, 1, 1), (100, 3, 64),
+		(50, 4, 64), (256, 4, 64), (257, 4, 64)]:
+	print "  %d bytes, %d parts, align %d: %s" % (size, parts, align,
+			split_ranges(size, parts, align))
+
+# the ranges cover the file in order, with no gaps, overlap or empty range,
+# each starts on a multiple of align and there are at most parts of them
+bad_list = []
+for size in range(0, 300):
+	for parts in range(1, 10):
+		for align in (1, 7, 64, 512):
+			range_list = split_ranges(size, parts, align)
+			offset = 0
+			ok = 1 <= len(range_list) <= parts
+			for start, length in range_list:
+				ok = ok and start == offset and start % align == 0
+				ok = ok and (length > 0 or size == 0)
+				offset += length
+			if not ok or offset != size:
+				bad_list.append((size, parts, align, range_list))
+print "Bad splits:", len(bad_list)
+assert not bad_list, bad_list[:3]
@@ -0,0 +1,62 @@
+"""
+ Unit tests for verify.
+"""
+
+import os
+import sys
+import hashlib
+import tempfile
+import threading
+sys.path.append('../bin')
+from verify import StreamHash, BLOCK
+
+
+def content_hash(data):
+	" The content hash as the remote script computes it "
+	whole = hashlib.md5()
+	for offset in range(0, len(data), BLOCK):
+		whole.update(hashlib.md5(data[offset:offset + BLOCK]).digest())
+	return whole.hexdigest()
+
+def feed(hasher, data, range_list, piece):
+	" Feed each range in pieces, every range on its own thread "
+	def feed_range(offset, length):
+		for start in range(offset, offset + length, piece):
+			hasher.update(start, data[start:min(start + piece, offset + length)])
+	thread_list = [threading.Thread(target=feed_range, args=r) for r in range_list]
+	for thread in thread_list:
+		thread.start()
+	for thread in thread_list:
+		thread.join()
+
+fd, path = tempfile.mkstemp()
+os.close(fd)
+try:
+	for size in (0, 100, BLOCK, BLOCK * 3 + 12345):
+		data = os.urandom(size)
+		open(path, 'wb').write(data)
+		third = size / 3
+		case_list = [
+			('whole', [(0, size)]),
+			('aligned', [(0, BLOCK), (BLOCK, max(0, size - BLOCK))]),
+			('unaligned', [(0, third), (third, third), (third * 2, size - third * 2)]),
+			('not fed', []),
+		]
+		for name, range_list in case_list:
+			range_list = [(offset, length) for offset, length in range_list if length > 0]
+			hasher = StreamHash(size)
+			feed(hasher, data, range_list, 65536 + 17)
+			read_back = (size + BLOCK - 1) / BLOCK - len(hasher.digest_map)
+			result = hasher.hexdigest(path)
+			print "%d bytes, %s: %d block(s) read back" % (size, name, read_back)
+			assert result == content_hash(data)
+	# a block which changed on disk after it was fed keeps the fed hash
+	data = os.urandom(BLOCK * 2)
+	open(path, 'wb').write(data)
+	hasher = StreamHash(len(data))
+	hasher.update(0, data)
+	open(path, 'wb').write('x' * len(data))
+	assert hasher.hexdigest(path) == content_hash(data)
+	print "Fed blocks are not read back"
+finally:
+	os.remove(path)